@@ -1,26 +1,43 @@
 import os
+import json
+import numpy as np
 import torch
 import matplotlib.pyplot as plt
 from PIL import Image
 from torchvision import transforms
 import seaborn as sns
 from sklearn.metrics import confusion_matrix, classification_report
-from .argface_extract_features import FeatureExtractor
+from .argface_extract_features import FeatureExtractor, embedding_version
 from .argface_model import ArcFaceModel
 from .argface_train import ArcFaceTrainer
+from embedding_store import EmbeddingStore
+from training_profile import TrainingProfile
 from logger import info
 
 class ArcFaceClassifier:
-    def __init__(self, data_path, arcface_model_dir, model_save_path):
+    def __init__(self, data_path, arcface_model_dir, model_save_path, shard_dir=None, s3_dataset=None, archive=None):
         self.model_loaded = False
         self.data_path = data_path
         self.arcface_model_dir = arcface_model_dir
         self.model_save_path = model_save_path
-        self.feature_extractor = FeatureExtractor(data_path)
+        # Label ids are persisted with the weights so enrolling a customer never renumbers the others
+        self.label_map_path = f"{os.path.splitext(model_save_path)[0]}_labels.json"
+        self.checkpoint_mtime = None
+        self.shard_dir = shard_dir
+        self.s3_dataset = s3_dataset
+        self.archive = archive
+        self.feature_extractor = FeatureExtractor(data_path, shard_dir, s3_dataset, archive)
+        # Opened for the embedding mode of the model, see _embedding_store
+        self.embedding_store = None
         self.features, self.labels, self.label_map = None, None, None
         self.model = None
         self.training_losses = []
         self.training_accuracies = []
+        self.transform = transforms.Compose([
+            transforms.Resize((112, 112)),
+            transforms.ToTensor(),
+            transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
+        ])
 
     def initialize_model(self, num_classes=None):
         info("Initializing model...")
@@ -35,16 +52,28 @@ class ArcFaceClassifier:
 
     def extract_labels(self):
         info("Extracting labels...")
-        self.feature_extractor.extract_labels()
+        self.feature_extractor.extract_labels(self.load_label_map())
         self.label_map = self.feature_extractor.label_map
         info(f"Extracted label map: {self.label_map}")
 
-    def extract_features(self):
+    def extract_features(self, checkpoint=None):
         info("Extracting features...")
         if self.model is None:
             raise ValueError("Model is not initialized. Call initialize_model() first.")
-        self.feature_extractor.extract_features(self.model)
+        state = checkpoint.load('features') if checkpoint else None
+        version = embedding_version(self.model.embedding_mode)
+        if state and state['label_map'] == self.label_map and state.get('embedding_version') == version:
+            self.features, self.labels = state['features'], state['labels']
+            info(f"Features restored from checkpoint: {len(self.features)} samples")
+            return
+        if state:
+            info("Customers or embedding mode changed since the checkpoint was taken, starting over")
+            checkpoint.clear()
+        self.feature_extractor.extract_features(self.model, self._embedding_store())
         self.features, self.labels = self.feature_extractor.get_features_and_labels()
+        if checkpoint:
+            checkpoint.save('features', {'features': self.features, 'labels': self.labels,
+                                         'label_map': self.label_map, 'embedding_version': version})
 
         if self.features is None or self.labels is None:
             raise ValueError("Features or labels not extracted correctly.")
@@ -52,20 +81,20 @@ class ArcFaceClassifier:
             raise ValueError("Extracted features or labels are empty.")
         info("Features and labels extracted successfully.")
 
-    def train(self, num_epochs=100, lr=0.001, momentum=0.9):
+    def train(self, num_epochs=100, lr=0.001, momentum=0.9, batch_size=256, val_split=0.1, patience=10,
+              on_epoch=None, checkpoint=None):
         info("Starting training...")
         if self.features is None or self.labels is None:
             raise ValueError("Features or labels is None. Ensure they are extracted correctly.")
-        trainer = ArcFaceTrainer(self.model, self.features, self.labels, lr, momentum)
-        
-        for epoch in range(num_epochs):
-            info(f"Epoch {epoch + 1}/{num_epochs}...")
-            loss, accuracy = trainer.train_epoch()
-            self.training_losses.append(loss)
-            self.training_accuracies.append(accuracy)
-            info(f'Epoch {epoch+1}/{num_epochs}, Loss: {loss:.4f}, Accuracy: {accuracy:.4f}')
-
-        torch.save(self.model.state_dict(), self.model_save_path)
+        trainer = ArcFaceTrainer(self.model, self.features, self.labels, lr, momentum,
+                                 profile=TrainingProfile.from_env())
+
+        history = trainer.fit(num_epochs=num_epochs, batch_size=batch_size, val_split=val_split, patience=patience,
+                              on_epoch=on_epoch, checkpoint=checkpoint)
+        self.training_losses.extend(epoch['loss'] for epoch in history)
+        self.training_accuracies.extend(epoch['accuracy'] for epoch in history)
+
+        self.save_model()
         info("Training completed. Model saved.")
         self.print_evaluation_metrics(self.labels, trainer.get_predictions(), save_path=self.arcface_model_dir)
 
@@ -101,12 +130,102 @@ class ArcFaceClassifier:
         info("Loading model...")
         if not self.model_loaded:
             self.initialize_model()
-            self.model.load_state_dict(torch.load(self.model_save_path))
+            self.load_checkpoint()
             self.model_loaded = True
             info(f"Model loaded: {self.model_save_path}")
         else:
             info("Model already loaded, skipping reload.")
 
+    def load_checkpoint(self):
+        """Load the saved weights, and the saved label ids when present, into the current model."""
+        checkpoint_mtime = os.path.getmtime(self.model_save_path)
+        label_map = self.load_label_map()
+        if label_map:
+            self.label_map = label_map
+        self.model.load_state_dict(torch.load(self.model_save_path, map_location=self.model.device))
+        self.checkpoint_mtime = checkpoint_mtime
+
+    def load_label_map(self):
+        """Return the label ids saved with the model, or None for checkpoints saved without them."""
+        if not os.path.isfile(self.label_map_path):
+            return None
+        with open(self.label_map_path) as label_file:
+            return {int(label): person for label, person in json.load(label_file).items()}
+
+    def save_model(self):
+        """Write the label ids and weights atomically, so a reader never sees a partial file.
+
+        Labels go first: new labels next to old weights only add a class that is never predicted.
+        """
+        os.makedirs(os.path.dirname(self.model_save_path), exist_ok=True)
+        with open(f"{self.label_map_path}.tmp", 'w') as label_file:
+            json.dump(self.label_map, label_file)
+        os.replace(f"{self.label_map_path}.tmp", self.label_map_path)
+        torch.save(self.model.state_dict(), f"{self.model_save_path}.tmp")
+        os.replace(f"{self.model_save_path}.tmp", self.model_save_path)
+        self.checkpoint_mtime = os.path.getmtime(self.model_save_path)
+        info(f"Model saved: {self.model_save_path}")
+
+    def _embedding_store(self):
+        """Return the embedding store of the model's embedding mode; each mode caches its own features."""
+        version = embedding_version(self.model.embedding_mode)
+        if self.embedding_store is None or self.embedding_store.model_version != version:
+            self.embedding_store = EmbeddingStore(os.path.join(self.arcface_model_dir, 'embedding_store'), version)
+        return self.embedding_store
+
+    def clone(self):
+        """Return a copy with its own head weights and labels that shares the InsightFace sessions.
+
+        Used to fine-tune next to the serving model, which keeps answering until the copy is published.
+        """
+        other = ArcFaceClassifier.__new__(ArcFaceClassifier)
+        other.__dict__.update(self.__dict__)
+        other.feature_extractor = FeatureExtractor(self.data_path, self.shard_dir, self.s3_dataset, self.archive)
+        other.label_map = dict(self.label_map)
+        other.features, other.labels = None, None
+        other.training_losses, other.training_accuracies = [], []
+        other.model = ArcFaceModel(feature_dim=self.model.fc1.in_features, num_classes=self.model.fc2.out_features,
+                                   model_dir=self.arcface_model_dir, embedding_mode=self.model.embedding_mode)
+        other.model.share_face_analysis(self.model)
+        other.model.load_state_dict(self.model.state_dict())
+        return other
+
+    def enroll(self, person_name, num_epochs=50, lr=0.01, momentum=0.9, batch_size=256):
+        """Add a customer to the trained model without retraining it from scratch.
+
+        fc2 gets one more output per new customer and only fc2 is fine-tuned, on the features of
+        the whole gallery: known images come from the embedding store, only new ones are embedded.
+        """
+        info(f"Enrolling {person_name}...")
+        if self.model is None:
+            raise ValueError("Model is not initialized. Call load_model() first.")
+        if not os.path.isdir(os.path.join(self.data_path, person_name)):
+            raise FileNotFoundError(f"No images found for {person_name} in {self.data_path}")
+
+        # Customers added since the last training (e.g. through /retrieve) are enrolled as well
+        self.feature_extractor.label_map = {}
+        self.feature_extractor.extract_labels(self.label_map)
+        self.label_map = self.feature_extractor.label_map
+        self.model.expand_final_layer(max(self.label_map) + 1)
+
+        self.feature_extractor.extract_features(self.model, self._embedding_store())
+        self.features, self.labels = self.feature_extractor.get_features_and_labels()
+        person_label = next(label for label, person in self.label_map.items() if person == person_name)
+        if not np.any(self.labels == person_label):
+            raise ValueError(f"No face could be embedded from the images of {person_name}")
+
+        trainer = ArcFaceTrainer(self.model, self.features, self.labels, lr, momentum,
+                                 parameters=self.model.fc2.parameters())
+        # Every image is needed to fit the new class, so nothing is held out for validation
+        history = trainer.fit(num_epochs=num_epochs, batch_size=batch_size, val_split=0)
+        self.training_losses.extend(epoch['loss'] for epoch in history)
+        self.training_accuracies.extend(epoch['accuracy'] for epoch in history)
+        info(f"Enrolled {person_name} as label {person_label} after {len(history)} epochs, "
+             f"Loss: {history[-1]['loss']:.4f}, Accuracy: {history[-1]['accuracy']:.4f}")
+        self.model.eval()
+        self.save_model()
+        return person_label
+
     def model_exists(self):
         exists = os.path.exists(self.model_save_path)
         info(f"Model exists: {exists}")
@@ -117,24 +236,50 @@ class ArcFaceClassifier:
         if not os.path.exists(image_file):
             raise FileNotFoundError(f"Image file not found: {image_file}")
 
-        transform = transforms.Compose([
-            transforms.Resize((112, 112)),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
-        ])
         image = Image.open(image_file).convert("RGB")  # Ensure image is in RGB format
-        image_tensor = transform(image).unsqueeze(0).to(self.model.device)  # Move tensor to the correct device
+        person_name = self.identify_person_array(np.array(image))
+        info(f"Identified person: {person_name} from image: {image_file}")
+        return person_name
+
+    def identify_person_array(self, face_array):
+        """Identify a person from an RGB uint8 face crop held in memory."""
+        image = Image.fromarray(face_array).convert("RGB")
 
         with torch.no_grad():
-            embedding = self.model.get_embedding(image_tensor).to(self.model.device)  # Ensure the embedding is on the device
+            # Same embedding path as the training features of the model's embedding mode
+            embedding = self.model.embed_image(image, self.transform).to(self.model.device)
             info(f"Generated embedding: {embedding.shape}")
         predicted = self.model.predict(embedding)  # Ensure tensor is moved before prediction
         info(f"Prediction result: {predicted}")
-        
+
         person_name = self.label_map[predicted.item()]
-        info(f"Identified person: {person_name} from image: {image_file}")
+        info(f"Identified person: {person_name}")
         return person_name
     
+    def identify_person_arrays(self, face_arrays):
+        """Identify every face crop of a frame with one batched embedding and prediction call."""
+        info(f"Identifying {len(face_arrays)} faces in one batch")
+        person_names = ['Unknown'] * len(face_arrays)
+        if not face_arrays:
+            return person_names
+
+        with torch.no_grad():
+            if self.model.embedding_mode == 'recognition':
+                # align_face_crop output goes to the recognition network as is, like in FeatureExtractor
+                embeddings = self.model.get_aligned_embeddings([np.asarray(face) for face in face_arrays])
+                valid_indices = list(range(len(face_arrays)))
+            else:
+                batch = torch.stack([self.transform(Image.fromarray(face).convert("RGB")) for face in face_arrays])
+                embeddings, valid_indices = self.model.get_embeddings(batch.to(self.model.device))
+            if not valid_indices:
+                return person_names
+            predicted = self.model.predict(embeddings)
+
+        for index, label in zip(valid_indices, predicted.tolist()):
+            person_names[index] = self.label_map[label]
+        info(f"Identified persons: {person_names}")
+        return person_names
+
     def identify_person_from_embedding(self, embedding):
         info("Identifying person from embedding...")
         embedding_tensor = torch.tensor(embedding, dtype=torch.float32).unsqueeze(0).to(self.model.device)
@@ -1,13 +1,27 @@
 import os
-from PIL import Image
+import time
 import numpy as np
 import torch
 from torchvision import transforms
+from embedding_store import content_hash
+from dataset_shards import DatasetShards
+from .parallel_extraction import decode_bytes, extract_parallel, load_image
 from logger import info, error
 
+def embedding_version(embedding_mode):
+    """Identify how features are produced; bump it when the transform or embedding path changes."""
+    return f"buffalo_l-{embedding_mode}-112"
+
+
 class FeatureExtractor:
-    def __init__(self, data_path):
+    def __init__(self, data_path, shard_dir=None, s3_dataset=None, archive=None):
         self.data_path = data_path
+        # Pre-decoded 112x112 dataset shards (see dataset_shards.py); None reads the image files
+        self.shard_dir = shard_dir
+        # Optional S3Dataset (see s3_dataset.py) streaming the gallery from S3 instead of data_path
+        self.s3_dataset = s3_dataset
+        # Optional GalleryArchive (see gallery_archive.py) reading the gallery from packed tar shards
+        self.archive = archive
         self.transform = transforms.Compose([
             transforms.Resize((112, 112)),
             transforms.ToTensor(),
@@ -17,14 +31,26 @@ class FeatureExtractor:
         self.labels = []
         self.label_map = {}
 
-    def extract_labels(self):
-        """Extract labels from the dataset directory."""
+    def extract_labels(self, known_label_map=None):
+        """Extract labels from the dataset directory.
+
+        Labels of known_label_map keep their ids, customers found on disk that it does
+        not contain get the next free ids.
+        """
         try:
-            info(f"Extracting labels from {self.data_path}")
-            for label, person in enumerate(os.listdir(self.data_path)):
-                person_path = os.path.join(self.data_path, person)
-                if os.path.isdir(person_path):
-                    self.label_map[label] = person
+            info(f"Extracting labels from {self._source_name()}")
+            if known_label_map:
+                self.label_map = dict(known_label_map)
+                known_persons = set(known_label_map.values())
+                next_label = max(known_label_map) + 1
+                for person in sorted(self._persons()):
+                    if person not in known_persons and self._is_person(person):
+                        self.label_map[next_label] = person
+                        next_label += 1
+            else:
+                for label, person in enumerate(self._persons()):
+                    if self._is_person(person):
+                        self.label_map[label] = person
             if not self.label_map:
                 raise ValueError("No labels found. The dataset directory might be empty.")
             info(f"Labels extracted: {self.label_map}")
@@ -32,39 +58,94 @@ class FeatureExtractor:
             error(f"Error extracting labels: {e}")
             raise ValueError(f"Error extracting labels: {e}") from e
 
-    def extract_features(self, model):
-        """Extract features from the images using the given model."""
+    def extract_features(self, model, embedding_store=None, workers=None):
+        """Extract features from the images using the given model.
+
+        With an embedding_store, images whose content was embedded before are served from
+        the store and only new or changed images go through the model. With more than one
+        worker (ARCFACE_EXTRACT_WORKERS by default) those images are embedded in a process pool.
+        """
+        workers = int(os.getenv('ARCFACE_EXTRACT_WORKERS', '0')) if workers is None else workers
         if not self.label_map:
             error("Label map is empty. Please call extract_labels() first.")
             raise ValueError("Label map is empty. Please call extract_labels() first.")
 
         info("Starting feature extraction...")
+        self.features, self.labels = [], []
+        new_entries = []
+        shard_images, source = None, self.s3_dataset
+        if self.s3_dataset is not None:
+            s3_images = self.s3_dataset.images_by_person()
+        elif self.archive is not None:
+            source = self.archive
+            archive_images = self.archive.indices_by_person()
+        elif self.shard_dir and model.embedding_mode == 'recognition':
+            # The shards hold whole images downscaled to 112x112, the face crop needs the full resolution
+            info("Recognition embedding mode reads the image files instead of the dataset shards")
+        elif self.shard_dir:
+            source = DatasetShards(self.data_path, self.shard_dir, 112).update()
+            shard_images = source.indices_by_person()
+        # Gallery images in label order; features[i] stays None for images without an embedding
+        images, features, pending = [], [], []
         for label, person in self.label_map.items():
-            person_path = os.path.join(self.data_path, person)
-            if not os.path.isdir(person_path):
-                continue
-            for image_name in os.listdir(person_path):
-                image_path = os.path.join(person_path, image_name)
-                if not image_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-                    continue
-                try:
-                    image = Image.open(image_path).convert("RGB")
-                    info(f"Processing image: {image_path}")
-                except Exception as e:
-                    error(f"Error opening image {image_path}: {e}")
-                    continue
-
-                image_tensor = self.transform(image).unsqueeze(0)
-                try:
-                    with torch.no_grad():
-                        embedding = model.get_embedding(image_tensor)
-                    # Ensure the tensor is moved to the CPU before converting to a NumPy array
-                    self.features.append(embedding.squeeze().cpu().numpy())
-                    self.labels.append(label)
-                    info(f"Feature extracted for image: {image_path}")
-                except Exception as e:
-                    error(f"Error extracting embedding for {image_path}: {e}")
-                    continue
+            if self.s3_dataset is not None:
+                person_images = self._s3_images(s3_images.get(person, []))
+            elif self.archive is not None:
+                person_images = self._archive_images(archive_images.get(person, []))
+            elif shard_images is not None:
+                person_images = self._shard_images(source, shard_images.get(person, []))
+            else:
+                person_images = self._file_images(person)
+            for image_path, digest, load_image, ref in person_images:
+                images.append((label, image_path, digest, load_image, ref))
+                features.append(None)
+                if embedding_store is not None:
+                    found, embedding = embedding_store.get(digest)
+                    if found:
+                        features[-1] = embedding
+                        continue
+                pending.append(len(images) - 1)
+
+        if workers > 1 and len(pending) > 1:
+            embedded = extract_parallel([images[i][4] for i in pending], model.model_dir, self.transform, workers,
+                                        source=source, embedding_mode=model.embedding_mode)
+        elif self.archive is not None:
+            start = time.perf_counter()
+            # One pass over the shards in storage order, neighbouring images come from a single read
+            refs = {images[i][4]: i for i in pending}
+            by_position = {}
+            for ref, image_bytes in self.archive.iter_images(list(refs)):
+                by_position[refs[ref]] = self._embed_image(model, images[refs[ref]][1],
+                                                           lambda image_bytes=image_bytes: decode_bytes(image_bytes))
+            embedded = [by_position[i] for i in pending]
+            if pending:
+                info(f"Extracted {len(pending)} images in {time.perf_counter() - start:.1f}s")
+        else:
+            start = time.perf_counter()
+            embedded = []
+            for n, i in enumerate(pending):
+                if self.s3_dataset is not None:
+                    # Keep the next images downloading while this one is embedded
+                    self.s3_dataset.prefetch([images[j][4] for j in pending[n + 1:n + 1 + self.s3_dataset.read_ahead]])
+                embedded.append(self._embed_image(model, images[i][1], images[i][3]))
+            if pending:
+                info(f"Extracted {len(pending)} images in {time.perf_counter() - start:.1f}s")
+        for i, feature in zip(pending, embedded):
+            features[i] = feature
+            if embedding_store is not None:
+                # Failures are cached too, so images without a face are not retried every run
+                new_entries.append((images[i][2], feature))
+
+        for (label, _, _, _, _), feature in zip(images, features):
+            if feature is not None:
+                self.features.append(feature)
+                self.labels.append(label)
+
+        if embedding_store is not None:
+            embedding_store.put_many(new_entries)
+            stats = embedding_store.stats()
+            info(f"Embedding store: {stats['hits']} hits, {stats['misses']} misses "
+                 f"(hit rate {stats['hit_rate']:.2%}), {len(new_entries)} images embedded")
 
         # Convert to NumPy arrays and check size
         self.features = np.array(self.features)
@@ -76,6 +157,75 @@ class FeatureExtractor:
 
         info("Feature extraction completed successfully.")
 
+    def _embed_image(self, model, image_path, load_image):
+        try:
+            image = load_image()
+            info(f"Processing image: {image_path}")
+        except Exception as e:
+            error(f"Error opening image {image_path}: {e}")
+            return None
+
+        try:
+            with torch.no_grad():
+                embedding = model.embed_image(image, self.transform)
+            info(f"Feature extracted for image: {image_path}")
+            # Ensure the tensor is moved to the CPU before converting to a NumPy array
+            return embedding.squeeze().cpu().numpy()
+        except Exception as e:
+            error(f"Error extracting embedding for {image_path}: {e}")
+            return None
+
+    def _source_name(self):
+        if self.s3_dataset is not None:
+            return self.s3_dataset.prefix
+        return self.archive.archive_dir if self.archive is not None else self.data_path
+
+    def _persons(self):
+        """Customer folders of the dataset, from the bucket listing or archive index when reading those."""
+        if self.s3_dataset is not None:
+            return self.s3_dataset.persons()
+        return self.archive.persons() if self.archive is not None else os.listdir(self.data_path)
+
+    def _is_person(self, person):
+        return self.s3_dataset is not None or self.archive is not None or \
+            os.path.isdir(os.path.join(self.data_path, person))
+
+    def _file_images(self, person):
+        """Yield (path, content hash, image loader, worker reference) for the image files of a customer."""
+        person_path = os.path.join(self.data_path, person)
+        if not os.path.isdir(person_path):
+            return
+        for image_name in os.listdir(person_path):
+            image_path = os.path.join(person_path, image_name)
+            if not image_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
+                continue
+            try:
+                with open(image_path, 'rb') as image_file:
+                    image_bytes = image_file.read()
+            except OSError as e:
+                error(f"Error reading image {image_path}: {e}")
+                continue
+            # Images are re-read when embedded so the whole gallery is never held in memory
+            yield image_path, content_hash(image_bytes), lambda path=image_path: load_image(path), image_path
+
+    @staticmethod
+    def _shard_images(shards, indices):
+        """Yield (path, content hash, image loader, worker reference) for pre-decoded shard rows."""
+        for index in indices:
+            entry = shards.entries[index]
+            yield entry['path'], entry['digest'], lambda index=index: load_image(index, shards), index
+
+    def _s3_images(self, keys):
+        """Yield (key, ETag digest, image loader, worker reference) for S3 images; nothing is downloaded yet."""
+        for key in keys:
+            yield key, self.s3_dataset.digest(key), lambda key=key: self.s3_dataset.open_image(key), key
+
+    def _archive_images(self, indices):
+        """Yield (path, content hash, image loader, worker reference) for images of the gallery archive."""
+        for index in indices:
+            entry = self.archive.entries[index]
+            yield entry['path'], entry['digest'], lambda index=index: self.archive.open_image(index), index
+
     def get_features_and_labels(self):
         """Return the extracted features and labels."""
         if self.features.size == 0 or self.labels.size == 0:
@@ -1,26 +1,70 @@
+import os
 import torch
 import torch.nn as nn
 import numpy as np
 import insightface
-from logger import info, error
+from threading import Lock
+from PIL import Image
+from logger import info, debug, error
+
+# 'detect' re-runs the buffalo_l detector on every crop, 'recognition' feeds YOLO crops
+# straight into the recognition network
+EMBEDDING_MODES = ('detect', 'recognition')
+
+
+def align_face_crop(image_np, bbox, output_size=112, margin=0.0):
+    """Cut a square crop centred on a YOLO face box and resize it to the recognition input size."""
+    x1, y1, x2, y2 = bbox
+    center_x, center_y = (x1 + x2) / 2, (y1 + y2) / 2
+    half_side = max(x2 - x1, y2 - y1) * (1 + margin) / 2
+    # PIL pads regions outside the frame with black, keeping the face centred near borders
+    crop = Image.fromarray(image_np).crop((
+        int(round(center_x - half_side)), int(round(center_y - half_side)),
+        int(round(center_x + half_side)), int(round(center_y + half_side))
+    ))
+    return np.array(crop.resize((output_size, output_size), Image.BILINEAR))
+
 
 class ArcFaceModel(nn.Module):
-    def __init__(self, feature_dim, num_classes, model_dir):
+    def __init__(self, feature_dim, num_classes, model_dir, embedding_mode=None):
         super(ArcFaceModel, self).__init__()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.face_analysis = insightface.app.FaceAnalysis(name='buffalo_l', root=model_dir)
-        self.face_analysis.prepare(ctx_id=0 if self.device == torch.device('cuda') else -1)
+        self.embedding_mode = embedding_mode or os.getenv('ARCFACE_EMBEDDING_MODE', 'detect')
+        if self.embedding_mode not in EMBEDDING_MODES:
+            raise ValueError(f"Unknown ArcFace embedding mode: {self.embedding_mode}, expected one of {EMBEDDING_MODES}")
+        self.model_dir = model_dir
+        # InsightFace sessions are created on first use, once per process (see face_analysis)
+        self._face_analysis = None
+        self._face_analysis_pid = None
+        self._face_analysis_lock = Lock()
 
-        info(f"Model initialized on device: {self.device}")
+        info(f"Model initialized on device: {self.device} with embedding mode: {self.embedding_mode}")
 
         # Define trainable layers
         self.fc1 = nn.Linear(feature_dim, 256)
         self.fc2 = nn.Linear(256, num_classes)
         self.criterion = nn.CrossEntropyLoss()
+        # Optional ONNX/TorchScript backend for the fc1/fc2 head at inference time
+        self.head_backend = None
 
         # Move model to the appropriate device
         self.to(self.device)
 
+    @property
+    def face_analysis(self):
+        """Return the buffalo_l FaceAnalysis of this process, creating it on first use.
+
+        ONNX Runtime sessions do not survive fork(), so a forked serving worker builds its own.
+        """
+        if self._face_analysis is None or self._face_analysis_pid != os.getpid():
+            with self._face_analysis_lock:
+                if self._face_analysis is None or self._face_analysis_pid != os.getpid():
+                    face_analysis = insightface.app.FaceAnalysis(name='buffalo_l', root=self.model_dir)
+                    face_analysis.prepare(ctx_id=0 if self.device == torch.device('cuda') else -1)
+                    self._face_analysis = face_analysis
+                    self._face_analysis_pid = os.getpid()
+        return self._face_analysis
+
     def get_embedding(self, image):
         info("Extracting embedding from image")
         image_np = image.squeeze(0).permute(1, 2, 0).cpu().numpy()  # Ensure tensor is on CPU before converting
@@ -31,19 +75,66 @@ class ArcFaceModel(nn.Module):
         info("Face detected and embedding extracted")
         return torch.tensor(face_info[0].embedding, dtype=torch.float32).unsqueeze(0).to(self.device)
 
+    def get_embeddings(self, images):
+        """Extract embeddings for a batch of normalized face tensors.
+
+        Returns the stacked embeddings and the batch indices they belong to, faces
+        the detector rejects are left out instead of failing the whole batch.
+        """
+        info(f"Extracting embeddings from a batch of {images.size(0)} images")
+        images_np = images.permute(0, 2, 3, 1).cpu().numpy()
+        images_np = ((images_np + 1) / 2 * 255).astype(np.uint8)  # Denormalize
+        if self.embedding_mode == 'recognition':
+            return self.get_aligned_embeddings(images_np), list(range(len(images_np)))
+
+        embeddings, valid_indices = [], []
+        for index, image_np in enumerate(images_np):
+            face_info = self.face_analysis.get(image_np)
+            if len(face_info) == 0:
+                info(f"No face detected in batch item {index}")
+                continue
+            embeddings.append(face_info[0].embedding)
+            valid_indices.append(index)
+        if not embeddings:
+            return torch.empty((0, self.fc1.in_features), device=self.device), valid_indices
+        return torch.tensor(np.stack(embeddings), dtype=torch.float32).to(self.device), valid_indices
+
+    def embed_image(self, image, transform):
+        """Embed one RGB gallery image the way serving embeds faces in this embedding mode.
+
+        In 'recognition' mode the buffalo_l detector only locates the face; the crop fed to the
+        recognition network is cut by align_face_crop from the full-resolution uint8 image,
+        as serving does around a YOLO box.
+        """
+        if self.embedding_mode != 'recognition':
+            return self.get_embedding(transform(image).unsqueeze(0))
+        image_np = np.asarray(image)
+        bboxes, _ = self.face_analysis.det_model.detect(image_np, max_num=1)
+        if len(bboxes) == 0:
+            raise ValueError("No face detected")
+        return self.get_aligned_embeddings([align_face_crop(image_np, bboxes[0][:4])])
+
+    def get_aligned_embeddings(self, faces):
+        """Run only the recognition network on already aligned 112x112 RGB uint8 faces."""
+        recognition = self.face_analysis.models['recognition']
+        # insightface expects BGR input and swaps channels itself
+        faces_bgr = [np.ascontiguousarray(face[:, :, ::-1]) for face in faces]
+        embeddings = recognition.get_feat(faces_bgr)
+        return torch.tensor(embeddings, dtype=torch.float32).to(self.device)
+
     def forward(self, features):
-        info(f"Forward pass started on device: {features.device}")
+        debug(f"Forward pass started on device: {features.device}")
         features = features.to(self.device)
-        info(f"Input features moved to device: {features.device}")
+        debug(f"Input features moved to device: {features.device}")
 
         x = self.fc1(features)
-        info(f"After fc1 - device: {x.device}")
+        debug(f"After fc1 - device: {x.device}")
 
         x = nn.ReLU()(x)
-        info("Applied ReLU activation")
+        debug("Applied ReLU activation")
 
         output = self.fc2(x)
-        info(f"Output generated - device: {output.device}")
+        debug(f"Output generated - device: {output.device}")
         return output
 
     def predict(self, feature):
@@ -56,18 +147,22 @@ class ArcFaceModel(nn.Module):
             if param.device != self.device:
                 error(f"Parameter {name} is on {param.device}, expected {self.device}")
 
-        x = self.fc1(feature)
-        info(f"After fc1 - device: {x.device}")
+        if self.head_backend is not None:
+            output = torch.from_numpy(self.head_backend(feature.detach().cpu().numpy()))
+            info(f"Output generated by {self.head_backend.name} backend")
+        else:
+            x = self.fc1(feature)
+            info(f"After fc1 - device: {x.device}")
 
-        x = nn.ReLU()(x)
-        info("Applied ReLU activation")
+            x = nn.ReLU()(x)
+            info("Applied ReLU activation")
 
-        output = self.fc2(x)
-        info(f"Output generated - device: {output.device}")
+            output = self.fc2(x)
+            info(f"Output generated - device: {output.device}")
 
         # Ensure the result is on the correct device if needed
         _, predicted = torch.max(output, 1)
-        info(f"Prediction completed. Predicted class: {predicted.item()}")
+        info(f"Prediction completed. Predicted class: {predicted.tolist()}")
 
         return predicted
 
@@ -77,6 +172,24 @@ class ArcFaceModel(nn.Module):
             self.fc2 = nn.Linear(256, num_classes)
             self.num_classes = num_classes
 
+    def expand_final_layer(self, num_classes):
+        """Grow fc2 to num_classes outputs, keeping the weights of the existing classes."""
+        old_fc2 = self.fc2
+        if num_classes <= old_fc2.out_features:
+            return
+        info(f"Expanding final layer from {old_fc2.out_features} to {num_classes} classes")
+        new_fc2 = nn.Linear(old_fc2.in_features, num_classes).to(self.device)
+        with torch.no_grad():
+            new_fc2.weight[:old_fc2.out_features] = old_fc2.weight
+            new_fc2.bias[:old_fc2.out_features] = old_fc2.bias
+        self.fc2 = new_fc2
+        self.num_classes = num_classes
+
+    def share_face_analysis(self, other):
+        """Reuse the InsightFace sessions of another model instead of loading buffalo_l again."""
+        self._face_analysis = other.face_analysis
+        self._face_analysis_pid = os.getpid()
+
     def load_state_dict(self, state_dict, strict=True):
         info("Loading state dict")
         if 'fc2.weight' in state_dict and state_dict['fc2.weight'].size(0) != self.fc2.out_features:
@@ -1,39 +1,198 @@
+import time
+import numpy as np
 import torch
 import torch.optim as optim
 import torch.nn as nn
+from training_checkpoint import restore_rng_state, rng_state
+from training_profile import TrainingProfile
 from logger import info
 
 class ArcFaceTrainer:
-    def __init__(self, model, features, labels, lr=0.01, momentum=0.9):
+    def __init__(self, model, features, labels, lr=0.01, momentum=0.9, parameters=None, profile=None):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model = model.to(self.device)
-        self.features = torch.tensor(features, dtype=torch.float32).to(self.device)
-        self.labels = torch.tensor(labels, dtype=torch.long).to(self.device)
-        self.optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
+        # Kept on the host; fit() only moves one mini-batch at a time to the device
+        self.features = torch.as_tensor(features, dtype=torch.float32)
+        self.labels = torch.as_tensor(labels, dtype=torch.long)
+        # parameters restricts training to part of the model, e.g. only fc2 when enrolling
+        self.optimizer = optim.SGD(parameters if parameters is not None else model.parameters(),
+                                   lr=lr, momentum=momentum)
         self.criterion = nn.CrossEntropyLoss()
+        # bf16 autocast, channels_last and torch.compile for fit(); see training_profile.py
+        self.profile = profile or TrainingProfile()
+        self._forward = None
 
     def train_epoch(self):
+        """One full-batch gradient step over every feature."""
         self.model.train()
+        features, labels = self.features.to(self.device), self.labels.to(self.device)
         self.optimizer.zero_grad()
-        outputs = self.model(self.features)
-        loss = self.criterion(outputs, self.labels)
+        outputs = self.model(features)
+        loss = self.criterion(outputs, labels)
         loss.backward()
         self.optimizer.step()
 
         # Calculate accuracy
         _, predicted = torch.max(outputs, 1)
-        total = self.labels.size(0)
-        correct = (predicted == self.labels).sum().item()
+        total = labels.size(0)
+        correct = (predicted == labels).sum().item()
         accuracy = correct / total
 
         return loss.item(), accuracy
-    
-    def get_predictions(self):
+
+    def split_validation(self, val_split, seed=0):
+        """Return (train_indices, val_indices), holding out val_split of every class.
+
+        Classes with a single sample stay in the training set.
+        """
+        rng = np.random.default_rng(seed)
+        labels = self.labels.numpy()
+        train_indices, val_indices = [], []
+        order = np.argsort(labels, kind='stable')
+        boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+        for class_indices in np.split(order, boundaries):
+            class_indices = rng.permutation(class_indices)
+            held_out = int(len(class_indices) * val_split)
+            val_indices.append(class_indices[:held_out])
+            train_indices.append(class_indices[held_out:])
+        return np.concatenate(train_indices), np.concatenate(val_indices)
+
+    def evaluate(self, indices=None, batch_size=1024):
+        """Return (loss, accuracy) over the given samples, all of them by default."""
+        predicted, loss = self._predict(indices, batch_size)
+        labels = self.labels if indices is None else self.labels[indices]
+        return loss, float((predicted == labels).float().mean()) if len(labels) else 0.0
+
+    def _predict(self, indices=None, batch_size=1024):
+        features = self.features if indices is None else self.features[indices]
+        labels = self.labels if indices is None else self.labels[indices]
         self.model.eval()
+        predictions, total_loss = [], 0.0
         with torch.no_grad():
-            outputs = self.model(self.features)
-            _, predicted = torch.max(outputs, 1)
-        return predicted.cpu().numpy()
+            for start in range(0, len(features), batch_size):
+                batch_labels = labels[start:start + batch_size].to(self.device)
+                with self.profile.autocast(self.device):
+                    outputs = self.model(features[start:start + batch_size].to(self.device))
+                    total_loss += self.criterion(outputs, batch_labels).item() * len(batch_labels)
+                predictions.append(torch.max(outputs, 1)[1].cpu())
+        if not predictions:
+            return torch.empty(0, dtype=torch.long), 0.0
+        return torch.cat(predictions), total_loss / len(features)
+
+    def fit(self, num_epochs=100, batch_size=256, shuffle=True, val_split=0.1, patience=10,
+            min_delta=1e-4, lr_factor=0.5, lr_patience=3, target_accuracy=None, seed=0, on_epoch=None,
+            checkpoint=None):
+        """Mini-batch training with a validation split, LR scheduling and early stopping.
+
+        The learning rate is reduced when the validation loss plateaus, training stops after
+        `patience` epochs without improvement (or once target_accuracy is reached on the
+        validation set) and the best weights are restored. Returns one dict per epoch, each of
+        which is also passed to on_epoch when given.
+
+        With a TrainingCheckpoint the whole loop state is saved periodically and a run with
+        the same config continues from the last saved epoch.
+        """
+        train_indices, val_indices = self.split_validation(val_split, seed) if val_split else \
+            (np.arange(len(self.labels)), np.array([], dtype=np.int64))
+        if not len(val_indices):
+            info("No validation samples, early stopping monitors the training loss")
+        info(f"Training on {len(train_indices)} samples, validating on {len(val_indices)}, batch size {batch_size}")
+        if self._forward is None:
+            self._forward = self.profile.prepare_model(self.model)
+        scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, mode='min', factor=lr_factor,
+                                                         patience=lr_patience)
+        generator = torch.Generator().manual_seed(seed)
+        history = []
+        best_loss, best_state, epochs_without_improvement = float('inf'), None, 0
+
+        state = checkpoint.load('fit') if checkpoint else None
+        if state:
+            train_indices, val_indices = state['train_indices'], state['val_indices']
+            self.model.load_state_dict(state['model'])
+            self.optimizer.load_state_dict(state['optimizer'])
+            scheduler.load_state_dict(state['scheduler'])
+            generator.set_state(state['generator'])
+            restore_rng_state(state['rng'])
+            history = state['history']
+            best_loss, best_state = state['best_loss'], state['best_state']
+            epochs_without_improvement = state['epochs_without_improvement']
+            info(f"Resuming training at epoch {len(history) + 1}/{num_epochs}")
+        train_indices = torch.from_numpy(train_indices)
+        val_indices = torch.from_numpy(val_indices)
+
+        start = time.perf_counter() - (history[-1]['seconds'] if history else 0.0)
+        for epoch in range(len(history), num_epochs):
+            self.model.train()
+            order = train_indices[torch.randperm(len(train_indices), generator=generator)] if shuffle else train_indices
+            total_loss, correct = 0.0, 0
+            for batch_start in range(0, len(order), batch_size):
+                batch = order[batch_start:batch_start + batch_size]
+                features = self.features[batch].to(self.device, non_blocking=True)
+                labels = self.labels[batch].to(self.device, non_blocking=True)
+                self.optimizer.zero_grad()
+                with self.profile.autocast(self.device):
+                    outputs = self._forward(features)
+                    loss = self.criterion(outputs, labels)
+                loss.backward()
+                self.optimizer.step()
+                total_loss += loss.item() * len(batch)
+                correct += (torch.max(outputs, 1)[1] == labels).sum().item()
+
+            train_loss, train_accuracy = total_loss / len(order), correct / len(order)
+            if len(val_indices):
+                val_loss, val_accuracy = self.evaluate(val_indices)
+            else:
+                val_loss, val_accuracy = train_loss, train_accuracy
+            scheduler.step(val_loss)
+            history.append({
+                'epoch': epoch + 1,
+                'loss': train_loss,
+                'accuracy': train_accuracy,
+                'val_loss': val_loss,
+                'val_accuracy': val_accuracy,
+                'lr': self.optimizer.param_groups[0]['lr'],
+                'seconds': time.perf_counter() - start,
+            })
+            info(f"Epoch {epoch + 1}/{num_epochs}, Loss: {train_loss:.4f}, Accuracy: {train_accuracy:.4f}, "
+                 f"Val Loss: {val_loss:.4f}, Val Accuracy: {val_accuracy:.4f}, "
+                 f"LR: {history[-1]['lr']:.6f}")
+            if on_epoch:
+                on_epoch(history[-1])
+
+            if val_loss < best_loss - min_delta:
+                best_loss, epochs_without_improvement = val_loss, 0
+                best_state = {key: value.detach().cpu().clone() for key, value in self.model.state_dict().items()}
+            else:
+                epochs_without_improvement += 1
+            if target_accuracy is not None and val_accuracy >= target_accuracy:
+                info(f"Target accuracy {target_accuracy} reached after {epoch + 1} epochs")
+                best_state = None  # Keep the weights that reached it
+                break
+            if epochs_without_improvement >= patience:
+                info(f"Early stopping after {epoch + 1} epochs, best validation loss {best_loss:.4f}")
+                break
+            if checkpoint and checkpoint.due(epoch + 1):
+                checkpoint.save('fit', {
+                    'train_indices': train_indices.numpy(),
+                    'val_indices': val_indices.numpy(),
+                    'model': self.model.state_dict(),
+                    'optimizer': self.optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                    'generator': generator.get_state(),
+                    'rng': rng_state(),
+                    'history': history,
+                    'best_loss': best_loss,
+                    'best_state': best_state,
+                    'epochs_without_improvement': epochs_without_improvement,
+                })
+
+        if best_state is not None:
+            self.model.load_state_dict(best_state)
+        return history
+
+    def get_predictions(self):
+        predicted, _ = self._predict()
+        return predicted.numpy()
 
     def train(self, num_epochs=10):
         for epoch in range(num_epochs):
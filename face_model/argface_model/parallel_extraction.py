@@ -0,0 +1,110 @@
+import io
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+from PIL import Image
+from logger import info, logger
+
+# Per-process state of an extraction worker, set up once by _init_worker
+_worker = {}
+
+
+def limit_session_threads(face_analysis, threads):
+    """Recreate the ONNX Runtime sessions of a FaceAnalysis with a fixed intra-op thread count.
+
+    InsightFace builds its sessions with default options, which size the thread pool to every
+    core; N workers would then run N x cores threads.
+    """
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    for model in face_analysis.models.values():
+        model.session = ort.InferenceSession(model.model_file, sess_options=options,
+                                             providers=model.session.get_providers())
+
+
+def _init_worker(model_dir, transform, source, threads, embedding_mode):
+    from .argface_model import ArcFaceModel
+    # Per-image logs of thousands of images from every worker drown the progress report
+    logger.setLevel(logging.WARNING)
+    torch.set_num_threads(threads)
+    model = ArcFaceModel(feature_dim=512, num_classes=1, model_dir=model_dir, embedding_mode=embedding_mode)
+    limit_session_threads(model.face_analysis, threads)
+    _worker.update(model=model, transform=transform, source=source)
+
+
+def load_image(ref, source=None):
+    """Open a gallery image by file path, by row index into pre-decoded DatasetShards, or through the
+    open_image of an S3Dataset (object key) or GalleryArchive (entry index)."""
+    if source is None:
+        with Image.open(ref) as image:
+            return image.convert("RGB")
+    if hasattr(source, 'open_image'):
+        return source.open_image(ref)
+    return Image.fromarray(np.array(source.image(ref)))
+
+
+def decode_bytes(image_bytes):
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return image.convert("RGB")
+
+
+def _embed_chunk(chunk):
+    model, transform, source = _worker['model'], _worker['transform'], _worker['source']
+    if hasattr(source, 'prefetch'):
+        # Download the whole chunk concurrently while the first images are embedded
+        source.prefetch([ref for _, ref in chunk])
+    # Archive members of a chunk are neighbours on disk and are read together
+    loaded = dict(source.iter_images([ref for _, ref in chunk])) if hasattr(source, 'iter_images') else {}
+    results = []
+    for position, ref in chunk:
+        try:
+            image = decode_bytes(loaded.pop(ref)) if ref in loaded else load_image(ref, source)
+            with torch.no_grad():
+                feature = model.embed_image(image, transform).squeeze().cpu().numpy()
+        except Exception:
+            # Undecodable image or no face: recorded as a failure like the serial path does
+            feature = None
+        results.append((position, feature))
+    return results
+
+
+def extract_parallel(refs, model_dir, transform, workers, threads=None, source=None, chunk_size=16,
+                     progress_seconds=10, embedding_mode=None):
+    """Embed images in a process pool, one InsightFace session per worker.
+
+    refs are file paths, or shard row indices / S3 keys of source; the result list has one feature (or None when
+    the image could not be embedded) per ref, in the order of refs whatever the completion order.
+    """
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    chunks = [list(enumerate(refs))[start:start + chunk_size] for start in range(0, len(refs), chunk_size)]
+    features = [None] * len(refs)
+    info(f"Extracting {len(refs)} images with {workers} worker processes x {threads} threads")
+
+    start = last_report = time.perf_counter()
+    done = 0
+    # spawn: ONNX Runtime and torch thread pools are not fork-safe once started in the parent. Each
+    # worker re-imports the __main__ script, so entry points such as main.py keep their startup work
+    # behind the __main__ guard (see main.initialize_service)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(model_dir, transform, source, threads, embedding_mode)) as executor:
+        futures = [executor.submit(_embed_chunk, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            results = future.result()
+            for position, feature in results:
+                features[position] = feature
+            done += len(results)
+            now = time.perf_counter()
+            if now - last_report >= progress_seconds:
+                last_report = now
+                info(f"Extracted {done}/{len(refs)} images, {done / (now - start):.1f} images/s")
+
+    elapsed = time.perf_counter() - start
+    info(f"Extracted {len(refs)} images in {elapsed:.1f}s ({len(refs) / max(elapsed, 1e-9):.1f} images/s), "
+         f"{sum(feature is None for feature in features)} without a face")
+    return features
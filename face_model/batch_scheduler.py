@@ -0,0 +1,160 @@
+import time
+import queue
+from bisect import bisect_left
+from concurrent.futures import Future, InvalidStateError
+from threading import Lock, Thread
+from inference_executor import ExecutorBusyError
+from logger import info, error
+
+# Upper bounds (ms) of the queueing delay histogram buckets, the last bucket is unbounded
+QUEUE_DELAY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class MicroBatchScheduler:
+    """Gather requests arriving within a short window and process them as one batch.
+
+    process_batch receives a list of items and must return one result per item in
+    the same order. Each submit() returns a Future resolved with that item's result.
+    When max_queue items are already waiting, submit() raises ExecutorBusyError.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait_ms=5.0, name='batch',
+                 max_queue=None, retry_after=1):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.queue = queue.Queue()
+        self._thread = None
+        self._start_lock = Lock()
+        self._metrics_lock = Lock()
+        self._batch_sizes = {}
+        self._queue_delay_counts = [0] * (len(QUEUE_DELAY_BUCKETS_MS) + 1)
+        self._queue_delay_total_ms = 0.0
+        self._queue_delay_max_ms = 0.0
+        self._items = 0
+        self._rejected = 0
+
+    def _ensure_started(self):
+        # Started on first use so the worker thread is created in the serving process
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=f"{self.name}-scheduler", daemon=True)
+                self._thread.start()
+                info(f"{self.name} scheduler started (max_batch_size={self.max_batch_size}, "
+                     f"max_wait_ms={self.max_wait_ms})")
+
+    def submit(self, item):
+        """Queue an item for the next batch and return a Future for its result."""
+        self._ensure_started()
+        if self.max_queue is not None and self.queue.qsize() >= self.max_queue:
+            with self._metrics_lock:
+                self._rejected += 1
+            raise ExecutorBusyError(self.name, self.retry_after)
+        future = Future()
+        self.queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _record(self, batch, started):
+        with self._metrics_lock:
+            size = len(batch)
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+            self._items += size
+            for _, _, enqueued in batch:
+                delay_ms = (started - enqueued) * 1000
+                self._queue_delay_counts[bisect_left(QUEUE_DELAY_BUCKETS_MS, delay_ms)] += 1
+                self._queue_delay_total_ms += delay_ms
+                self._queue_delay_max_ms = max(self._queue_delay_max_ms, delay_ms)
+
+    def _run(self):
+        while True:
+            # Requests whose client went away were cancelled while queued; they are not processed
+            batch = [entry for entry in self._collect_batch() if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._process(batch)
+            except Exception as e:
+                # The scheduler thread must survive anything, or every later submit() would hang
+                error(f"{self.name} scheduler failed on a batch of {len(batch)}: {e}")
+                for _, future, _ in batch:
+                    self._resolve(future, exception=e)
+
+    def _process(self, batch):
+        started = time.perf_counter()
+        self._record(batch, started)
+        items = [item for item, _, _ in batch]
+        try:
+            results = list(self.process_batch(items))
+        except Exception as e:
+            error(f"{self.name} batch of {len(items)} failed, retrying items one by one: {e}")
+            self._run_individually(batch)
+            return
+        if len(results) != len(items):
+            error(f"{self.name} batch of {len(items)} returned {len(results)} results")
+        for (_, future, _), result in zip(batch, results):
+            self._resolve(future, result=result)
+        for _, future, _ in batch[len(results):]:
+            self._resolve(future, exception=RuntimeError(
+                f"{self.name} batch returned {len(results)} results for {len(items)} items"))
+
+    def _run_individually(self, batch):
+        # Keeps one bad item from failing every request that shared its batch
+        for item, future, _ in batch:
+            try:
+                self._resolve(future, result=self.process_batch([item])[0])
+            except Exception as e:
+                self._resolve(future, exception=e)
+
+    def _resolve(self, future, result=None, exception=None):
+        if future.done():
+            return
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            # Resolved concurrently; nobody is waiting for this result any more
+            pass
+
+    def metrics(self):
+        """Return the configured knobs, batch-size histogram and queueing delay."""
+        with self._metrics_lock:
+            batches = sum(self._batch_sizes.values())
+            bucket_labels = [f"le_{bound}ms" for bound in QUEUE_DELAY_BUCKETS_MS] + [f"gt_{QUEUE_DELAY_BUCKETS_MS[-1]}ms"]
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait_ms,
+                'max_queue': self.max_queue,
+                'queued': self.queue.qsize(),
+                'rejected': self._rejected,
+                'batches': batches,
+                'items': self._items,
+                'mean_batch_size': round(self._items / batches, 2) if batches else 0.0,
+                'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+                'queue_delay_ms': {
+                    'mean': round(self._queue_delay_total_ms / self._items, 3) if self._items else 0.0,
+                    'max': round(self._queue_delay_max_ms, 3),
+                    'histogram': dict(zip(bucket_labels, self._queue_delay_counts)),
+                },
+            }
@@ -0,0 +1,88 @@
+"""ArcFace embedding cost: buffalo_l detect path versus recognition-only path.
+
+Both paths embed the same YOLO detections of a frame. The detect path feeds the
+padded crop through FaceAnalysis.get (detector, landmarks, attributes and
+recognition), the recognition path feeds the aligned crop to the recognition
+network only. Cosine similarity between the two embeddings is reported so the
+agreement of the paths can be checked alongside the latency.
+
+Usage (from face_model/):
+    python benchmarks/arcface_embedding_benchmark.py --image path/to/frame.png
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image
+from model_registry import ModelRegistry, build_dir
+from process_image import ImageProcessor
+from argface_model.argface_model import align_face_crop
+from logger import info
+
+
+def time_embeddings(model, faces, mode, repeats):
+    """Return (median ms per call, embeddings, valid indices) for one embedding mode."""
+    model.embedding_mode = mode
+    batch = torch.stack([
+        torch.from_numpy(np.array(Image.fromarray(face).resize((112, 112)))).permute(2, 0, 1).float() / 127.5 - 1
+        for face in faces
+    ])
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with torch.no_grad():
+            if mode == 'recognition':
+                # Serving feeds the uint8 crops straight in, see ArcFaceClassifier.identify_person_arrays
+                embeddings, valid_indices = model.get_aligned_embeddings(faces), list(range(len(faces)))
+            else:
+                embeddings, valid_indices = model.get_embeddings(batch)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings)), embeddings.cpu().numpy(), valid_indices
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', required=True, help='Frame containing one or more faces')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--yolo-path', default=os.path.join(build_dir, 'yolo_model/train/weights/best.pt'))
+    args = parser.parse_args()
+
+    image_processor = ImageProcessor(ModelRegistry(args.yolo_path))
+    image_np = np.array(Image.open(args.image).convert('RGB'))
+    detections = image_processor._detect_faces(image_np)
+    if not detections:
+        info("No faces detected by YOLO, nothing to benchmark")
+        return
+
+    model = image_processor.model_registry.arcface().model
+    original_mode = model.embedding_mode
+    padded_faces = image_processor._crop_faces(image_np, detections)
+    aligned_faces = [align_face_crop(image_np, detection['bbox']) for detection in detections]
+
+    # Warm up both paths once
+    time_embeddings(model, padded_faces, 'detect', 1)
+    time_embeddings(model, aligned_faces, 'recognition', 1)
+
+    detect_ms, detect_embeddings, detect_valid = time_embeddings(model, padded_faces, 'detect', args.repeats)
+    recognition_ms, recognition_embeddings, _ = time_embeddings(model, aligned_faces, 'recognition', args.repeats)
+    model.embedding_mode = original_mode
+
+    face_count = len(detections)
+    info(f"faces: {face_count}, detect path rejected {face_count - len(detect_valid)} crops")
+    info(f"detect path:      {detect_ms:8.1f} ms/frame, {detect_ms / face_count:7.1f} ms/face")
+    info(f"recognition path: {recognition_ms:8.1f} ms/frame, {recognition_ms / face_count:7.1f} ms/face")
+    info(f"speedup: {detect_ms / recognition_ms:.2f}x")
+
+    for row, index in enumerate(detect_valid):
+        a, b = detect_embeddings[row], recognition_embeddings[index]
+        cosine = float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+        info(f"face {index}: cosine(detect, recognition) = {cosine:.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Wall-clock time to a target validation accuracy: full-batch ArcFaceTrainer.train_epoch
+versus the mini-batch ArcFaceTrainer.fit, on synthetic ArcFace features.
+
+Every identity is a random unit vector in the 512-d embedding space; its samples are that
+centre plus Gaussian noise, renormalised like InsightFace embeddings. The default noise
+keeps a cosine of about 0.7 between a sample and its centre, close to what buffalo_l gives
+for two photos of one customer. Both loops train the same fc1/fc2 head from the same
+initial weights on the same per-class validation split, each with its own learning rate
+(one full-batch step per epoch needs a much larger one).
+
+--max-seconds bounds the whole run, data generation included: the full-batch loop gets
+half of the budget left after generation, the mini-batch loop the rest. A loop stops at
+the first epoch ending past its share, so a run overshoots by at most one epoch. The
+full-batch loop holds logits and their gradients for the whole training set at once and
+is skipped when they would exceed --full-batch-max-gb.
+
+Usage (from face_model/):
+    python benchmarks/arcface_trainer_benchmark.py [--identities 1000] [--target-accuracy 0.95]
+
+Measured on one CPU core with 6 GB of memory (torch 2.14.1), defaults (1000 identities):
+    full-batch:   49 epochs,   12.3s, val accuracy 0.9550 (reached)
+    mini-batch:    8 epochs,    2.4s, val accuracy 0.9640 (reached)
+--identities 10000 --max-seconds 500:
+    full-batch: skipped, needs about 8.9 GB
+    mini-batch:    8 epochs,  185.1s, val accuracy 0.9998 (reached)
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from argface_model.argface_model import ArcFaceModel
+from argface_model.argface_train import ArcFaceTrainer
+from logger import info, error, logger
+
+
+class TimeBudgetExceeded(Exception):
+    pass
+
+
+def synthetic_features(identities, per_identity, dim, noise, seed):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((identities, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    labels = np.repeat(np.arange(identities), per_identity)
+    features = centres[labels] + rng.standard_normal((len(labels), dim)).astype(np.float32) * noise / np.sqrt(dim)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    return features, labels
+
+
+def new_model(identities, dim, initial_state):
+    model = ArcFaceModel(feature_dim=dim, num_classes=identities, model_dir=tempfile.gettempdir())
+    model.load_state_dict(initial_state)
+    return model
+
+
+def full_batch(model, features, labels, train_indices, val_indices, args, deadline):
+    """The current loop: one gradient step over the whole training set per epoch."""
+    trainer = ArcFaceTrainer(model, features[train_indices], labels[train_indices], args.full_batch_lr, args.momentum)
+    validator = ArcFaceTrainer(model, features[val_indices], labels[val_indices])
+    start = time.perf_counter()
+    for epoch in range(args.max_epochs):
+        trainer.train_epoch()
+        _, val_accuracy = validator.evaluate()
+        if val_accuracy >= args.target_accuracy or time.perf_counter() > deadline:
+            break
+    return epoch + 1, time.perf_counter() - start, val_accuracy
+
+
+def mini_batch(model, features, labels, args, deadline):
+    trainer = ArcFaceTrainer(model, features, labels, args.lr, args.momentum)
+    history = []
+
+    def on_epoch(epoch):
+        history.append(epoch)
+        if time.perf_counter() > deadline:
+            raise TimeBudgetExceeded()
+
+    try:
+        trainer.fit(num_epochs=args.max_epochs, batch_size=args.batch_size, val_split=args.val_split,
+                    patience=args.patience, target_accuracy=args.target_accuracy, seed=args.seed, on_epoch=on_epoch)
+    except TimeBudgetExceeded:
+        pass
+    return len(history), history[-1]['seconds'], history[-1]['val_accuracy']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--identities', type=int, default=1000)
+    parser.add_argument('--per-identity', type=int, default=10)
+    parser.add_argument('--noise', type=float, default=1.0, help='noise norm relative to the unit centres')
+    parser.add_argument('--target-accuracy', type=float, default=0.95)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--val-split', type=float, default=0.2)
+    parser.add_argument('--patience', type=int, default=10)
+    parser.add_argument('--lr', type=float, default=0.5, help='mini-batch learning rate')
+    parser.add_argument('--full-batch-lr', type=float, default=2.0)
+    parser.add_argument('--momentum', type=float, default=0.9)
+    parser.add_argument('--max-epochs', type=int, default=500)
+    parser.add_argument('--max-seconds', type=float, default=900, help='time budget of the whole run')
+    parser.add_argument('--full-batch-max-gb', type=float, default=2.0,
+                        help='skip the full-batch loop when its activations would need more memory')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    deadline = time.perf_counter() + args.max_seconds
+    # ArcFaceModel.forward logs at debug level on every call
+    logger.setLevel(logging.INFO)
+    torch.manual_seed(args.seed)
+    dim = 512
+    features, labels = synthetic_features(args.identities, args.per_identity, dim, args.noise, args.seed)
+    info(f"{len(features)} synthetic features, {args.identities} identities")
+
+    initial_state = ArcFaceModel(feature_dim=dim, num_classes=args.identities,
+                                 model_dir=tempfile.gettempdir()).state_dict()
+    model = new_model(args.identities, dim, initial_state)
+    # Same split as fit() uses, so both loops are scored on the same held-out samples
+    train_indices, val_indices = ArcFaceTrainer(model, features, labels).split_validation(args.val_split, args.seed)
+    if time.perf_counter() > deadline:
+        error(f"Data generation used the whole {args.max_seconds}s budget")
+        return
+
+    # Logits, their softmax and its gradient, float32, for every training sample
+    full_batch_gb = 3 * len(train_indices) * args.identities * 4 / 1024 ** 3
+    now = time.perf_counter()
+    results = {'full-batch': None}
+    if full_batch_gb <= args.full_batch_max_gb:
+        results['full-batch'] = full_batch(model, features, labels, train_indices, val_indices, args,
+                                           now + (deadline - now) / 2)
+    results['mini-batch'] = mini_batch(new_model(args.identities, dim, initial_state), features, labels, args, deadline)
+    info(f"target validation accuracy {args.target_accuracy}")
+    for name, result in results.items():
+        if result is None:
+            info(f"{name:10s}: skipped, needs about {full_batch_gb:.1f} GB (--full-batch-max-gb {args.full_batch_max_gb})")
+            continue
+        epochs, seconds, val_accuracy = result
+        reached = 'reached' if val_accuracy >= args.target_accuracy else 'NOT reached'
+        info(f"{name:10s}: {epochs:4d} epochs, {seconds:8.1f}s, val accuracy {val_accuracy:.4f} ({reached})")
+
+
+if __name__ == '__main__':
+    main()
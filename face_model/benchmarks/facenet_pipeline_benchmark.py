@@ -0,0 +1,117 @@
+"""FaceNet training input throughput: the old per-batch thread pool versus the DataLoader pipeline.
+
+The old path decoded and augmented every image with a ThreadPoolExecutor created per batch.
+The pipeline decodes in worker processes, keeps decoded uint8 images in a bounded cache and
+augments on the fly. Images per second are reported per epoch; no model step is run, so the
+numbers are the ceiling the input side can feed the GPU/CPU with.
+
+Usage (from face_model/):
+    python benchmarks/facenet_pipeline_benchmark.py --epochs 3 --workers 0 2 4
+    python benchmarks/facenet_pipeline_benchmark.py --synthetic 2000   # random JPEGs
+
+Measured on one CPU core (torch 2.14.1), --synthetic 2000 (400x400 JPEGs), batch size 64:
+    thread pool per batch :  108.8 images/s
+    DataLoader 0 workers  :  epoch 1 160.0, epoch 2 704.9, epoch 3 718.3 images/s
+    DataLoader 1 workers  :  epoch 1 141.6, epoch 2 578.6, epoch 3 555.7 images/s
+    DataLoader 2 workers  :  epoch 1 131.5, epoch 2 216.8, epoch 3 325.4 images/s
+    --cache-mb 0, 0 workers: epoch 1 153.9, epoch 2 146.6 images/s (thread pool 113.5)
+Each worker caches the images it happened to decode, so with shuffling and more workers
+than cores later epochs hit the cache less often.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from facenet_model.facenet_dataset import FaceImageDataset, create_data_loader
+from logger import info
+
+
+def gallery_images(dataset_dir):
+    paths = []
+    for person in sorted(os.listdir(dataset_dir)):
+        person_dir = os.path.join(dataset_dir, person)
+        if os.path.isdir(person_dir):
+            paths.extend(os.path.join(person_dir, name) for name in sorted(os.listdir(person_dir))
+                         if name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')))
+    return paths
+
+
+def synthetic_images(directory, count, size=400):
+    rng = np.random.default_rng(0)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f"{index}.jpg")
+        Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def thread_pool_epoch(paths, batch_size):
+    """The former FaceNetModel._load_batch loop, without its augmented tensor cache."""
+    transform = transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(15),
+        transforms.ColorJitter(brightness=0.2, contrast=0.2),
+        transforms.Resize((160, 160)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
+    ])
+
+    def preprocess(path):
+        return transform(Image.open(path).convert("RGB"))
+
+    for i in range(0, len(paths), batch_size):
+        with ThreadPoolExecutor() as executor:
+            torch.stack(list(executor.map(preprocess, paths[i:i + batch_size])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', help='gallery directory, arcface_train_dataset by default')
+    parser.add_argument('--synthetic', type=int, default=0, help='benchmark on this many random JPEGs instead')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', nargs='+', type=int, default=[0, 2, 4])
+    parser.add_argument('--cache-mb', type=int, default=512)
+    args = parser.parse_args()
+    if args.dataset is None and not args.synthetic:
+        # model_registry pulls in ultralytics, only needed for the default gallery path
+        from model_registry import arcface_dataset
+        args.dataset = arcface_dataset
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        paths = synthetic_images(synthetic_dir, args.synthetic) if args.synthetic else gallery_images(args.dataset)
+        if not paths:
+            info(f"No images found in {args.dataset}, use --synthetic")
+            return
+        info(f"{len(paths)} images, batch size {args.batch_size}")
+
+        start = time.perf_counter()
+        thread_pool_epoch(paths, args.batch_size)
+        info(f"thread pool per batch : {len(paths) / (time.perf_counter() - start):8.1f} images/s")
+
+        for workers in args.workers:
+            dataset = FaceImageDataset(paths, [0] * len(paths), augment=True, cache_bytes=args.cache_mb * 1024 * 1024)
+            loader = create_data_loader(dataset, args.batch_size, shuffle=True, num_workers=workers)
+            rates = []
+            for _ in range(args.epochs):
+                start = time.perf_counter()
+                for _batch in loader:
+                    pass
+                rates.append(len(paths) / (time.perf_counter() - start))
+            info(f"DataLoader {workers} workers: " + ", ".join(f"epoch {epoch + 1} {rate:8.1f}"
+                                                               for epoch, rate in enumerate(rates)) + " images/s")
+            del loader
+
+
+if __name__ == '__main__':
+    main()
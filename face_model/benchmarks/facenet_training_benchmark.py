@@ -0,0 +1,65 @@
+"""FaceNet training: full fine-tuning versus a frozen backbone with cached embeddings.
+
+Both modes train on the same split of the gallery for the same number of epochs. The frozen
+mode is run twice: the first run computes and caches the backbone embeddings, the second
+shows the warm-cache cost of a retraining. Checkpoints are written to a temporary directory,
+the served FaceNet weights are not touched.
+
+Usage (from face_model/):
+    python benchmarks/facenet_training_benchmark.py --epochs 20 [--skip-full]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from facenet_model.facenet_model import FaceNetModel
+from model_registry import arcface_dataset
+from logger import info
+
+
+def run(mode, args, save_path):
+    # Same split for every run, _split_dataset shuffles with the global numpy generator
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    model = FaceNetModel(image_path=args.dataset, batch_size=args.batch_size, lr=args.lr, num_epochs=args.epochs,
+                         save_path=save_path, model_file_path=os.path.join(save_path, 'facenet_model.pth'),
+                         train_mode=mode)
+    history = []
+    start = time.perf_counter()
+    model.train(on_epoch=history.append)
+    seconds = time.perf_counter() - start
+    best = max((epoch['val_accuracy'] for epoch in history), default=0.0)
+    return seconds, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default=arcface_dataset)
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-full', action='store_true', help='only run the frozen-backbone mode')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as save_path:
+        results['frozen (cold cache)'] = run('frozen', args, save_path)
+        results['frozen (warm cache)'] = run('frozen', args, save_path)
+    if not args.skip_full:
+        with tempfile.TemporaryDirectory() as save_path:
+            results['full fine-tuning'] = run('full', args, save_path)
+
+    info(f"{args.epochs} epochs on {args.dataset}")
+    for name, (seconds, best) in results.items():
+        info(f"{name:20s}: {seconds:9.1f}s, best validation accuracy {best:.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""CPU latency of eager PyTorch versus the exported ONNX Runtime and TorchScript artifacts.
+
+Run export_models.py first. Backends whose artifacts are missing are skipped.
+
+Usage (from face_model/):
+    python benchmarks/inference_backend_benchmark.py --batch-sizes 1 8 32 --threads 4
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from facenet_model.facenet_model import FaceNetModel
+from inference_backend import (ArcFaceHead, TorchBackend, OnnxBackend, TorchScriptBackend, artifact_paths,
+                               min_cosine_similarity)
+from model_registry import arcface_dataset, model_save_path, facenet_model_dir, facenet_model_file_path
+from logger import info
+
+
+def median_ms(backend, batch, repeats):
+    backend(batch)  # Warm up
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        backend(batch)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def available_backends(module, model_file_path, threads):
+    paths = artifact_paths(model_file_path)
+    backends = [TorchBackend(module)]
+    if os.path.isfile(paths['onnx']):
+        backends.append(OnnxBackend(paths['onnx'], num_threads=threads))
+    if os.path.isfile(paths['torchscript']):
+        backends.append(TorchScriptBackend(paths['torchscript']))
+    return backends
+
+
+def benchmark(name, module, model_file_path, input_shape, batch_sizes, repeats, threads):
+    backends = available_backends(module, model_file_path, threads)
+    rng = np.random.default_rng(0)
+    info(f"{name}: batch | " + " | ".join(f"{backend.name} ms" for backend in backends) + " | min cosine vs torch")
+    for batch_size in batch_sizes:
+        batch = rng.uniform(-1, 1, (batch_size,) + input_shape).astype(np.float32)
+        timings = [median_ms(backend, batch, repeats) for backend in backends]
+        reference = backends[0](batch)
+        cosines = [min_cosine_similarity(reference, backend(batch)) for backend in backends[1:]]
+        info(f"{name}: {batch_size:5d} | " + " | ".join(f"{ms:8.2f}" for ms in timings) +
+             " | " + ", ".join(f"{cosine:.6f}" for cosine in cosines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=0, help='torch and ONNX Runtime intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    facenet = FaceNetModel(image_path=arcface_dataset, model_file_path=facenet_model_file_path,
+                           save_path=facenet_model_dir)
+    benchmark('facenet', facenet.model.cpu().eval(), facenet_model_file_path, (3, 160, 160),
+              args.batch_sizes, args.repeats, args.threads)
+
+    if os.path.isfile(model_save_path):
+        head = ArcFaceHead.from_state_dict(torch.load(model_save_path, map_location='cpu'))
+        benchmark('arcface head', head, model_save_path, (head.fc1.in_features,),
+                  args.batch_sizes, args.repeats, args.threads)
+
+
+if __name__ == '__main__':
+    main()
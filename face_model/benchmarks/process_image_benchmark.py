@@ -0,0 +1,70 @@
+"""Per-frame recognition latency versus number of faces.
+
+Compares the batched ImageProcessor._recognize_faces path against running the
+same faces one at a time, which is how process_image used to work.
+
+Usage (from face_model/):
+    python benchmarks/process_image_benchmark.py --image path/to/face.png --max-faces 8
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from model_registry import ModelRegistry, build_dir
+from process_image import ImageProcessor
+from logger import info
+
+
+def time_call(fn, repeats):
+    """Return the median wall-clock time of fn() in milliseconds."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def synthetic_detections(image_np, face_count):
+    """Place the same face box face_count times so every detection holds a real face."""
+    height, width = image_np.shape[:2]
+    return [{'bbox': (0, 0, width, height), 'confidence': 1.0} for _ in range(face_count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', required=True, help='Image containing a single face')
+    parser.add_argument('--max-faces', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--yolo-path', default=os.path.join(build_dir, 'yolo_model/train/weights/best.pt'))
+    args = parser.parse_args()
+
+    image_processor = ImageProcessor(ModelRegistry(args.yolo_path))
+    image_np = np.array(Image.open(args.image).convert('RGB'))
+
+    # Warm up model loading and the first forward passes
+    image_processor._recognize_faces(image_np, synthetic_detections(image_np, 1))
+
+    rows = []
+    for face_count in range(1, args.max_faces + 1):
+        batched_ms = time_call(
+            lambda: image_processor._recognize_faces(image_np, synthetic_detections(image_np, face_count)),
+            args.repeats)
+        sequential_ms = time_call(
+            lambda: [image_processor._recognize_faces(image_np, synthetic_detections(image_np, 1))
+                     for _ in range(face_count)],
+            args.repeats)
+        rows.append((face_count, sequential_ms, batched_ms))
+
+    info("faces | sequential ms | batched ms | speedup")
+    for face_count, sequential_ms, batched_ms in rows:
+        info(f"{face_count:5d} | {sequential_ms:13.1f} | {batched_ms:10.1f} | {sequential_ms / batched_ms:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Speedup of each TrainingProfile option on the FaceNet and ArcFace training loops.
+
+Runs FaceNetModel._run_epoch (full fine-tuning) on synthetic 160x160 batches and
+ArcFaceTrainer.fit on synthetic 512-d features, once per profile:
+
+    node threads     torch.set_num_threads(os.cpu_count()), what an unconfigured pod gets
+    cgroup threads   available_cpus(): affinity capped by the container CPU quota
+    + bf16 / + channels_last / + compile / + all   on top of cgroup threads
+
+Speedups are relative to "node threads". The first batch/epoch of every profile is a warm-up
+(torch.compile compiles there) and is not timed.
+
+Usage (from face_model/):
+    python benchmarks/training_profile_benchmark.py --facenet-batches 10 --arcface-epochs 5
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from argface_model.argface_model import ArcFaceModel
+from argface_model.argface_train import ArcFaceTrainer
+from facenet_model.facenet_model import FaceNetModel
+from training_profile import TrainingProfile, available_cpus
+from logger import info, logger
+
+
+def profiles():
+    return [
+        ('node threads', TrainingProfile(threads=os.cpu_count())),
+        ('cgroup threads', TrainingProfile()),
+        ('+ bf16', TrainingProfile(bf16=True)),
+        ('+ channels_last', TrainingProfile(channels_last=True)),
+        ('+ compile', TrainingProfile(torch_compile=True)),
+        ('+ all', TrainingProfile(bf16=True, channels_last=True, torch_compile=True)),
+    ]
+
+
+def facenet_rate(profile, batches, work_dir):
+    model = FaceNetModel(batch_size=len(batches[0][0]), save_path=work_dir,
+                         model_file_path=os.path.join(work_dir, 'facenet_model.pth'), training_profile=profile)
+    model._forward_model = profile.prepare_model(model.model)
+    model._run_epoch(batches[:1])  # Warm up
+    start = time.perf_counter()
+    model._run_epoch(batches[1:])
+    return sum(len(images) for images, _ in batches[1:]) / (time.perf_counter() - start)
+
+
+def arcface_rate(profile, features, labels, num_classes, epochs):
+    model = ArcFaceModel(feature_dim=features.size(1), num_classes=num_classes, model_dir=tempfile.gettempdir())
+    trainer = ArcFaceTrainer(model, features, labels, lr=0.05, profile=profile)
+    trainer.fit(num_epochs=1, val_split=0)  # Warm up
+    start = time.perf_counter()
+    trainer.fit(num_epochs=epochs, val_split=0, patience=epochs + 1)
+    return len(features) * epochs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--facenet-batches', type=int, default=10)
+    parser.add_argument('--facenet-batch-size', type=int, default=32)
+    parser.add_argument('--arcface-samples', type=int, default=50000)
+    parser.add_argument('--arcface-classes', type=int, default=10000)
+    parser.add_argument('--arcface-epochs', type=int, default=5)
+    args = parser.parse_args()
+
+    # Per-batch forward logs would dominate the timings
+    logger.setLevel(logging.WARNING)
+    torch.manual_seed(0)
+    batches = [(torch.rand(args.facenet_batch_size, 3, 160, 160) * 2 - 1,
+                torch.randint(0, 512, (args.facenet_batch_size,))) for _ in range(args.facenet_batches + 1)]
+    features = torch.nn.functional.normalize(torch.randn(args.arcface_samples, 512), dim=1)
+    labels = torch.randint(0, args.arcface_classes, (args.arcface_samples,))
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, profile in profiles():
+            profile.apply_threads()
+            results.append((name, profile.threads, facenet_rate(profile, batches, work_dir),
+                            arcface_rate(profile, features, labels, args.arcface_classes, args.arcface_epochs)))
+
+    logger.setLevel(logging.INFO)
+    info(f"node CPUs {os.cpu_count()}, available CPUs {available_cpus()}")
+    _, _, facenet_baseline, arcface_baseline = results[0]
+    info("profile         | threads | facenet images/s | speedup | arcface samples/s | speedup")
+    for name, threads, facenet, arcface in results:
+        info(f"{name:15s} | {threads:7d} | {facenet:16.1f} | {facenet / facenet_baseline:6.2f}x | "
+             f"{arcface:17.1f} | {arcface / arcface_baseline:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
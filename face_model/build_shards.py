@@ -0,0 +1,38 @@
+"""Compile arcface_train_dataset into pre-decoded, memory-mapped uint8 shards.
+
+Writes one shard set per training resolution (160x160 for FaceNet, 112x112 for the ArcFace
+feature extractor) under build/dataset_shards. Runs are incremental: only customer folders
+and images that are new or changed since the last build are decoded. The trainers run the
+same update before reading, so this script is only needed to build ahead of time.
+
+Usage (from face_model/):
+    python build_shards.py [--workers 8] [--rebuild]
+"""
+import os
+import shutil
+import argparse
+from dataset_shards import SHARD_SIZES, DatasetShards
+from model_registry import arcface_dataset, build_dir
+from logger import info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default=arcface_dataset)
+    parser.add_argument('--shard-dir', default=os.path.join(build_dir, 'dataset_shards'))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(SHARD_SIZES))
+    parser.add_argument('--images-per-shard', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=None, help='decode threads')
+    parser.add_argument('--rebuild', action='store_true', help='drop the shards (and their stale rows) first')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        if args.rebuild:
+            shutil.rmtree(os.path.join(args.shard_dir, str(size)), ignore_errors=True)
+        shards = DatasetShards(args.dataset, args.shard_dir, size, args.images_per_shard).update(args.workers)
+        info(f"{size}x{size}: {len(shards)} images, {len(shards.indices_by_person())} customers, "
+             f"{sum(shards.shard_rows)} rows in {len(shards.shard_rows)} shards")
+
+
+if __name__ == '__main__':
+    main()
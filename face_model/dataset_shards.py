@@ -0,0 +1,181 @@
+import io
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from embedding_store import content_hash
+from logger import info, error
+
+valid_extensions = ('.jpg', '.jpeg', '.png', '.bmp')
+# FaceNet trains on 160x160 crops, the ArcFace feature extractor on 112x112
+SHARD_SIZES = (160, 112)
+# Row marker for files that could not be decoded
+NO_IMAGE = -1
+
+
+def decode_resized(image_bytes, size):
+    """Decode image bytes into a size x size RGB uint8 array, resized like the training transforms."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return np.asarray(image.convert("RGB").resize((size, size), Image.BILINEAR), dtype=np.uint8)
+
+
+class DatasetShards:
+    """Gallery images pre-decoded at one resolution into memory-mapped uint8 shard files.
+
+    index.json lists every image in dataset order with its customer, content hash and
+    (shard, row); shard files are append-only, so update() only decodes files that are new
+    or changed since the last build. Rows of deleted or replaced files stay in the shards
+    until a rebuild. Enrollment and the training process update the same shards, so
+    update() holds an flock and starts from the index on disk.
+    """
+
+    def __init__(self, dataset_dir, shard_dir, size, images_per_shard=4096):
+        self.dataset_dir = dataset_dir
+        self.size = size
+        self.shard_dir = os.path.join(shard_dir, str(size))
+        self.index_path = os.path.join(self.shard_dir, 'index.json')
+        self.lock_path = os.path.join(self.shard_dir, 'shards.lock')
+        self.images_per_shard = images_per_shard
+        self.row_bytes = size * size * 3
+        self.lock = Lock()
+        self.entries = []
+        self.shard_rows = []
+        self._shards = {}
+        self._load()
+
+    def __getstate__(self):
+        # Memory maps and the lock are recreated in the receiving process (e.g. a spawned DataLoader worker)
+        state = dict(self.__dict__, _shards={})
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path) as index_file:
+                meta = json.load(index_file)
+            if meta['size'] != self.size:
+                raise ValueError(f"index is for size {meta['size']}")
+            self.entries, self.shard_rows = meta['images'], meta['shards']
+        except (OSError, ValueError, KeyError) as e:
+            error(f"Shard index {self.index_path} is unreadable, rebuilding: {e}")
+            self.entries, self.shard_rows = [], []
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.shard_dir, f"shard-{shard:05d}.u8")
+
+    def _scan(self):
+        """Return (relative path, customer, stat) of every gallery image in a stable order."""
+        files = []
+        for person in sorted(os.listdir(self.dataset_dir)):
+            person_dir = os.path.join(self.dataset_dir, person)
+            if not os.path.isdir(person_dir):
+                continue
+            for image_name in sorted(os.listdir(person_dir)):
+                if image_name.lower().endswith(valid_extensions):
+                    files.append((f"{person}/{image_name}", person, os.stat(os.path.join(person_dir, image_name))))
+        return files
+
+    def _decode(self, relative_path):
+        try:
+            with open(os.path.join(self.dataset_dir, relative_path), 'rb') as image_file:
+                image_bytes = image_file.read()
+        except OSError as e:
+            error(f"Error reading image {relative_path}: {e}")
+            return None, None
+        try:
+            return content_hash(image_bytes), decode_resized(image_bytes, self.size)
+        except Exception as e:
+            error(f"Error decoding image {relative_path}: {e}")
+            return content_hash(image_bytes), None
+
+    def update(self, workers=None):
+        """Bring the shards in line with the dataset directory, decoding only new or changed files."""
+        with self.lock, self._file_lock():
+            # Another process may have appended rows since this one loaded the index
+            self._load()
+            self._shards = {}
+            known = {entry['path']: entry for entry in self.entries}
+            entries, pending = [], []
+            for relative_path, person, stat in self._scan():
+                entry = known.get(relative_path)
+                if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['bytes'] != stat.st_size:
+                    entry = {'path': relative_path, 'person': person, 'mtime_ns': stat.st_mtime_ns,
+                             'bytes': stat.st_size}
+                    pending.append(entry)
+                entries.append(entry)
+            if not pending and len(entries) == len(self.entries):
+                info(f"Shards {self.shard_dir} are up to date ({len(entries)} images)")
+                return self
+
+            # PIL releases the GIL while decoding, so threads scale over the cores
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for entry, (digest, image) in zip(pending, executor.map(self._decode, [e['path'] for e in pending])):
+                    entry['digest'] = digest
+                    entry['shard'], entry['row'] = self._append(image) if image is not None else (NO_IMAGE, NO_IMAGE)
+
+            self.entries = entries
+            with open(f"{self.index_path}.tmp", 'w') as index_file:
+                json.dump({'size': self.size, 'shards': self.shard_rows, 'images': self.entries}, index_file)
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+            self._shards = {}
+            info(f"Shards {self.shard_dir} updated: {len(pending)} images decoded, {len(entries)} indexed")
+        return self
+
+    def _append(self, image):
+        if not self.shard_rows or self.shard_rows[-1] >= self.images_per_shard:
+            self.shard_rows.append(0)
+        shard, row = len(self.shard_rows) - 1, self.shard_rows[-1]
+        path = self._shard_path(shard)
+        # Rows past the indexed count are left over from an interrupted build and are overwritten
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as shard_file:
+            shard_file.seek(row * self.row_bytes)
+            shard_file.truncate()
+            shard_file.write(np.ascontiguousarray(image).tobytes())
+        self.shard_rows[-1] += 1
+        return shard, row
+
+    def _shard(self, shard):
+        array = self._shards.get(shard)
+        if array is None:
+            array = np.memmap(self._shard_path(shard), dtype=np.uint8, mode='r',
+                              shape=(self.shard_rows[shard], self.size, self.size, 3))
+            self._shards[shard] = array
+        return array
+
+    def __len__(self):
+        return len(self.entries)
+
+    def image(self, index):
+        """Return the decoded image of an entry as a read-only uint8 array, None if undecodable."""
+        entry = self.entries[index]
+        if entry['shard'] == NO_IMAGE:
+            return None
+        return self._shard(entry['shard'])[entry['row']]
+
+    def indices_by_person(self):
+        """Return {customer: [entry index, ...]} for every decodable image."""
+        persons = {}
+        for index, entry in enumerate(self.entries):
+            if entry['shard'] != NO_IMAGE:
+                persons.setdefault(entry['person'], []).append(index)
+        return persons
@@ -0,0 +1,164 @@
+import os
+import json
+from threading import Lock
+import numpy as np
+from PIL import Image
+from logger import info, error
+
+valid_extensions = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class EmbeddingIndex:
+    """Per-customer FaceNet reference embeddings persisted as memory-mapped .npy files."""
+
+    def __init__(self, index_dir, dataset_dir, model_file_path, facenet_provider):
+        self.index_dir = index_dir
+        self.dataset_dir = dataset_dir
+        self.model_file_path = model_file_path
+        # Callable returning the shared FaceNetModel, only invoked when embeddings must be built
+        self.facenet_provider = facenet_provider
+        self.lock = Lock()
+        self.model_signature = self._model_signature()
+        self._embeddings = {}
+        self._images = {}
+        # Modification time of the metadata each customer was loaded from, see _is_current
+        self._versions = {}
+
+    def _model_signature(self):
+        """Identify the FaceNet weights so stale embeddings are rebuilt after training."""
+        if self.model_file_path and os.path.isfile(self.model_file_path):
+            stat = os.stat(self.model_file_path)
+            return f"{int(stat.st_mtime)}-{stat.st_size}"
+        return "pretrained"
+
+    def _paths(self, customer):
+        base = os.path.join(self.index_dir, customer)
+        return f"{base}.npy", f"{base}.json"
+
+    def _meta_version(self, customer):
+        try:
+            return os.stat(self._paths(customer)[1]).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _is_current(self, customer):
+        """Whether the in-memory index of a customer matches the one on disk.
+
+        Prefork workers each hold their own copy; an image enrolled through another worker
+        replaces the files on disk, which this process then re-reads. Weights trained by
+        another worker make every copy stale, see _refresh_signature.
+        """
+        return (customer in self._embeddings and self.model_signature == self._model_signature()
+                and self._versions.get(customer) == self._meta_version(customer))
+
+    def _refresh_signature(self):
+        """Forget the embeddings built with other weights once the FaceNet checkpoint changed; call under lock."""
+        signature = self._model_signature()
+        if signature != self.model_signature:
+            self.model_signature = signature
+            self._embeddings.clear()
+            self._images.clear()
+            self._versions.clear()
+            info("FaceNet weights changed, embedding index reloaded with the new signature")
+
+    def load(self):
+        """Memory-map every persisted customer index built with the current weights."""
+        if not os.path.isdir(self.index_dir):
+            info(f"No embedding index found at {self.index_dir}")
+            return
+        loaded = 0
+        with self.lock:
+            for file_name in os.listdir(self.index_dir):
+                if not file_name.endswith('.json'):
+                    continue
+                customer = file_name[:-len('.json')]
+                if self._load_customer(customer):
+                    loaded += 1
+        info(f"Embedding index loaded for {loaded} customers from {self.index_dir}")
+
+    def _load_customer(self, customer):
+        embeddings_path, meta_path = self._paths(customer)
+        version = self._meta_version(customer)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta.get('model_signature') != self.model_signature:
+                info(f"Embedding index for {customer} is stale, it will be rebuilt on demand")
+                return False
+            self._embeddings[customer] = np.load(embeddings_path, mmap_mode='r')
+            self._images[customer] = meta['images']
+            self._versions[customer] = version
+            return True
+        except (OSError, ValueError, KeyError) as e:
+            error(f"Failed to load embedding index for {customer}: {e}")
+            return False
+
+    def _save_customer(self, customer, images, embeddings):
+        """Atomically persist a customer index and re-map it read-only."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        embeddings_path, meta_path = self._paths(customer)
+        with open(f"{embeddings_path}.tmp", 'wb') as embeddings_file:
+            np.save(embeddings_file, np.asarray(embeddings, dtype=np.float32))
+        with open(f"{meta_path}.tmp", 'w') as meta_file:
+            json.dump({'model_signature': self.model_signature, 'images': images}, meta_file)
+        os.replace(f"{embeddings_path}.tmp", embeddings_path)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        self._embeddings[customer] = np.load(embeddings_path, mmap_mode='r')
+        self._images[customer] = images
+        self._versions[customer] = self._meta_version(customer)
+
+    def _embed_files(self, customer, image_names):
+        customer_dir = os.path.join(self.dataset_dir, customer)
+        faces = [np.array(Image.open(os.path.join(customer_dir, name)).convert('RGB')) for name in image_names]
+        return self.facenet_provider().get_embeddings_from_arrays(faces)
+
+    def _build_customer(self, customer):
+        """Embed every gallery image of a customer, reusing embeddings already indexed."""
+        customer_dir = os.path.join(self.dataset_dir, customer)
+        if not os.path.isdir(customer_dir):
+            return None
+        images = sorted(f for f in os.listdir(customer_dir) if f.lower().endswith(valid_extensions))
+        if not images:
+            return None
+
+        known = dict(zip(self._images.get(customer, []), self._embeddings.get(customer, [])))
+        missing = [name for name in images if name not in known]
+        if missing:
+            info(f"Embedding {len(missing)} gallery images for {customer}")
+            known.update(zip(missing, self._embed_files(customer, missing)))
+        self._save_customer(customer, images, np.stack([known[name] for name in images]))
+        return self._embeddings[customer]
+
+    def get(self, customer):
+        """Return the reference embeddings of a customer, building the index on first use."""
+        embeddings = self._embeddings.get(customer)
+        if embeddings is not None and self._is_current(customer):
+            return embeddings
+        with self.lock:
+            self._refresh_signature()
+            if not self._is_current(customer) and not self._load_customer(customer):
+                return self._build_customer(customer)
+            return self._embeddings[customer]
+
+    def add_image(self, customer, image_name, face_array):
+        """Index a newly enrolled gallery image without re-embedding the others."""
+        with self.lock:
+            self._refresh_signature()
+            if not self._is_current(customer) and not self._load_customer(customer):
+                self._build_customer(customer)
+                return
+            if image_name in self._images[customer]:
+                return
+            embedding = self.facenet_provider().get_embeddings_from_arrays([face_array])
+            embeddings = np.concatenate([self._embeddings[customer], embedding])
+            self._save_customer(customer, self._images[customer] + [image_name], embeddings)
+            info(f"Added {image_name} to embedding index of {customer}")
+
+    def invalidate(self):
+        """Forget in-memory embeddings so they are rebuilt with the current weights."""
+        with self.lock:
+            self.model_signature = self._model_signature()
+            self._embeddings.clear()
+            self._images.clear()
+            self._versions.clear()
+        info("Embedding index invalidated")
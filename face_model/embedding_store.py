@@ -0,0 +1,125 @@
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from threading import Lock
+import numpy as np
+from logger import info, error
+
+# Row marker for images the model could not embed (e.g. no face detected)
+NO_EMBEDDING = -1
+
+
+def content_hash(data):
+    """Return the content address of raw image bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class EmbeddingStore:
+    """Persistent embeddings keyed by image content hash, one store per model version.
+
+    Vectors live in an append-only float32 file that is memory-mapped for reads, the
+    index maps each content hash to its row. Serving workers, enrollment and the training
+    process share a store, so writers hold an flock on the store and start from the index
+    on disk rather than their own copy.
+    """
+
+    def __init__(self, store_dir, model_version, dim=512):
+        self.store_dir = os.path.join(store_dir, model_version)
+        self.model_version = model_version
+        self.dim = dim
+        self.vectors_path = os.path.join(self.store_dir, 'embeddings.f32')
+        self.index_path = os.path.join(self.store_dir, 'index.json')
+        self.lock_path = os.path.join(self.store_dir, 'store.lock')
+        self.lock = Lock()
+        self.index = {}
+        self.rows = 0
+        self._vectors = None
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            info(f"Creating embedding store {self.store_dir}")
+            return
+        self.index, self.rows = self._read_index()
+        self._vectors = self._map_vectors(self.rows)
+        info(f"Embedding store {self.store_dir} loaded with {len(self.index)} entries")
+
+    def _read_index(self):
+        """Return (index, rows) as published on disk."""
+        try:
+            with open(self.index_path) as index_file:
+                meta = json.load(index_file)
+            return meta['index'], meta['rows']
+        except FileNotFoundError:
+            return {}, 0
+        except (OSError, ValueError, KeyError) as e:
+            error(f"Embedding store index {self.index_path} is unreadable, starting empty: {e}")
+            return {}, 0
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _map_vectors(self, rows):
+        return np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim)) if rows else None
+
+    def get(self, digest):
+        """Return (found, vector) for a content hash; vector is None for cached failures."""
+        row = self.index.get(digest)
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        if row == NO_EMBEDDING:
+            return True, None
+        return True, np.array(self._vectors[row])
+
+    def put_many(self, entries):
+        """Append (digest, vector or None) entries and persist the index atomically."""
+        entries = [(digest, vector) for digest, vector in entries if digest not in self.index]
+        if not entries:
+            return
+        with self.lock, self._file_lock():
+            # Other processes may have appended since this one loaded; start from the index they
+            # published so their rows are kept and new rows go after them
+            index, rows = self._read_index()
+            # Rows are only published by the index written afterwards, so anything past the
+            # indexed rows is left over from an interrupted run and is overwritten
+            mode = 'r+b' if os.path.exists(self.vectors_path) else 'wb'
+            with open(self.vectors_path, mode) as vectors_file:
+                vectors_file.seek(rows * self.dim * 4)
+                vectors_file.truncate()
+                for digest, vector in entries:
+                    if digest in index:
+                        continue
+                    if vector is None:
+                        index[digest] = NO_EMBEDDING
+                        continue
+                    vectors_file.write(np.asarray(vector, dtype=np.float32).reshape(self.dim).tobytes())
+                    index[digest] = rows
+                    rows += 1
+            with open(f"{self.index_path}.tmp", 'w') as index_file:
+                json.dump({'model_version': self.model_version, 'rows': rows, 'index': index}, index_file)
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+            # The vectors are mapped before the index is swapped, so get() never sees a row past the map
+            self._vectors = self._map_vectors(rows)
+            self.index, self.rows = index, rows
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.index),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
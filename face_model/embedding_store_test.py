@@ -0,0 +1,68 @@
+"""EmbeddingStore persistence and concurrent writers sharing one store directory.
+
+Usage (from face_model/):
+    python -m unittest embedding_store_test
+"""
+import os
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+from embedding_store import NO_EMBEDDING, EmbeddingStore
+
+
+def _write_vectors(store_dir, worker, count):
+    # Every writer loads the store before the others append, like serving workers do
+    store = EmbeddingStore(store_dir, 'test', dim=4)
+    for i in range(count):
+        store.put_many([(f"{worker}-{i}", np.full(4, worker * 1000 + i, dtype=np.float32))])
+
+
+class TestEmbeddingStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+    def test_round_trip_and_failures(self):
+        store = EmbeddingStore(self.store_dir, 'test', dim=4)
+        store.put_many([('a', np.arange(4)), ('b', None)])
+        reopened = EmbeddingStore(self.store_dir, 'test', dim=4)
+        self.assertEqual(reopened.get('a')[0], True)
+        np.testing.assert_array_equal(reopened.get('a')[1], np.arange(4, dtype=np.float32))
+        self.assertEqual(reopened.get('b'), (True, None))
+        self.assertEqual(reopened.get('c'), (False, None))
+        self.assertEqual(reopened.index['b'], NO_EMBEDDING)
+
+    def test_stale_writer_keeps_rows_of_others(self):
+        first = EmbeddingStore(self.store_dir, 'test', dim=4)
+        second = EmbeddingStore(self.store_dir, 'test', dim=4)
+        first.put_many([('a', np.full(4, 1.0))])
+        second.put_many([('b', np.full(4, 2.0))])
+        first.put_many([('c', np.full(4, 3.0))])
+
+        store = EmbeddingStore(self.store_dir, 'test', dim=4)
+        self.assertEqual(store.rows, 3)
+        for digest, value in (('a', 1.0), ('b', 2.0), ('c', 3.0)):
+            np.testing.assert_array_equal(store.get(digest)[1], np.full(4, value, dtype=np.float32))
+
+    def test_concurrent_processes(self):
+        processes = [multiprocessing.get_context('fork').Process(target=_write_vectors,
+                                                                  args=(self.store_dir, worker, 25))
+                     for worker in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        store = EmbeddingStore(self.store_dir, 'test', dim=4)
+        self.assertEqual(store.rows, 100)
+        self.assertEqual(os.path.getsize(store.vectors_path), 100 * 4 * 4)
+        for worker in range(4):
+            for i in range(25):
+                np.testing.assert_array_equal(store.get(f"{worker}-{i}")[1],
+                                              np.full(4, worker * 1000 + i, dtype=np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""Export FaceNet and the ArcFace head to ONNX and TorchScript next to their .pth files.
+
+Every exported artifact is checked against eager PyTorch; the export fails when the
+lowest embedding/logit cosine similarity drops below the parity threshold.
+
+Usage (from face_model/):
+    python export_models.py [--backends onnx torchscript] [--parity-threshold 0.999]
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from facenet_model.facenet_model import FaceNetModel
+from inference_backend import (ArcFaceHead, TorchBackend, OnnxBackend, TorchScriptBackend, artifact_paths,
+                               export_onnx, export_torchscript, min_cosine_similarity)
+from model_registry import arcface_dataset, model_save_path, facenet_model_dir, facenet_model_file_path
+from logger import info, error
+
+
+def sample_faces(facenet_model, limit=16):
+    """Return up to `limit` gallery images prepared like inference inputs, random data if none exist."""
+    transform = facenet_model.eval_transform()
+    image_paths, _ = facenet_model._load_images()
+    if not image_paths:
+        info("No gallery images found, checking parity on random inputs")
+        return torch.rand(limit, 3, 160, 160) * 2 - 1
+    return torch.stack([transform(Image.open(path).convert("RGB")) for path in image_paths[:limit]])
+
+
+def check_parity(name, reference, exported, inputs, threshold):
+    similarity = min_cosine_similarity(reference(inputs), exported(inputs))
+    passed = similarity > threshold
+    (info if passed else error)(f"{name}: min cosine similarity vs eager = {similarity:.6f} "
+                                f"({'ok' if passed else 'FAILED'}, threshold {threshold})")
+    return passed
+
+
+def export_model(name, module, example, parity_inputs, model_file_path, backends, threshold):
+    paths = artifact_paths(model_file_path)
+    reference = TorchBackend(module)
+    passed = True
+    if 'onnx' in backends:
+        export_onnx(module, example, paths['onnx'], paths['onnx_raw'])
+        passed &= check_parity(f"{name} onnx", reference, OnnxBackend(paths['onnx']), parity_inputs, threshold)
+    if 'torchscript' in backends:
+        export_torchscript(module, example, paths['torchscript'])
+        passed &= check_parity(f"{name} torchscript", reference, TorchScriptBackend(paths['torchscript']),
+                               parity_inputs, threshold)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['onnx', 'torchscript'], choices=['onnx', 'torchscript'])
+    parser.add_argument('--parity-threshold', type=float, default=0.999)
+    args = parser.parse_args()
+
+    passed = True
+    facenet = FaceNetModel(image_path=arcface_dataset, model_file_path=facenet_model_file_path,
+                           save_path=facenet_model_dir)
+    facenet_module = facenet.model.cpu().eval()
+    faces = sample_faces(facenet).numpy()
+    passed &= export_model('facenet', facenet_module, torch.from_numpy(faces[:1]), faces,
+                           facenet_model_file_path, args.backends, args.parity_threshold)
+
+    if os.path.isfile(model_save_path):
+        head = ArcFaceHead.from_state_dict(torch.load(model_save_path, map_location='cpu'))
+        features = np.random.default_rng(0).standard_normal((64, head.fc1.in_features)).astype(np.float32)
+        passed &= export_model('arcface head', head, torch.from_numpy(features[:1]), features,
+                               model_save_path, args.backends, args.parity_threshold)
+    else:
+        error(f"ArcFace model not found at {model_save_path}, skipping the head export")
+
+    if not passed:
+        error("Parity check failed, do not deploy the exported artifacts")
+        sys.exit(1)
+    info("All exported artifacts match eager PyTorch")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import torch
+from PIL import Image, UnidentifiedImageError
+from torch.utils.data import Dataset, DataLoader, get_worker_info
+from torchvision import transforms
+from dataset_shards import decode_resized
+from logger import info
+
+# FaceNet input resolution; gallery images are cached decoded at this size
+IMAGE_SIZE = 160
+
+
+class DecodedImageCache:
+    """LRU cache of decoded uint8 images bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._images
+
+    def get(self, key):
+        image = self._images.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self._images.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def put(self, key, image):
+        if image.nbytes > self.max_bytes or key in self._images:
+            return
+        self._images[key] = image
+        self.size_bytes += image.nbytes
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.size_bytes -= evicted.nbytes
+
+
+def augment_transform():
+    """Random augmentation applied on the fly to cached IMAGE_SIZE images, new on every epoch."""
+    return transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(15),  # Random rotation within 15 degrees
+        transforms.ColorJitter(brightness=0.2, contrast=0.2),  # Adjust brightness and contrast
+        transforms.ToTensor(),
+        transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
+    ])
+
+
+def normalize_transform():
+    return transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
+    ])
+
+
+def decode_image(image_path, size=IMAGE_SIZE):
+    """Decode an image file into a size x size RGB uint8 array."""
+    with Image.open(image_path) as image:
+        return np.asarray(image.convert("RGB").resize((size, size), Image.BILINEAR))
+
+
+class FaceImageDataset(Dataset):
+    """Gallery images with their class index, decoded once into a bounded cache.
+
+    Each DataLoader worker process holds its own cache, so cache_bytes is split between them.
+    Unreadable images yield None and are dropped by skip_invalid_collate.
+    """
+
+    def __init__(self, image_paths, targets, augment=False, cache_bytes=0):
+        self.image_paths = list(image_paths)
+        self.targets = list(targets)
+        self.transform = augment_transform() if augment else normalize_transform()
+        self.cache = DecodedImageCache(cache_bytes)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        image_path = self.image_paths[index]
+        image = self.cache.get(image_path)
+        if image is None:
+            try:
+                image = self._decode(image_path)
+            except (UnidentifiedImageError, OSError):
+                info(f"Skipped non-image file: {image_path}")
+                return None
+            self.cache.put(image_path, image)
+        return self.transform(Image.fromarray(image)), self.targets[index]
+
+    def _decode(self, image_path):
+        return decode_image(image_path)
+
+
+class S3ImageDataset(FaceImageDataset):
+    """Gallery images streamed from an S3Dataset through its local disk cache.
+
+    The DataLoader fetches a whole batch at once, so the batch is downloaded concurrently
+    before it is decoded; prefetch_factor keeps the next batches downloading meanwhile.
+    """
+
+    def __init__(self, s3_dataset, keys, targets, augment=False, cache_bytes=0):
+        super(S3ImageDataset, self).__init__(keys, targets, augment, cache_bytes)
+        self.s3_dataset = s3_dataset
+
+    def __getitems__(self, indices):
+        self.s3_dataset.prefetch([self.image_paths[index] for index in indices
+                                  if self.image_paths[index] not in self.cache])
+        return [self[index] for index in indices]
+
+    def _decode(self, key):
+        return np.asarray(self.s3_dataset.open_image(key).resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR))
+
+
+class ArchiveImageDataset(FaceImageDataset):
+    """Images read from a GalleryArchive by entry index.
+
+    The DataLoader fetches a whole batch at once, so its members are read in storage order
+    and neighbours share a single read.
+    """
+
+    def __init__(self, archive, indices, targets, augment=False, cache_bytes=0):
+        super(ArchiveImageDataset, self).__init__(indices, targets, augment, cache_bytes)
+        self.archive = archive
+        self._batch = {}
+
+    def __getitems__(self, indices):
+        self._batch = dict(self.archive.iter_images([self.image_paths[index] for index in indices
+                                                     if self.image_paths[index] not in self.cache]))
+        try:
+            return [self[index] for index in indices]
+        finally:
+            self._batch = {}
+
+    def _decode(self, index):
+        image_bytes = self._batch.get(index)
+        return decode_resized(image_bytes if image_bytes is not None else self.archive.read(index), IMAGE_SIZE)
+
+
+class ShardImageDataset(Dataset):
+    """Images read from pre-decoded DatasetShards; no decode and no cache are needed."""
+
+    def __init__(self, shards, shard_indices, targets, augment=False):
+        self.shards = shards
+        self.shard_indices = list(shard_indices)
+        self.targets = list(targets)
+        self.transform = augment_transform() if augment else normalize_transform()
+
+    def __len__(self):
+        return len(self.shard_indices)
+
+    def __getitem__(self, index):
+        image = self.shards.image(self.shard_indices[index])
+        if image is None:
+            return None
+        return self.transform(Image.fromarray(np.array(image))), self.targets[index]
+
+
+def skip_invalid_collate(samples):
+    samples = [sample for sample in samples if sample is not None]
+    if not samples:
+        return None
+    images, targets = zip(*samples)
+    return torch.stack(images), torch.tensor(targets, dtype=torch.long)
+
+
+def _split_cache_between_workers(_worker_id):
+    worker_info = get_worker_info()
+    cache = getattr(worker_info.dataset, 'cache', None)
+    if cache is not None:
+        cache.max_bytes //= worker_info.num_workers
+    # Parallelism comes from the workers; one intra-op thread each avoids oversubscription
+    torch.set_num_threads(1)
+
+
+def default_num_workers():
+    return int(os.getenv('FACENET_DATA_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+
+def create_data_loader(dataset, batch_size, shuffle, num_workers=None, prefetch_factor=2):
+    """DataLoader decoding and augmenting in worker processes while the model trains.
+
+    Workers persist across epochs so their decoded image caches are reused.
+    """
+    num_workers = default_num_workers() if num_workers is None else num_workers
+    options = {}
+    if num_workers > 0:
+        options = dict(prefetch_factor=prefetch_factor, persistent_workers=True,
+                       worker_init_fn=_split_cache_between_workers)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      collate_fn=skip_invalid_collate, pin_memory=torch.cuda.is_available(), **options)
@@ -6,16 +6,26 @@ from torchvision import transforms
 from facenet_pytorch import InceptionResnetV1
 import torch.nn as nn
 import torch.optim as optim
-from concurrent.futures import ThreadPoolExecutor
 from sklearn.metrics import accuracy_score
 from scipy.spatial.distance import cosine
-from threading import Lock  # For thread-safe access to the cache
 from tqdm import tqdm
+from .facenet_dataset import (IMAGE_SIZE, ArchiveImageDataset, FaceImageDataset, S3ImageDataset, ShardImageDataset,
+                              create_data_loader)
+from dataset_shards import DatasetShards
+from embedding_store import EmbeddingStore, content_hash
+from training_checkpoint import restore_rng_state, rng_state
+from training_profile import TrainingProfile
 from logger import info, error
 
+# 'full' fine-tunes InceptionResnetV1, 'frozen' trains a classifier head on cached backbone embeddings.
+# Serving only uses the backbone embeddings, so a frozen run leaves the served weights as they are and
+# its head just measures how well those embeddings separate the gallery.
+TRAIN_MODES = ('full', 'frozen')
+
 class FaceNetModel:
     def __init__(self, image_path='', batch_size=32, lr=0.001, num_epochs=20, num_classes=2, 
-                 save_path=None, model_file_path=None):
+                 save_path=None, model_file_path=None, num_workers=None, image_cache_mb=None, shard_dir=None,
+                 train_mode=None, training_profile=None, s3_dataset=None, archive=None):
         self.image_path = image_path if image_path else ''
         self.batch_size = batch_size
         self.lr = lr
@@ -24,9 +34,28 @@ class FaceNetModel:
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.save_path = save_path if save_path else './checkpoints'
         self.model_file_path = model_file_path
-        self.image_cache = {}
-        self.cache_lock = Lock()  # Lock for thread-safe access to image_cache
+        # Training data pipeline: worker processes (None picks FACENET_DATA_WORKERS) and the
+        # budget of decoded images they keep in memory between epochs
+        self.num_workers = num_workers
+        self.image_cache_bytes = int(image_cache_mb if image_cache_mb is not None
+                                     else os.getenv('FACENET_IMAGE_CACHE_MB', '512')) * 1024 * 1024
         self.label_map = {}  # Consistent label map across batches
+        # Pre-decoded dataset shards (see dataset_shards.py); None trains from the image files
+        self.shard_dir = shard_dir
+        self.shards = None
+        # Optional S3Dataset (see s3_dataset.py) streaming the gallery from S3 instead of image_path
+        self.s3_dataset = s3_dataset
+        # Optional GalleryArchive (see gallery_archive.py) reading the gallery from packed tar shards
+        self.archive = archive
+        self.inference_backend = None  # Optional ONNX/TorchScript backend for embeddings
+        self.train_mode = train_mode or os.getenv('FACENET_TRAIN_MODE', 'full')
+        if self.train_mode not in TRAIN_MODES:
+            raise ValueError(f"Unknown FaceNet training mode: {self.train_mode}, expected one of {TRAIN_MODES}")
+        # bf16 autocast, channels_last and torch.compile for full fine-tuning; see training_profile.py
+        self.training_profile = training_profile or TrainingProfile.from_env()
+        self._forward_model = None
+        # Modification time of the weights file loaded, None for the pretrained weights
+        self.checkpoint_mtime = None
         self._initialize_model()
 
     def _initialize_model(self):
@@ -54,23 +83,24 @@ class FaceNetModel:
             error(f"Invalid model file path: {model_path}")
             return
 
+        checkpoint_mtime = os.path.getmtime(model_path)
         checkpoint = torch.load(model_path)
         self.model.load_state_dict(checkpoint, strict=False)
+        self.checkpoint_mtime = checkpoint_mtime
         info(f"Model loaded from {model_path}")
         
     def _save_model(self, save_path):
         """Save the model state to a file."""
         if save_path:
             os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            torch.save(self.model.state_dict(), save_path)
+            # Written aside and renamed, so a stopped training never leaves a truncated checkpoint
+            torch.save(self.model.state_dict(), f"{save_path}.tmp")
+            os.replace(f"{save_path}.tmp", save_path)
             info(f"Model saved to {save_path}")
 
-    def transform(self):
-        """Return image transformation pipeline with augmentation."""
+    def eval_transform(self):
+        """Return the deterministic image transformation used for inference."""
         return transforms.Compose([
-            transforms.RandomHorizontalFlip(),
-            transforms.RandomRotation(15),  # Random rotation within 15 degrees
-            transforms.ColorJitter(brightness=0.2, contrast=0.2),  # Adjust brightness and contrast
             transforms.Resize((160, 160)),
             transforms.ToTensor(),
             transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
@@ -105,31 +135,71 @@ class FaceNetModel:
 
         return image_paths, labels
 
+    def _load_shard_images(self):
+        """Return (shard indices, labels) of the dataset, updating the 160x160 shards first."""
+        self.shards = DatasetShards(self.image_path, self.shard_dir, IMAGE_SIZE).update()
+        shard_indices, labels = [], []
+        for person, indices in self.shards.indices_by_person().items():
+            shard_indices.extend(indices)
+            labels.extend([person] * len(indices))
+        if labels:
+            self.label_map = {label: idx for idx, label in enumerate(sorted(set(labels)))}
+            info(f"Label map created: {self.label_map}")
+        return shard_indices, labels
+
+    def _load_s3_images(self):
+        """Return (S3 keys, labels) of the dataset listed from the bucket; images are fetched on demand."""
+        image_keys, labels = [], []
+        for person, keys in self.s3_dataset.images_by_person().items():
+            image_keys.extend(keys)
+            labels.extend([person] * len(keys))
+        if labels:
+            self.label_map = {label: idx for idx, label in enumerate(sorted(set(labels)))}
+            info(f"Label map created: {self.label_map}")
+        return image_keys, labels
+
+    def _load_archive_images(self):
+        """Return (archive entry indices, labels) of the packed gallery, in storage order per customer."""
+        image_indices, labels = [], []
+        for person, indices in self.archive.indices_by_person().items():
+            image_indices.extend(indices)
+            labels.extend([person] * len(indices))
+        if labels:
+            self.label_map = {label: idx for idx, label in enumerate(sorted(set(labels)))}
+            info(f"Label map created: {self.label_map}")
+        return image_indices, labels
+
+    def _load_training_images(self):
+        """Return (image references, labels) from S3, the gallery archive, the pre-decoded shards or the image files."""
+        if self.s3_dataset is not None:
+            return self._load_s3_images()
+        if self.archive is not None:
+            return self._load_archive_images()
+        return self._load_shard_images() if self.shard_dir else self._load_images()
+
     def _preprocess_image(self, image_path):
-        """Preprocess an image for input to the model."""
-        with self.cache_lock:
-            if image_path in self.image_cache:
-                return self.image_cache[image_path]
+        """Preprocess an image for inference, without augmentation."""
         try:
             image = Image.open(image_path).convert("RGB")
-            transformed_image = self.transform()(image)
-            with self.cache_lock:
-                self.image_cache[image_path] = transformed_image
-            return transformed_image
+            return self.eval_transform()(image)
         except UnidentifiedImageError:
             info(f"Skipped non-image file: {image_path}")
             return None
 
-    def _load_batch(self, batch_paths, batch_labels):
-        """Load a batch of images and their corresponding labels."""
-        batch_images, batch_targets = [], []
-        with ThreadPoolExecutor() as executor:
-            results = list(executor.map(self._preprocess_image, batch_paths))
-        for result, label in zip(results, batch_labels):
-            if result is not None:
-                batch_images.append(result)
-                batch_targets.append(self.label_map[label])  # Use consistent label mapping
-        return batch_images, batch_targets
+    def _data_loader(self, image_paths, labels, train):
+        """Return a DataLoader over the images, augmented and shuffled for training."""
+        targets = [self.label_map[label] for label in labels]  # Use consistent label mapping
+        if self.s3_dataset is not None:
+            dataset = S3ImageDataset(self.s3_dataset, image_paths, targets, augment=train,
+                                     cache_bytes=self.image_cache_bytes)
+        elif self.archive is not None:
+            dataset = ArchiveImageDataset(self.archive, image_paths, targets, augment=train,
+                                          cache_bytes=self.image_cache_bytes)
+        elif self.shards is not None:
+            dataset = ShardImageDataset(self.shards, image_paths, targets, augment=train)
+        else:
+            dataset = FaceImageDataset(image_paths, targets, augment=train, cache_bytes=self.image_cache_bytes)
+        return create_data_loader(dataset, self.batch_size, shuffle=train, num_workers=self.num_workers)
 
     def _split_dataset(self, image_paths, labels, split_ratio=0.8):
         """Split dataset into training and validation sets."""
@@ -137,28 +207,52 @@ class FaceNetModel:
         np.random.shuffle(data)
         split_index = int(len(data) * split_ratio)
         train_data, val_data = data[:split_index], data[split_index:]
-        train_paths, train_labels = zip(*train_data)
-        val_paths, val_labels = zip(*val_data)
+        # A split can be empty, e.g. the validation split of a gallery with a single image
+        train_paths, train_labels = zip(*train_data) if train_data else ((), ())
+        val_paths, val_labels = zip(*val_data) if val_data else ((), ())
         return train_paths, train_labels, val_paths, val_labels
 
-    def train(self):
-        """Train the FaceNet model."""
+    def train(self, on_epoch=None, checkpoint=None):
+        """Train the FaceNet model, passing each epoch's metrics to on_epoch when given.
+
+        With a TrainingCheckpoint, model, optimizer, epoch, RNG state and split are saved
+        periodically and a run with the same config continues from the last saved epoch.
+        """
+        if self.train_mode == 'frozen':
+            return self._train_frozen(on_epoch, checkpoint)
         info("Starting training process")
-        image_paths, labels = self._load_images()
+        # With shards the "paths" are row indices into the pre-decoded shards, with an archive entry
+        # indices and with S3 object keys
+        image_paths, labels = self._load_training_images()
         if not image_paths:
             error("No valid images found for training.")
             return
 
-        train_image_paths, train_labels, val_image_paths, val_labels = self._split_dataset(image_paths, labels)
-        
         best_val_acc = 0.0  # Initialize best validation accuracy
+        start_epoch = 0
+        state = checkpoint.load('fit') if checkpoint else None
+        if state and state['label_map'] == self.label_map:
+            train_image_paths, train_labels, val_image_paths, val_labels = self._restore_split(state['split'])
+            self.model.load_state_dict(state['model'])
+            self.optimizer.load_state_dict(state['optimizer'])
+            restore_rng_state(state['rng'])
+            best_val_acc, start_epoch = state['best_val_acc'], state['epoch']
+            info(f"Resuming training at epoch {start_epoch + 1}/{self.num_epochs}")
+        else:
+            train_image_paths, train_labels, val_image_paths, val_labels = self._split_dataset(image_paths, labels)
+        self._forward_model = self.training_profile.prepare_model(self.model)
+        train_loader = self._data_loader(train_image_paths, train_labels, train=True)
+        val_loader = self._data_loader(val_image_paths, val_labels, train=False)
 
-        for epoch in range(self.num_epochs):
+        for epoch in range(start_epoch, self.num_epochs):
             info(f"Epoch {epoch+1}/{self.num_epochs}")
-            train_loss, train_acc = self._run_epoch(train_image_paths, train_labels)
-            val_loss, val_acc = self._run_epoch(val_image_paths, val_labels, train=False)
+            train_loss, train_acc = self._run_epoch(train_loader)
+            val_loss, val_acc = self._run_epoch(val_loader, train=False)
             info(f"Train Loss: {train_loss:.4f}, Train Acc: {train_acc:.4f}, "
                  f"Val Loss: {val_loss:.4f}, Val Acc: {val_acc:.4f}")
+            if on_epoch:
+                on_epoch({'epoch': epoch + 1, 'loss': train_loss, 'accuracy': train_acc,
+                          'val_loss': val_loss, 'val_accuracy': val_acc})
         
             # Save best model based on validation accuracy
             if val_acc > best_val_acc:
@@ -166,35 +260,228 @@ class FaceNetModel:
                 self._save_model(self.model_file_path)
                 info(f"New best model saved with validation accuracy: {best_val_acc:.4f}")
 
+            if checkpoint and checkpoint.due(epoch + 1):
+                checkpoint.save('fit', {
+                    'split': self._split_keys(train_image_paths, train_labels, val_image_paths, val_labels),
+                    'model': self.model.state_dict(),
+                    'optimizer': self.optimizer.state_dict(),
+                    'rng': rng_state(),
+                    'epoch': epoch + 1,
+                    'best_val_acc': best_val_acc,
+                    'label_map': self.label_map,
+                })
+
         info("Training completed")
 
-    def _run_epoch(self, image_paths, labels, train=True):
+    def _indexed_dataset(self):
+        """The DatasetShards or GalleryArchive whose entry indices serve as image references, if any."""
+        return self.shards if self.shards is not None else self.archive
+
+    def _split_keys(self, train_refs, train_labels, val_refs, val_labels):
+        """Describe a split by relative image path, which stays valid when shard rows are renumbered."""
+        indexed = self._indexed_dataset()
+        if indexed is not None:
+            train_refs = [indexed.entries[ref]['path'] for ref in train_refs]
+            val_refs = [indexed.entries[ref]['path'] for ref in val_refs]
+        return list(train_refs), list(train_labels), list(val_refs), list(val_labels)
+
+    def _restore_split(self, split):
+        """Turn a saved split back into image references, dropping images that no longer exist."""
+        if self.s3_dataset is not None:
+            lookup = lambda key: key if key in self.s3_dataset.entries else None
+        elif self._indexed_dataset() is not None:
+            rows = {entry['path']: index for index, entry in enumerate(self._indexed_dataset().entries)}
+            lookup = rows.get
+        else:
+            lookup = lambda path: path if os.path.isfile(path) else None
+        restored = []
+        for refs, labels in ((split[0], split[1]), (split[2], split[3])):
+            kept = [(lookup(ref), label) for ref, label in zip(refs, labels) if lookup(ref) is not None]
+            restored.extend([[ref for ref, _ in kept], [label for _, label in kept]])
+        return restored
+
+    def _backbone_signature(self):
+        """Identify the backbone weights the cached embeddings were computed with."""
+        if self.model_file_path and os.path.isfile(self.model_file_path):
+            stat = os.stat(self.model_file_path)
+            return f"{int(stat.st_mtime)}-{stat.st_size}"
+        return "pretrained"
+
+    def _content_hash(self, image_ref):
+        if self.s3_dataset is not None:
+            return self.s3_dataset.digest(image_ref)
+        if self._indexed_dataset() is not None:
+            return self._indexed_dataset().entries[image_ref]['digest']
+        with open(image_ref, 'rb') as image_file:
+            return content_hash(image_file.read())
+
+    def _cached_embeddings(self, image_refs, labels):
+        """Return (embeddings, targets) of the images, running the backbone only on cache misses.
+
+        Embeddings are stored by image content hash for the current backbone weights, so they
+        are computed once and reused by every later frozen-backbone run.
+        """
+        store = EmbeddingStore(os.path.join(self.save_path, 'backbone_embeddings'),
+                               f"facenet-{self._backbone_signature()}")
+        embeddings = [None] * len(image_refs)
+        digests, missing = [], []
+        for position, image_ref in enumerate(image_refs):
+            try:
+                digest = self._content_hash(image_ref)
+            except OSError as e:
+                error(f"Error reading image {image_ref}: {e}")
+                digest = None
+            digests.append(digest)
+            if digest is None:
+                continue
+            found, embedding = store.get(digest)
+            if found:
+                embeddings[position] = embedding
+            else:
+                missing.append(position)
+
+        if missing:
+            info(f"Computing backbone embeddings for {len(missing)} of {len(image_refs)} images")
+            # The targets carry positions, so unreadable images dropped by the loader are just left out
+            refs = [image_refs[position] for position in missing]
+            if self.s3_dataset is not None:
+                dataset = S3ImageDataset(self.s3_dataset, refs, missing)
+            elif self.archive is not None:
+                # In storage order the sequential batches turn into large contiguous reads
+                order = sorted(range(len(refs)), key=lambda i: self.archive.position(refs[i]))
+                dataset = ArchiveImageDataset(self.archive, [refs[i] for i in order], [missing[i] for i in order])
+            elif self.shards is not None:
+                dataset = ShardImageDataset(self.shards, refs, missing)
+            else:
+                dataset = FaceImageDataset(refs, missing)
+            self.model.eval()
+            with torch.no_grad():
+                for batch in create_data_loader(dataset, self.batch_size, shuffle=False, num_workers=self.num_workers):
+                    if batch is None:
+                        continue
+                    images, positions = batch
+                    for position, embedding in zip(positions.tolist(),
+                                                   self.model(images.to(self.device)).cpu().numpy()):
+                        embeddings[position] = embedding
+            store.put_many([(digests[position], embeddings[position]) for position in missing])
+
+        valid = [position for position, embedding in enumerate(embeddings) if embedding is not None]
+        if not valid:
+            return torch.empty(0, self.model.last_linear.out_features), torch.empty(0, dtype=torch.long)
+        return (torch.from_numpy(np.stack([embeddings[position] for position in valid])).float(),
+                torch.tensor([self.label_map[labels[position]] for position in valid], dtype=torch.long))
+
+    def _classifier_head(self, num_classes):
+        embedding_dim = self.model.last_linear.out_features
+        return nn.Sequential(
+            nn.Linear(embedding_dim, 512),
+            nn.ReLU(),
+            nn.Dropout(p=0.5),  # Additional dropout for regularization
+            nn.Linear(512, num_classes)
+        ).to(self.device)
+
+    def _train_frozen(self, on_epoch=None, checkpoint=None):
+        """Train only a classifier head on cached backbone embeddings; the backbone is left untouched.
+
+        With a TrainingCheckpoint, head, optimizer, epoch, RNG state and split are saved
+        periodically and a run with the same config continues from the last saved epoch.
+        """
+        info("Starting frozen-backbone training process")
+        image_refs, labels = self._load_training_images()
+        if not image_refs:
+            error("No valid images found for training.")
+            return
+
+        head = self._classifier_head(len(self.label_map))
+        optimizer = optim.Adam(head.parameters(), lr=self.lr)
+        best_val_acc = 0.0
+        start_epoch = 0
+        state = checkpoint.load('frozen') if checkpoint else None
+        if state and state['label_map'] == self.label_map:
+            train_refs, train_labels, val_refs, val_labels = self._restore_split(state['split'])
+            head.load_state_dict(state['head'])
+            optimizer.load_state_dict(state['optimizer'])
+            restore_rng_state(state['rng'])
+            best_val_acc, start_epoch = state['best_val_acc'], state['epoch']
+            info(f"Resuming training at epoch {start_epoch + 1}/{self.num_epochs}")
+        else:
+            train_refs, train_labels, val_refs, val_labels = self._split_dataset(image_refs, labels)
+        train_embeddings, train_targets = self._cached_embeddings(train_refs, train_labels)
+        val_embeddings, val_targets = self._cached_embeddings(val_refs, val_labels)
+        if not len(train_targets):
+            error("No readable images found for training.")
+            return
+        if not len(val_targets):
+            info("No validation samples, reporting the training metrics instead")
+
+        for epoch in range(start_epoch, self.num_epochs):
+            head.train()
+            order = torch.randperm(len(train_targets))
+            epoch_loss, correct = 0.0, 0
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                embeddings, targets = train_embeddings[batch].to(self.device), train_targets[batch].to(self.device)
+                optimizer.zero_grad()
+                outputs = head(embeddings)
+                loss = self.criterion(outputs, targets)
+                loss.backward()
+                optimizer.step()
+                epoch_loss += loss.item() * len(batch)
+                correct += (torch.max(outputs, 1)[1] == targets).sum().item()
+            train_loss, train_acc = epoch_loss / len(order), correct / len(order)
+
+            if len(val_targets):
+                head.eval()
+                with torch.no_grad():
+                    outputs = head(val_embeddings.to(self.device))
+                    val_loss = self.criterion(outputs, val_targets.to(self.device)).item()
+                    val_acc = (torch.max(outputs, 1)[1].cpu() == val_targets).float().mean().item()
+            else:
+                val_loss, val_acc = train_loss, train_acc
+            info(f"Epoch {epoch+1}/{self.num_epochs}, Train Loss: {train_loss:.4f}, Train Acc: {train_acc:.4f}, "
+                 f"Val Loss: {val_loss:.4f}, Val Acc: {val_acc:.4f}")
+            if on_epoch:
+                on_epoch({'epoch': epoch + 1, 'loss': train_loss, 'accuracy': train_acc,
+                          'val_loss': val_loss, 'val_accuracy': val_acc})
+
+            best_val_acc = max(best_val_acc, val_acc)
+            if checkpoint and checkpoint.due(epoch + 1):
+                checkpoint.save('frozen', {
+                    'split': self._split_keys(train_refs, train_labels, val_refs, val_labels),
+                    'head': head.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'rng': rng_state(),
+                    'epoch': epoch + 1,
+                    'best_val_acc': best_val_acc,
+                    'label_map': self.label_map,
+                })
+
+        info(f"Training completed, best validation accuracy: {best_val_acc:.4f}")
+
+    def _run_epoch(self, data_loader, train=True):
         """Run a single epoch for training or validation."""
         self.model.train() if train else self.model.eval()
         epoch_loss, all_labels, all_preds = 0.0, [], []
         total_samples = 0
 
-        for i in range(0, len(image_paths), self.batch_size):
-            batch_paths = image_paths[i:i + self.batch_size]
-            batch_labels = labels[i:i + self.batch_size]
-            batch_images, batch_targets = self._load_batch(batch_paths, batch_labels)
-            
-            if not batch_images:
+        for batch in data_loader:
+            if batch is None:
                 continue
 
-            total_samples += len(batch_images)
-            images = torch.stack(batch_images).to(self.device)
-            targets = torch.tensor(batch_targets, dtype=torch.long).to(self.device)
+            images, targets = batch
+            total_samples += len(images)
+            images = images.to(self.device, non_blocking=True)
+            targets = targets.to(self.device, non_blocking=True)
 
             self.optimizer.zero_grad()
-            with torch.set_grad_enabled(train):
-                outputs = self.model(images)
+            with torch.set_grad_enabled(train), self.training_profile.autocast(self.device):
+                outputs = (self._forward_model or self.model)(self.training_profile.prepare_input(images))
                 loss = self.criterion(outputs, targets)
                 if train:
                     loss.backward()
                     self.optimizer.step()
 
-            epoch_loss += loss.item() * len(batch_images)
+            epoch_loss += loss.item() * len(images)
             _, preds = torch.max(outputs, 1)
             all_labels.extend(targets.cpu().numpy())
             all_preds.extend(preds.cpu().numpy())
@@ -203,30 +490,30 @@ class FaceNetModel:
         average_loss = epoch_loss / total_samples if total_samples > 0 else 0
         return average_loss, accuracy
 
-    def verify_images(self, threshold=0.5, batch_size=32):
-        """Verify images by comparing embeddings."""
+    def verify_images(self, threshold=0.5, batch_size=32, backend=None):
+        """Verify images by comparing embeddings.
+
+        When a backend is given (e.g. an ONNX or INT8 session) images are preprocessed
+        deterministically, so the pairs of different backends can be compared one to one.
+        """
+        embed = self._verification_embedder(backend)
         distances, labels = [], []
-        for label_folder in os.listdir(self.image_path):
+        for label_folder in sorted(os.listdir(self.image_path)):
             folder_path = os.path.join(self.image_path, label_folder)
             if not os.path.isdir(folder_path):
                 continue
 
-            images = [os.path.join(folder_path, img) for img in os.listdir(folder_path)
+            images = [os.path.join(folder_path, img) for img in sorted(os.listdir(folder_path))
                     if img.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp'))]
 
             if len(images) < 2:
                 continue
 
-            reference_image = self._preprocess_image(images[0]).unsqueeze(0).to(self.device)
-            reference_embedding = self.model(reference_image).detach().cpu().numpy().flatten()
+            reference_embedding = embed(images[:1])[0].flatten()
 
             for i in tqdm(range(1, len(images), batch_size), desc=f"Verifying {label_folder}"):
                 batch = images[i:i+batch_size]
-                batch_images = [self._preprocess_image(img).unsqueeze(0) for img in batch]
-                batch_tensor = torch.cat(batch_images).to(self.device)
-                
-                with torch.no_grad():
-                    batch_embeddings = self.model(batch_tensor).detach().cpu().numpy()
+                batch_embeddings = embed(batch)
 
                 for _, embedding in enumerate(batch_embeddings):
                     distance = cosine(reference_embedding, embedding.flatten())
@@ -236,6 +523,22 @@ class FaceNetModel:
         
         return distances, labels
 
+    def _verification_embedder(self, backend):
+        """Return a function embedding a list of image paths for verify_images."""
+        if backend is None:
+            def embed(paths):
+                batch_tensor = torch.cat([self._preprocess_image(path).unsqueeze(0) for path in paths]).to(self.device)
+                with torch.no_grad():
+                    return self.model(batch_tensor).detach().cpu().numpy()
+            return embed
+
+        transform = self.eval_transform()
+
+        def embed(paths):
+            batch = torch.stack([transform(Image.open(path).convert("RGB")) for path in paths])
+            return backend(batch.numpy())
+        return embed
+
     def get_embeddings(self, image_paths):
         """Get embeddings for a list of image paths."""
         self.model.eval()  # Set the model to evaluation mode
@@ -252,3 +555,18 @@ class FaceNetModel:
                     info(f"Skipped invalid image: {image_path}")
 
         return np.array(embeddings)
+
+    def get_embeddings_from_arrays(self, face_arrays):
+        """Get embeddings for a list of RGB uint8 face crops held in memory."""
+        if len(face_arrays) == 0:
+            return np.empty((0, 512), dtype=np.float32)
+
+        self.model.eval()
+        transform = self.eval_transform()
+        batch = torch.stack([transform(Image.fromarray(face).convert("RGB")) for face in face_arrays])
+        if self.inference_backend is not None:
+            embeddings = self.inference_backend(batch.numpy())
+        else:
+            with torch.no_grad():
+                embeddings = self.model(batch.to(self.device)).cpu().numpy()
+        return embeddings.reshape(len(face_arrays), -1)
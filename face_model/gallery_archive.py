@@ -0,0 +1,206 @@
+import io
+import os
+import json
+import tarfile
+from threading import Lock
+from PIL import Image
+from dataset_shards import valid_extensions
+from embedding_store import content_hash
+from logger import info, error
+
+MB = 1024 * 1024
+# Neighbouring members closer than this are fetched by one read, the gap is read and dropped
+MAX_READ_GAP = 1 * MB
+
+
+class GalleryArchive:
+    """The gallery packed into tar shards with a JSON index, read with large sequential I/O.
+
+    Every image is a plain customer/image member of a gallery-XXXXX.tar shard, so the shards
+    stay readable with tar. index.json records the customer, shard, byte offset, length and
+    content hash of every image; readers pread members directly and merge neighbouring
+    members into reads of up to read_bytes. update() packs only files that are new or
+    changed since the last run, into the last shard until it reaches shard_bytes; bytes of
+    deleted or replaced files stay in the shards until a rebuild.
+    """
+
+    def __init__(self, archive_dir, shard_bytes=256 * MB, read_bytes=8 * MB):
+        self.archive_dir = archive_dir
+        self.index_path = os.path.join(archive_dir, 'index.json')
+        self.shard_bytes = shard_bytes
+        self.read_bytes = read_bytes
+        self.lock = Lock()
+        self.entries = []
+        self.shard_count = 0
+        self._fds = {}
+        self._fds_pid = os.getpid()
+        self._load()
+
+    def __getstate__(self):
+        # File descriptors and the lock are recreated in the receiving process
+        state = dict(self.__dict__, _fds={}, _fds_pid=None)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path) as index_file:
+                meta = json.load(index_file)
+            self.entries, self.shard_count = meta['images'], meta['shards']
+        except (OSError, ValueError, KeyError) as e:
+            error(f"Gallery archive index {self.index_path} is unreadable, repacking: {e}")
+            self.entries, self.shard_count = [], 0
+
+    def _shard_path(self, shard):
+        return os.path.join(self.archive_dir, f"gallery-{shard:05d}.tar")
+
+    def update(self, dataset_dir):
+        """Pack the new or changed images of an arcface_train_dataset style directory."""
+        with self.lock:
+            known = {entry['path']: entry for entry in self.entries}
+            entries, pending = [], []
+            for person in sorted(os.listdir(dataset_dir)):
+                person_dir = os.path.join(dataset_dir, person)
+                if not os.path.isdir(person_dir):
+                    continue
+                for image_name in sorted(os.listdir(person_dir)):
+                    if not image_name.lower().endswith(valid_extensions):
+                        continue
+                    stat = os.stat(os.path.join(person_dir, image_name))
+                    relative_path = f"{person}/{image_name}"
+                    entry = known.get(relative_path)
+                    if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['length'] != stat.st_size:
+                        entry = {'path': relative_path, 'person': person, 'mtime_ns': stat.st_mtime_ns}
+                        pending.append(entry)
+                    entries.append(entry)
+            if not pending and len(entries) == len(self.entries):
+                info(f"Gallery archive {self.archive_dir} is up to date ({len(entries)} images)")
+                return self
+
+            os.makedirs(self.archive_dir, exist_ok=True)
+            self._pack(dataset_dir, pending)
+            # Files that could not be read are left out until the next update
+            self.entries = [entry for entry in entries if 'shard' in entry]
+            with open(f"{self.index_path}.tmp", 'w') as index_file:
+                json.dump({'shards': self.shard_count, 'images': self.entries}, index_file)
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+            self._close()
+            info(f"Gallery archive {self.archive_dir} updated: {len(pending)} images packed, "
+                 f"{len(self.entries)} indexed in {self.shard_count} shards")
+        return self
+
+    def _pack(self, dataset_dir, pending):
+        shard, archive = self.shard_count - 1, None
+        try:
+            for entry in pending:
+                try:
+                    with open(os.path.join(dataset_dir, entry['path']), 'rb') as image_file:
+                        image_bytes = image_file.read()
+                except OSError as e:
+                    error(f"Error reading image {entry['path']}: {e}")
+                    continue
+                if archive is None or archive.offset >= self.shard_bytes:
+                    if archive is None and shard >= 0 and os.path.getsize(self._shard_path(shard)) < self.shard_bytes:
+                        # Members are appended after the indexed ones, which keep their offsets
+                        mode = 'a'
+                    else:
+                        if archive is not None:
+                            archive.close()
+                        shard, mode = shard + 1, 'w'
+                    archive = tarfile.open(self._shard_path(shard), mode, format=tarfile.GNU_FORMAT)
+                member = tarfile.TarInfo(entry['path'])
+                member.size = len(image_bytes)
+                member.mtime = entry['mtime_ns'] // 1_000_000_000
+                archive.addfile(member, io.BytesIO(image_bytes))
+                # The data ends at the current offset, padded to the tar block size
+                padded = -(-len(image_bytes) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                entry.update(shard=shard, offset=archive.offset - padded, length=len(image_bytes),
+                             digest=content_hash(image_bytes))
+        finally:
+            if archive is not None:
+                archive.close()
+        self.shard_count = max(self.shard_count, shard + 1)
+
+    def _fd(self, shard):
+        if self._fds_pid != os.getpid():
+            # Descriptors inherited through fork() share their offset, each process opens its own
+            self._fds, self._fds_pid = {}, os.getpid()
+        fd = self._fds.get(shard)
+        if fd is None:
+            fd = os.open(self._shard_path(shard), os.O_RDONLY)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            self._fds[shard] = fd
+        return fd
+
+    def _close(self):
+        if self._fds_pid == os.getpid():
+            for fd in self._fds.values():
+                os.close(fd)
+        self._fds = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def position(self, index):
+        """Sort key placing entries in the order they are stored on disk."""
+        entry = self.entries[index]
+        return entry['shard'], entry['offset']
+
+    def read(self, index):
+        """Return the encoded bytes of one image."""
+        entry = self.entries[index]
+        return os.pread(self._fd(entry['shard']), entry['length'], entry['offset'])
+
+    def iter_images(self, indices):
+        """Yield (index, encoded bytes) in storage order, reading neighbouring members together."""
+        run = []
+        for index in sorted(indices, key=self.position) + [None]:
+            if run and (index is None or not self._extends(run, index)):
+                yield from self._read_run(run)
+                run = []
+            if index is not None:
+                run.append(index)
+
+    def _extends(self, run, index):
+        first, last, entry = self.entries[run[0]], self.entries[run[-1]], self.entries[index]
+        return (entry['shard'] == first['shard']
+                and entry['offset'] - (last['offset'] + last['length']) <= MAX_READ_GAP
+                and entry['offset'] + entry['length'] - first['offset'] <= self.read_bytes)
+
+    def _read_run(self, run):
+        first, last = self.entries[run[0]], self.entries[run[-1]]
+        start = first['offset']
+        data = os.pread(self._fd(first['shard']), last['offset'] + last['length'] - start, start)
+        for index in run:
+            entry = self.entries[index]
+            yield index, data[entry['offset'] - start:entry['offset'] - start + entry['length']]
+
+    def open_image(self, index):
+        with Image.open(io.BytesIO(self.read(index))) as image:
+            return image.convert("RGB")
+
+    def persons(self):
+        return sorted({entry['person'] for entry in self.entries})
+
+    def indices_by_person(self):
+        """Return {customer: [entry index, ...]} in storage order."""
+        persons = {}
+        for index in sorted(range(len(self.entries)), key=self.position):
+            persons.setdefault(self.entries[index]['person'], []).append(index)
+        return persons
+
+    def unpack(self, dataset_dir):
+        """Write the images back out in the arcface_train_dataset layout."""
+        for index, image_bytes in self.iter_images(range(len(self.entries))):
+            image_path = os.path.join(dataset_dir, self.entries[index]['path'])
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            with open(image_path, 'wb') as image_file:
+                image_file.write(image_bytes)
+        info(f"Gallery archive {self.archive_dir} unpacked to {dataset_dir} ({len(self.entries)} images)")
@@ -0,0 +1,107 @@
+"""GalleryArchive packing, incremental updates and coalesced reads of the tar shards.
+
+Usage (from face_model/):
+    python -m unittest gallery_archive_test
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+from gallery_archive import GalleryArchive
+
+
+class TestGalleryArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.dataset_dir = os.path.join(self.root, 'dataset')
+        self.archive_dir = os.path.join(self.root, 'archive')
+        self.images = {}
+        for i in range(6):
+            self._write_image(f"person_{i % 2}/image_{i}.png", os.urandom(1000 + i * 700))
+        self._write_image('person_0/notes.txt', b'not an image')
+
+    def _write_image(self, relative_path, image_bytes):
+        path = os.path.join(self.dataset_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as image_file:
+            image_file.write(image_bytes)
+        if relative_path.endswith('.png'):
+            self.images[relative_path] = image_bytes
+
+    def _contents(self, archive):
+        return {archive.entries[index]['path']: archive.read(index) for index in range(len(archive))}
+
+    def test_round_trip(self):
+        archive = GalleryArchive(self.archive_dir).update(self.dataset_dir)
+        self.assertEqual(self._contents(archive), self.images)
+        self.assertEqual(archive.persons(), ['person_0', 'person_1'])
+
+        # The shards stay plain tar files
+        with tarfile.open(os.path.join(self.archive_dir, 'gallery-00000.tar')) as shard:
+            self.assertEqual(sorted(shard.getnames()), sorted(self.images))
+
+        reopened = GalleryArchive(self.archive_dir)
+        self.assertEqual(self._contents(reopened), self.images)
+
+    def test_incremental_update_appends_to_the_last_shard(self):
+        archive = GalleryArchive(self.archive_dir, shard_bytes=8000).update(self.dataset_dir)
+        shard_count = archive.shard_count
+        self.assertGreater(shard_count, 1)
+        positions = {entry['path']: (entry['shard'], entry['offset']) for entry in archive.entries}
+
+        self._write_image('person_1/image_1.png', os.urandom(500))
+        self._write_image('person_2/image_6.png', os.urandom(300))
+        archive = GalleryArchive(self.archive_dir, shard_bytes=8000).update(self.dataset_dir)
+        self.assertEqual(self._contents(archive), self.images)
+        self.assertLessEqual(archive.shard_count, shard_count + 1)
+        for entry in archive.entries:
+            if entry['path'] not in ('person_1/image_1.png', 'person_2/image_6.png'):
+                self.assertEqual((entry['shard'], entry['offset']), positions[entry['path']])
+
+    def test_update_drops_deleted_images(self):
+        GalleryArchive(self.archive_dir).update(self.dataset_dir)
+        os.remove(os.path.join(self.dataset_dir, 'person_0/image_0.png'))
+        del self.images['person_0/image_0.png']
+        archive = GalleryArchive(self.archive_dir).update(self.dataset_dir)
+        self.assertEqual(self._contents(archive), self.images)
+
+    def test_iter_images_reads_neighbours_together(self):
+        archive = GalleryArchive(self.archive_dir).update(self.dataset_dir)
+        indices = list(range(len(archive)))[::-1]
+        with mock.patch('gallery_archive.os.pread', wraps=os.pread) as pread:
+            images = list(archive.iter_images(indices))
+        self.assertEqual(pread.call_count, 1)
+        self.assertEqual([index for index, _ in images], sorted(indices, key=archive.position))
+        self.assertEqual({archive.entries[index]['path']: data for index, data in images}, self.images)
+
+        # Runs stop at read_bytes, only an image larger than that is read on its own
+        archive.read_bytes = 4000
+        with mock.patch('gallery_archive.os.pread', wraps=os.pread) as pread:
+            self.assertEqual(len(list(archive.iter_images(indices))), len(indices))
+        self.assertGreater(pread.call_count, 1)
+        largest = max(entry['length'] for entry in archive.entries)
+        self.assertTrue(all(call.args[1] <= max(4000, largest) for call in pread.call_args_list))
+
+    def test_unpack(self):
+        archive = GalleryArchive(self.archive_dir).update(self.dataset_dir)
+        unpacked_dir = os.path.join(self.root, 'unpacked')
+        archive.unpack(unpacked_dir)
+        for relative_path, image_bytes in self.images.items():
+            with open(os.path.join(unpacked_dir, relative_path), 'rb') as image_file:
+                self.assertEqual(image_file.read(), image_bytes)
+
+    def test_unreadable_index_repacks(self):
+        GalleryArchive(self.archive_dir).update(self.dataset_dir)
+        with open(os.path.join(self.archive_dir, 'index.json'), 'w') as index_file:
+            index_file.write('{')
+        archive = GalleryArchive(self.archive_dir)
+        self.assertEqual(len(archive), 0)
+        self.assertEqual(self._contents(archive.update(self.dataset_dir)), self.images)
+
+
+if __name__ == '__main__':
+    unittest.main()
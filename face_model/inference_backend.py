@@ -0,0 +1,179 @@
+import os
+from threading import Lock
+import numpy as np
+import torch
+import torch.nn as nn
+from logger import info, error
+
+INFERENCE_BACKENDS = ('torch', 'onnx', 'torchscript', 'onnx-int8')
+# Artifact file suffix of the INT8 models written by quantize_models.py
+INT8_SUFFIX = '_int8'
+
+
+def artifact_paths(model_file_path, suffix=''):
+    """Return the ONNX and TorchScript artifact paths stored next to a .pth checkpoint.
+
+    'onnx_raw' is the unoptimized export kept for quantize_models.py: the quantizer does not
+    handle the fused operators of the optimized graph.
+    """
+    base, _ = os.path.splitext(model_file_path)
+    return {
+        'onnx': f"{base}{suffix}.onnx",
+        'onnx_raw': f"{base}{suffix}.raw.onnx",
+        'torchscript': f"{base}{suffix}.torchscript.pt",
+    }
+
+
+class ArcFaceHead(nn.Module):
+    """The trainable fc1 -> ReLU -> fc2 head of ArcFaceModel as a plain exportable module."""
+
+    def __init__(self, feature_dim, hidden_dim, num_classes):
+        super(ArcFaceHead, self).__init__()
+        self.fc1 = nn.Linear(feature_dim, hidden_dim)
+        self.fc2 = nn.Linear(hidden_dim, num_classes)
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        """Build the head from an ArcFaceModel checkpoint without loading InsightFace."""
+        hidden_dim, feature_dim = state_dict['fc1.weight'].shape
+        head = cls(feature_dim, hidden_dim, state_dict['fc2.weight'].size(0))
+        head.load_state_dict({key: value for key, value in state_dict.items()
+                              if key.startswith(('fc1.', 'fc2.'))})
+        return head.eval()
+
+    @classmethod
+    def from_model(cls, arcface_model):
+        return cls.from_state_dict({key: value.detach().cpu() for key, value in arcface_model.state_dict().items()})
+
+    def forward(self, features):
+        return self.fc2(torch.relu(self.fc1(features)))
+
+
+class TorchBackend:
+    """Eager PyTorch inference, the reference the other backends are checked against."""
+    name = 'torch'
+
+    def __init__(self, module, device='cpu'):
+        self.module = module.eval()
+        self.device = device
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.module(torch.from_numpy(batch).to(self.device)).cpu().numpy()
+
+
+class TorchScriptBackend:
+    """Frozen TorchScript module loaded from disk."""
+    name = 'torchscript'
+
+    def __init__(self, path):
+        self.path = path
+        self.module = torch.jit.load(path, map_location='cpu').eval()
+        info(f"TorchScript backend loaded from {path}")
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.module(torch.from_numpy(batch)).numpy()
+
+
+class OnnxBackend:
+    """ONNX Runtime session, created once per process because sessions do not survive fork()."""
+    name = 'onnx'
+
+    def __init__(self, path, num_threads=None):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"ONNX model not found: {path}")
+        self.path = path
+        self.num_threads = num_threads if num_threads is not None else int(os.getenv('ONNX_NUM_THREADS', '0'))
+        self._session = None
+        self._session_pid = None
+        self._lock = Lock()
+
+    def _get_session(self):
+        if self._session is None or self._session_pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    import onnxruntime as ort
+                    options = ort.SessionOptions()
+                    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    if self.num_threads:
+                        options.intra_op_num_threads = self.num_threads
+                    self._session = ort.InferenceSession(self.path, sess_options=options,
+                                                         providers=['CPUExecutionProvider'])
+                    self._input_name = self._session.get_inputs()[0].name
+                    self._session_pid = os.getpid()
+                    info(f"ONNX Runtime session created for {self.path}")
+        return self._session
+
+    def __call__(self, batch):
+        session = self._get_session()
+        return session.run(None, {self._input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+
+
+def load_backend(kind, model_file_path, suffix=''):
+    """Build the requested backend, or return None to keep eager torch inference.
+
+    Falls back to eager torch when the exported artifact is missing or older than the checkpoint.
+    """
+    if kind not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend: {kind}, expected one of {INFERENCE_BACKENDS}")
+    if kind == 'torch':
+        return None
+    if kind == 'onnx-int8':
+        kind, suffix = 'onnx', INT8_SUFFIX
+    artifact = artifact_paths(model_file_path, suffix)[kind]
+    if os.path.isfile(artifact) and os.path.isfile(model_file_path) and \
+            os.path.getmtime(artifact) < os.path.getmtime(model_file_path):
+        error(f"{artifact} is older than {model_file_path}, re-export it. Using eager torch.")
+        return None
+    try:
+        if kind == 'onnx':
+            return OnnxBackend(artifact)
+        return TorchScriptBackend(artifact)
+    except (FileNotFoundError, RuntimeError, ValueError) as e:
+        error(f"{kind} backend unavailable ({e}), run export_models.py (and quantize_models.py "
+              f"for INT8) first. Using eager torch.")
+        return None
+
+
+def export_onnx(module, example, path, raw_path=None):
+    """Export a module to ONNX with a dynamic batch axis and store the ORT-optimized graph.
+
+    The unoptimized export is kept at raw_path when one is given.
+    """
+    import onnxruntime as ort
+    module = module.eval()
+    keep_raw = raw_path is not None
+    raw_path = raw_path or f"{path}.raw"
+    torch.onnx.export(
+        module, example, raw_path,
+        input_names=['input'], output_names=['output'],
+        dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+        opset_version=17,
+    )
+    # Extended optimizations are portable across CPUs, hardware specific fusions happen at load time
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = path
+    ort.InferenceSession(raw_path, sess_options=options, providers=['CPUExecutionProvider'])
+    if not keep_raw:
+        os.remove(raw_path)
+    info(f"ONNX model exported to {path}")
+
+
+def export_torchscript(module, example, path):
+    """Trace and freeze a module to TorchScript."""
+    with torch.no_grad():
+        traced = torch.jit.trace(module.eval(), example)
+        frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, path)
+    info(f"TorchScript model exported to {path}")
+
+
+def min_cosine_similarity(reference, candidate):
+    """Return the lowest row-wise cosine similarity between two output batches."""
+    reference = reference.reshape(len(reference), -1)
+    candidate = candidate.reshape(len(candidate), -1)
+    dot = np.sum(reference * candidate, axis=1)
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    return float(np.min(dot / np.maximum(norms, 1e-12)))
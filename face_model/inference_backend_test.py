@@ -0,0 +1,59 @@
+"""Exported ONNX and TorchScript artifacts loaded through load_backend, checked against eager PyTorch.
+
+Usage (from face_model/):
+    python -m unittest inference_backend_test
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+from inference_backend import (ArcFaceHead, OnnxBackend, TorchBackend, TorchScriptBackend, artifact_paths,
+                               export_onnx, export_torchscript, load_backend, min_cosine_similarity)
+
+
+class TestExportedBackends(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.model_file_path = os.path.join(self.root, 'model.pth')
+        self.module = ArcFaceHead(16, 32, 5).eval()
+        torch.save(self.module.state_dict(), self.model_file_path)
+        self.inputs = np.random.default_rng(0).standard_normal((8, 16)).astype(np.float32)
+
+    def _export(self):
+        paths = artifact_paths(self.model_file_path)
+        example = torch.from_numpy(self.inputs[:1])
+        export_onnx(self.module, example, paths['onnx'], paths['onnx_raw'])
+        export_torchscript(self.module, example, paths['torchscript'])
+        return paths
+
+    def test_exported_backends_match_eager(self):
+        self._export()
+        reference = TorchBackend(self.module)(self.inputs)
+        for kind, backend_type in (('onnx', OnnxBackend), ('torchscript', TorchScriptBackend)):
+            with self.subTest(kind=kind):
+                backend = load_backend(kind, self.model_file_path)
+                self.assertIsInstance(backend, backend_type)
+                self.assertGreater(min_cosine_similarity(reference, backend(self.inputs)), 0.999)
+
+    def test_stale_artifact_falls_back_to_eager(self):
+        paths = self._export()
+        checkpoint_mtime = os.path.getmtime(self.model_file_path)
+        for kind in ('onnx', 'torchscript'):
+            with self.subTest(kind=kind):
+                # An artifact exported before the checkpoint was retrained
+                os.utime(paths[kind], (checkpoint_mtime - 60, checkpoint_mtime - 60))
+                self.assertIsNone(load_backend(kind, self.model_file_path))
+
+    def test_missing_artifact_falls_back_to_eager(self):
+        self.assertIsNone(load_backend('onnx', self.model_file_path))
+        self.assertIsNone(load_backend('torchscript', self.model_file_path))
+        self.assertIsNone(load_backend('torch', self.model_file_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from logger import info
+
+
+class ExecutorBusyError(Exception):
+    """Raised when a bounded executor has no free slot for new work."""
+
+    def __init__(self, name, retry_after=1):
+        super().__init__(f"{name} queue is full, retry after {retry_after}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """Thread pool that rejects work once max_workers + max_pending tasks are in flight."""
+
+    def __init__(self, max_workers, max_pending, name='executor', retry_after=1):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.name = name
+        self.retry_after = retry_after
+        self._slots = BoundedSemaphore(max_workers + max_pending)
+        self._executor = None
+        self._start_lock = Lock()
+        self._metrics_lock = Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def _get_executor(self):
+        # Created on first use so worker threads belong to the serving process
+        if self._executor is None:
+            with self._start_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix=self.name)
+                    info(f"{self.name} executor started (max_workers={self.max_workers}, "
+                         f"max_pending={self.max_pending})")
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit fn without blocking, raising ExecutorBusyError when the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._metrics_lock:
+                self._rejected += 1
+            raise ExecutorBusyError(self.name, self.retry_after)
+        with self._metrics_lock:
+            self._in_flight += 1
+        try:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future):
+        with self._metrics_lock:
+            self._in_flight -= 1
+            self._completed += 1
+        self._slots.release()
+
+    async def run(self, fn, *args, **kwargs):
+        """Await fn on the bounded pool from an async handler."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'in_flight': self._in_flight,
+                'completed': self._completed,
+                'rejected': self._rejected,
+            }
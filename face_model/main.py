@@ -2,13 +2,17 @@ from fastapi import FastAPI, File, Form, UploadFile, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
+import asyncio
 import io
 import os
 from process_image import ImageProcessor
+from model_registry import ModelRegistry, arcface_dataset
+from batch_scheduler import MicroBatchScheduler
+from inference_executor import BoundedExecutor, ExecutorBusyError
+from prefork_server import process_memory, run_prefork
+from training_jobs import TrainingJobManager
 from s3_config.s3Config import S3Config
 from logger import info, error
-from argface_model.argface_classifier import ArcFaceClassifier
-from facenet_model.facenet_model import FaceNetModel
 
 app = FastAPI()
 
@@ -29,23 +33,119 @@ yolo_root_dir = os.path.join(build_dir, 'yolo_model')
 yolo_dir = "yolo_model/train/weights/best.pt"
 yolo_path = os.path.join(build_dir, yolo_dir)
 
-# Export AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_DEFAULT_REGION in your env
-s3Config = S3Config()
+# Built by initialize_service(), not at import time: the spawned training and feature extraction
+# processes re-import this script as __mp_main__ and must not sync S3 or load models again
+s3Config = None
+model_registry = None
+image_processor = None
+upload_scheduler = None
+decode_executor = None
+inference_executor = None
+enroll_executor = None
+training_jobs = None
+upload_batching_enabled = os.getenv("UPLOAD_BATCHING_ENABLED", "true").lower() == "true"
+enroll_on_retrieve = os.getenv("ENROLL_ON_RETRIEVE", "false").lower() == "true"
 
-if not os.path.exists(build_dir):
-    info(f"Create {build_dir}")
-    os.makedirs(build_dir)
+def initialize_service():
+    """Sync the artifacts from S3 and build the models, pools and training job manager, once per process tree."""
+    global s3Config, model_registry, image_processor, upload_scheduler, decode_executor, inference_executor, \
+        enroll_executor, training_jobs
+    if model_registry is not None:
+        return
 
-if not os.path.exists(yolo_root_dir):
-    info(f"Create {yolo_root_dir} folder")
-    os.makedirs(yolo_root_dir)
+    # Export AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_DEFAULT_REGION in your env
+    s3Config = S3Config()
 
-if not os.path.exists(yolo_path):
-    info(f"Create {yolo_path} folder")
-    s3Config.download_all_objects('yolo_model/', build_dir)
+    if not os.path.exists(build_dir):
+        info(f"Create {build_dir}")
+        os.makedirs(build_dir)
 
-# Initialize the ImageProcessor
-image_processor = ImageProcessor(yolo_path)
+    if not os.path.exists(yolo_root_dir):
+        info(f"Create {yolo_root_dir} folder")
+        os.makedirs(yolo_root_dir)
+
+    # Only new or changed objects are transferred, restarts on a populated volume move just the diff
+    s3_sync_delete = os.getenv("S3_SYNC_DELETE", "false").lower() == "true"
+    if os.getenv("S3_SYNC_ON_STARTUP", "true").lower() == "true" or not os.path.exists(yolo_path):
+        s3Config.sync('yolo_model/', build_dir, delete=s3_sync_delete)
+    if os.getenv("S3_SYNC_DATASET_ON_STARTUP", "false").lower() == "true":
+        s3Config.sync(f"{os.path.basename(arcface_dataset)}/", build_dir, delete=s3_sync_delete)
+
+    # Models are loaded lazily, once per process, and shared by every endpoint
+    model_registry = ModelRegistry(yolo_path)
+    image_processor = ImageProcessor(model_registry)
+    model_registry.embedding_index.load()
+
+    # Frames posted to /upload within the batching window share one YOLO and embedding pass
+    upload_scheduler = MicroBatchScheduler(
+        image_processor.process_images,
+        max_batch_size=int(os.getenv("UPLOAD_MAX_BATCH_SIZE", "8")),
+        max_wait_ms=float(os.getenv("UPLOAD_BATCH_WINDOW_MS", "5")),
+        name="upload",
+        max_queue=int(os.getenv("UPLOAD_MAX_QUEUE", "64")),
+        retry_after=int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    )
+
+    # Image decoding and inference run on bounded pools; a full pool answers 503 instead of queueing forever
+    decode_executor = BoundedExecutor(
+        max_workers=int(os.getenv("DECODE_WORKERS", "2")),
+        max_pending=int(os.getenv("DECODE_MAX_PENDING", "32")),
+        name="decode",
+        retry_after=int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    )
+    inference_executor = BoundedExecutor(
+        max_workers=int(os.getenv("INFERENCE_WORKERS", "2")),
+        max_pending=int(os.getenv("INFERENCE_MAX_PENDING", "16")),
+        name="inference",
+        retry_after=int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    )
+
+    # Enrollment fine-tunes a copy of the ArcFace head one customer at a time, next to the serving model
+    enroll_executor = BoundedExecutor(
+        max_workers=1,
+        max_pending=int(os.getenv("ENROLL_MAX_PENDING", "4")),
+        name="enroll",
+        retry_after=int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    )
+
+    # Training runs in a separate, pinned and niced process; see training_jobs.py
+    training_jobs = TrainingJobManager(
+        os.path.join(build_dir, 'training_jobs'),
+        on_success=reload_trained_models,
+        niceness=int(os.getenv("TRAINING_NICE", "10")),
+        max_queue=int(os.getenv("TRAINING_MAX_QUEUE", "4")),
+        retry_after=int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    )
+
+def reload_trained_models():
+    # Pick up the freshly trained weights on the next request
+    model_registry.reload('arcface')
+    model_registry.reload('facenet')
+
+def decode_image(image_content):
+    pil_image = Image.open(io.BytesIO(image_content))
+    pil_image.load()  # Force the actual decode to happen on the decode pool
+    return pil_image
+
+def enroll_customer(customer_name):
+    classifier = model_registry.arcface().clone()
+    label = classifier.enroll(
+        customer_name,
+        num_epochs=int(os.getenv("ENROLL_EPOCHS", "50")),
+        lr=float(os.getenv("ENROLL_LEARNING_RATE", "0.01")),
+        momentum=float(os.getenv("ENROLL_MOMENTUM", "0.9"))
+    )
+    model_registry.publish('arcface', classifier)
+    return {"status": "success", "message": f"{customer_name} enrolled", "label": label}
+
+def log_enrollment_failure(customer_name, future):
+    # Nobody waits on background enrollments, their errors would otherwise be lost
+    if not future.cancelled() and future.exception() is not None:
+        error(f"Background enrollment of {customer_name} failed: {str(future.exception())}")
+
+def busy_response(e):
+    error(f"Rejecting request: {str(e)}")
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
 @app.get("/health")
 def health_check():
@@ -55,78 +155,136 @@ def health_check():
         error(f"Health check failed: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/models")
+def model_stats():
+    return model_registry.stats()
+
+@app.get("/metrics")
+def metrics():
+    return {
+        "upload_batching": dict(upload_scheduler.metrics(), enabled=upload_batching_enabled),
+        "decode_executor": decode_executor.metrics(),
+        "inference_executor": inference_executor.metrics(),
+        "enroll_executor": enroll_executor.metrics(),
+        "process": dict(process_memory(), pid=os.getpid()),
+    }
+
 @app.post("/upload")
-def upload_image(image: UploadFile = File(...)):
+async def upload_image(image: UploadFile = File(...)):
     try:
         info(f"File: {image.filename}")
-        image_content = image.file.read()
-        pil_image = Image.open(io.BytesIO(image_content))
-        result = image_processor.process_image(pil_image)
+        image_content = await image.read()
+        pil_image = await decode_executor.run(decode_image, image_content)
+        if upload_batching_enabled:
+            result = await asyncio.wrap_future(upload_scheduler.submit(pil_image))
+        else:
+            result = await inference_executor.run(image_processor.process_image, pil_image)
         info(f"/upload: {result}")
         return result
+    except ExecutorBusyError as e:
+        raise busy_response(e)
     except Exception as e:
         error(f"Error in /upload: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to process image: {str(e)}")
 
 @app.post("/retrieve")
-def retrieve_image(image: UploadFile = File(...), customerName: str = Form(...)):
+async def retrieve_image(image: UploadFile = File(...), customerName: str = Form(...)):
     try:
         info(f"File: {image.filename}\nCustomer Name: {customerName}")
-        image_content = image.file.read()
-        pil_image = Image.open(io.BytesIO(image_content))
-        image_processor_with_name = ImageProcessor(yolo_path, customerName)
-        result = image_processor_with_name.retrieve_image(pil_image)
+        image_content = await image.read()
+        pil_image = await decode_executor.run(decode_image, image_content)
+        result = await inference_executor.run(image_processor.retrieve_image, pil_image, customerName)
+        if enroll_on_retrieve:
+            try:
+                future = enroll_executor.submit(enroll_customer, customerName)
+                future.add_done_callback(lambda done: log_enrollment_failure(customerName, done))
+            except ExecutorBusyError as e:
+                error(f"Enrollment of {customerName} not scheduled: {str(e)}")
         info(f"/retrieve: {result}")
         return result
+    except ExecutorBusyError as e:
+        raise busy_response(e)
     except Exception as e:
         error(f"Error in /retrieve: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to retrieve image: {str(e)}")
 
-@app.post("/train")
-def train_images(variableKey: list[str], variableValue: list[str]):
-    arcface_dataset = os.path.join(build_dir, 'arcface_train_dataset')
-    arcface_model_dir = os.path.join(build_dir, '.insightface')
-    arcface_model_save = os.path.join(arcface_model_dir, 'arcface_model.pth')
-
-    if not os.path.exists(arcface_dataset):
-        error(f"{arcface_dataset} not found. Downloading from S3...")
-        s3Config.download_all_objects('arcface_train_dataset/', build_dir)
+@app.post("/enroll")
+async def enroll(customerName: str = Form(...)):
+    try:
+        info(f"Enrolling customer: {customerName}")
+        result = await enroll_executor.run(enroll_customer, customerName)
+        info(f"/enroll: {result}")
+        return result
+    except ExecutorBusyError as e:
+        raise busy_response(e)
+    except FileNotFoundError as e:
+        error(f"Error in /enroll: {str(e)}")
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        error(f"Error in /enroll: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to enroll customer: {str(e)}")
 
+@app.post("/train", status_code=202)
+def train_images(variableKey: list[str], variableValue: list[str]):
     config = dict(zip(variableKey, variableValue))
-    num_epochs = int(config.get("NUM_EPOCHS"))
-    learning_rate = float(config.get("LEARNING_RATE"))
-    momentum = float(config.get("MOMENTUM"))
     info(f"config: {config}")
+    try:
+        job_config = {
+            "num_epochs": int(config.get("NUM_EPOCHS")),
+            "learning_rate": float(config.get("LEARNING_RATE")),
+            "momentum": float(config.get("MOMENTUM")),
+            "batch_size": int(config.get("BATCH_SIZE", "256")),
+        }
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid training config: {str(e)}")
+    try:
+        job = training_jobs.submit(job_config)
+    except ExecutorBusyError as e:
+        raise busy_response(e)
+    return {"status": "queued", "message": "Training job queued", "job_id": job["id"]}
 
-    classifier = ArcFaceClassifier(arcface_dataset, arcface_model_dir, arcface_model_save)
-    info("Initializing and training the model.")
-    classifier.initialize_model()
-    classifier.extract_features()
-    classifier.train(num_epochs=num_epochs, lr=learning_rate, momentum=momentum)
-    classifier.plot_training_metrics(os.path.join(arcface_model_dir, 'arcface_train_loss'))
-
-    save_path = os.path.join(build_dir, 'face_net_train')
-    model_file_path = os.path.join(save_path, 'facenet_model.pth')
-    faceNetModel = FaceNetModel(
-        image_path=arcface_dataset, batch_size=64, lr=learning_rate,
-        num_epochs=num_epochs, save_path=save_path,
-        model_file_path=model_file_path
-    )
-    faceNetModel.train()
+@app.get("/train")
+def list_training_jobs():
+    return training_jobs.list()
+
+@app.get("/train/{job_id}")
+def training_job_status(job_id: str):
+    job = training_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Training job {job_id} not found")
+    return job
+
+@app.delete("/train/{job_id}")
+def cancel_training_job(job_id: str):
+    job = training_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Training job {job_id} not found")
+    return job
+
+@app.on_event("startup")
+def start_service():
+    # Already done before the server starts when run as a script; covers `uvicorn main:app`
+    initialize_service()
 
-    return {"status": "success", "message": "Model trained successfully"}
+@app.on_event("shutdown")
+def stop_training():
+    if training_jobs is not None:
+        training_jobs.shutdown()
 
 if __name__ == "__main__":
     import uvicorn
 
+    initialize_service()
+
     tls_enabled = os.getenv("TLS_ENABLED", "false").lower() == "true"
+    server_workers = int(os.getenv("SERVER_WORKERS", "1"))
+    torch_threads = int(os.getenv("TORCH_NUM_THREADS", "0"))
 
     if tls_enabled:
         ca_path = os.getenv("CA_PATH")
         cert_path = os.getenv("CERT_PATH")
         key_path = os.getenv("KEY_PATH")
-        uvicorn.run(
-            app,
+        server_options = dict(
             host="0.0.0.0",
             port=5443,
             ssl_certfile=cert_path,
@@ -134,4 +292,19 @@ if __name__ == "__main__":
             ssl_ca_certs=ca_path,
         )
     else:
-        uvicorn.run(app, host="0.0.0.0", port=5000)
+        server_options = dict(host="0.0.0.0", port=5000)
+
+    if server_workers > 1:
+        # Models are loaded once here and shared copy-on-write with the forked workers
+        run_prefork(
+            app, model_registry, server_workers,
+            torch_threads=torch_threads or None,
+            share_memory=os.getenv("PREFORK_SHARE_MEMORY", "false").lower() == "true",
+            memory_report_seconds=int(os.getenv("PREFORK_MEMORY_REPORT_SECONDS", "300")),
+            **server_options
+        )
+    else:
+        if torch_threads:
+            import torch
+            torch.set_num_threads(torch_threads)
+        uvicorn.run(app, **server_options)
@@ -1,4 +1,5 @@
 from process_image import ImageProcessor
+from model_registry import ModelRegistry
 from argface_model.argface_classifier import ArcFaceClassifier
 from facenet_model.facenet_model import FaceNetModel
 import os
@@ -82,7 +83,7 @@ def main():
     info(f"Distances: {distances}")
     info(f"Labels: {labels}")
 
-    image_processor = ImageProcessor(yolo_path)
+    image_processor = ImageProcessor(ModelRegistry(yolo_path))
 
     valid_extensions = ('.jpg', '.jpeg', '.png', '.bmp')  # Add more extensions if needed
     for label_name in os.listdir(arcface_dataset):
@@ -0,0 +1,199 @@
+import os
+import time
+from threading import Lock
+import torch
+from ultralytics import YOLO
+from argface_model.argface_classifier import ArcFaceClassifier
+from facenet_model.facenet_model import FaceNetModel
+from embedding_index import EmbeddingIndex
+from inference_backend import load_backend
+from logger import info, error
+
+file_location = os.path.abspath(__file__)  # Get current file abspath
+root_directory = os.path.dirname(file_location)  # Get root dir
+
+build_dir = os.path.join(root_directory, '..', 'build')
+arcface_dataset = os.path.join(build_dir, 'arcface_train_dataset')
+arcface_model_dir = os.path.join(build_dir, '.insightface')
+model_save_path = os.path.join(arcface_model_dir, 'arcface_model.pth')
+# Face Net
+facenet_model_dir = os.path.join(build_dir, 'face_net_train')
+facenet_model_file_path = os.path.join(facenet_model_dir, 'facenet_model.pth')
+embedding_index_dir = os.path.join(facenet_model_dir, 'embedding_index')
+training_checkpoint_dir = os.path.join(build_dir, 'training_checkpoints')
+# Pre-decoded training images shared by both trainers, DATASET_SHARDS_ENABLED=false reads the files
+dataset_shard_dir = os.path.join(build_dir, 'dataset_shards') \
+    if os.getenv('DATASET_SHARDS_ENABLED', 'true').lower() == 'true' else None
+# DATASET_BACKEND=s3 trains straight from the bucket through a bounded local cache instead of a full mirror,
+# DATASET_BACKEND=archive from the tar shards written by pack_gallery.py
+dataset_backend = os.getenv('DATASET_BACKEND', 'local')
+dataset_s3_cache_dir = os.path.join(build_dir, 'dataset_s3_cache')
+gallery_archive_dir = os.path.join(build_dir, 'gallery_archive')
+
+
+def _current_rss_bytes():
+    """Return the resident set size of the current process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss is reported in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ModelRegistry:
+    """Process-wide holder that loads each model once, lazily, and shares it across requests."""
+
+    def __init__(self, yolo_model_path):
+        self.yolo_model_path = yolo_model_path
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # torch, onnx or torchscript for the FaceNet backbone and the ArcFace head
+        self.inference_backend = os.getenv('INFERENCE_BACKEND', 'torch')
+        self._loaders = {
+            'yolo': self._load_yolo,
+            'arcface': self._load_arcface,
+            'facenet': self._load_facenet,
+        }
+        self._models = {}
+        self._stats = {}
+        # One lock per model so a slow load does not block the others
+        self._load_locks = {name: Lock() for name in self._loaders}
+        # Inference locks for models whose predict call mutates internal state
+        self.inference_locks = {name: Lock() for name in self._loaders}
+        # Gallery reference embeddings, built with the shared FaceNet model
+        self.embedding_index = EmbeddingIndex(embedding_index_dir, arcface_dataset,
+                                              facenet_model_file_path, self.facenet)
+
+    def _load_yolo(self):
+        return YOLO(self.yolo_model_path).to(self.device)
+
+    def _load_arcface(self):
+        classifier = ArcFaceClassifier(arcface_dataset, arcface_model_dir, model_save_path, dataset_shard_dir)
+        if not os.path.isfile(model_save_path):
+            info(f"ArcFace model not found at {model_save_path}, training a new one")
+            classifier.initialize_model()
+            classifier.extract_features()
+            classifier.train()
+        classifier.load_model()
+        classifier.model.head_backend = load_backend(self.inference_backend, model_save_path)
+        return classifier
+
+    def _load_facenet(self):
+        model = FaceNetModel(image_path=arcface_dataset, model_file_path=facenet_model_file_path,
+                             save_path=facenet_model_dir)
+        model.model.eval()
+        model.inference_backend = load_backend(self.inference_backend, facenet_model_file_path)
+        return model
+
+    def get(self, name):
+        """Return the shared instance of a model, loading it on first use."""
+        if name not in self._loaders:
+            raise KeyError(f"Unknown model: {name}")
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._load_locks[name]:
+            # Another thread may have finished loading while we waited
+            if name in self._models:
+                return self._models[name]
+            info(f"Loading model: {name}")
+            rss_before = _current_rss_bytes()
+            start = time.perf_counter()
+            try:
+                model = self._loaders[name]()
+            except Exception as e:
+                error(f"Failed to load model {name}: {e}")
+                raise
+            load_seconds = time.perf_counter() - start
+            rss_delta = max(0, _current_rss_bytes() - rss_before)
+            self._stats[name] = {
+                'load_seconds': round(load_seconds, 3),
+                'rss_delta_mb': round(rss_delta / (1024 * 1024), 1),
+            }
+            self._models[name] = model
+            info(f"Model {name} loaded in {load_seconds:.2f}s (+{self._stats[name]['rss_delta_mb']} MB RSS)")
+            return model
+
+    def yolo(self):
+        return self.get('yolo')
+
+    def arcface(self):
+        classifier = self.get('arcface')
+        # Another prefork worker may have published an enrollment since this process loaded the head
+        try:
+            checkpoint_mtime = os.path.getmtime(model_save_path)
+        except OSError:
+            return classifier
+        if classifier.checkpoint_mtime is not None and checkpoint_mtime > classifier.checkpoint_mtime:
+            with self._load_locks['arcface']:
+                classifier = self._models['arcface']
+                if checkpoint_mtime > classifier.checkpoint_mtime:
+                    updated = classifier.clone()
+                    updated.load_checkpoint()
+                    self._publish('arcface', updated)
+                    classifier = updated
+        return classifier
+
+    def facenet(self):
+        model = self.get('facenet')
+        # Training run by another prefork worker replaced the weights the gallery embeddings depend on
+        try:
+            checkpoint_mtime = os.path.getmtime(facenet_model_file_path)
+        except OSError:
+            return model
+        if model.checkpoint_mtime is not None and checkpoint_mtime <= model.checkpoint_mtime:
+            return model
+        # The embedding index notices the new weights by itself (see EmbeddingIndex._refresh_signature);
+        # invalidating it here would deadlock, it calls facenet() while holding its own lock
+        with self._load_locks['facenet']:
+            model = self._models.get('facenet')
+            if model is not None and (model.checkpoint_mtime is None or checkpoint_mtime > model.checkpoint_mtime):
+                info(f"FaceNet weights changed on disk, reloading {facenet_model_file_path}")
+                model = self._load_facenet()
+                self._publish('facenet', model)
+        return model if model is not None else self.get('facenet')
+
+    def preload(self, names=None):
+        """Load models eagerly, e.g. in a prefork parent so workers share the weights."""
+        for name in names or self._loaders:
+            self.get(name)
+
+    def share_memory(self):
+        """Move the torch weights of loaded models into shared memory."""
+        # YOLO, ArcFaceClassifier and FaceNetModel all keep their nn.Module in .model
+        shared = [name for name in self._loaders if name in self._models]
+        for name in shared:
+            self._models[name].model.share_memory()
+        info(f"Model weights moved to shared memory: {shared}")
+
+    def publish(self, name, model):
+        """Atomically replace a loaded model; requests already holding the old one finish with it."""
+        with self._load_locks[name]:
+            self._publish(name, model)
+
+    def _publish(self, name, model):
+        if name == 'arcface':
+            model.model.head_backend = load_backend(self.inference_backend, model_save_path)
+        self._models[name] = model
+        self._stats.setdefault(name, {})['published_at'] = round(time.time(), 3)
+        info(f"Model {name} published")
+
+    def reload(self, name):
+        """Drop a cached model so the next get() loads it again (e.g. after training)."""
+        with self._load_locks[name]:
+            self._models.pop(name, None)
+            self._stats.pop(name, None)
+        if name == 'facenet':
+            self.embedding_index.invalidate()
+        info(f"Model {name} scheduled for reload")
+
+    def stats(self):
+        """Return load time and memory usage per loaded model."""
+        return {
+            'device': str(self.device),
+            'inference_backend': self.inference_backend,
+            'process_rss_mb': round(_current_rss_bytes() / (1024 * 1024), 1),
+            'models': {name: dict(self._stats[name], loaded=name in self._models)
+                       for name in self._stats},
+        }
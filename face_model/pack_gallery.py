@@ -0,0 +1,56 @@
+"""Pack arcface_train_dataset into tar shards with a JSON index (see gallery_archive.py).
+
+The gallery is then stored and transferred as a few large objects instead of one small
+PNG per enrollment. Runs are incremental: only images that are new or changed since the
+last run are packed, so with --upload only the shards that grew are sent again. The index
+is uploaded last, once every shard it points into is in the bucket. Training reads the
+archive with DATASET_BACKEND=archive.
+
+Usage (from face_model/):
+    python pack_gallery.py [--shard-mb 256] [--rebuild] [--upload]
+    python pack_gallery.py --unpack [--dataset build/arcface_train_dataset]
+"""
+import os
+import sys
+import shutil
+import argparse
+from gallery_archive import MB, GalleryArchive
+from model_registry import arcface_dataset, gallery_archive_dir
+from logger import info, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default=arcface_dataset)
+    parser.add_argument('--archive-dir', default=gallery_archive_dir)
+    parser.add_argument('--shard-mb', type=int, default=256)
+    parser.add_argument('--rebuild', action='store_true', help='drop the archive (and the bytes of stale images) first')
+    parser.add_argument('--upload', action='store_true', help='upload the changed shards and the index to S3')
+    parser.add_argument('--unpack', action='store_true', help='write the archive back out to --dataset')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        shutil.rmtree(args.archive_dir, ignore_errors=True)
+    archive = GalleryArchive(args.archive_dir, shard_bytes=args.shard_mb * MB)
+    if args.unpack:
+        archive.unpack(args.dataset)
+        return
+
+    archive.update(args.dataset)
+    info(f"{len(archive)} images, {len(archive.persons())} customers in {archive.shard_count} shards")
+    if args.upload:
+        from s3_config.s3Config import S3Config
+        s3_config = S3Config()
+        prefix = f"{os.path.basename(gallery_archive_dir)}/"
+        index_name = os.path.basename(archive.index_path)
+        # Readers of the bucket must never see an index referencing shards not uploaded yet
+        stats = s3_config.upload_folder(prefix, args.archive_dir, exclude=(index_name, f"{index_name}.tmp"))
+        if stats['failed']:
+            error(f"{len(stats['failed'])} shards failed to upload, keeping the previous index in the bucket")
+            sys.exit(1)
+        if not s3_config.upload_file(f"{prefix}{index_name}", archive.index_path, folder_marker=False):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
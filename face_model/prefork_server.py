@@ -0,0 +1,133 @@
+import gc
+import os
+import time
+import signal
+import numpy as np
+import torch
+import uvicorn
+from training_profile import available_cpus
+from logger import info, error
+
+
+def process_memory(pid='self'):
+    """Return RSS, PSS and private/shared memory of a process in MB from smaps_rollup."""
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as smaps:
+            for line in smaps:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1])
+    except OSError as e:
+        error(f"Unable to read memory of process {pid}: {e}")
+        return {}
+
+    def to_mb(kb):
+        return round(kb / 1024, 1)
+
+    return {
+        'rss_mb': to_mb(fields.get('Rss', 0)),
+        'pss_mb': to_mb(fields.get('Pss', 0)),
+        'private_mb': to_mb(fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)),
+        'shared_mb': to_mb(fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0)),
+    }
+
+
+def _warm_up(model_registry):
+    # YOLO fuses its conv/bn layers on the first call; doing it here keeps the fused weights shared
+    model_registry.yolo()(np.zeros((64, 64, 3), dtype=np.uint8), verbose=False)
+
+
+def _run_worker(config, sock, torch_threads):
+    torch.set_num_threads(torch_threads)
+    info(f"Worker {os.getpid()} serving with {torch.get_num_threads()} torch threads")
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def _report_memory(children):
+    parent = process_memory()
+    info(f"Prefork parent {os.getpid()} memory: {parent}")
+    for pid in children:
+        memory = process_memory(pid)
+        info(f"Worker {pid} memory: {memory}, "
+             f"overhead over shared weights: {memory.get('private_mb', 0)} MB private")
+
+
+def run_prefork(app, model_registry, workers, torch_threads=None, share_memory=False,
+                memory_report_seconds=300, **uvicorn_kwargs):
+    """Load models once in this process, then fork workers that share the weights copy-on-write.
+
+    Without torch_threads, the available CPUs are split evenly between the workers. Every
+    worker keeps its own EmbeddingIndex in memory; it re-reads a customer's index from disk
+    when another worker enrolled an image for them (see EmbeddingIndex.get).
+    """
+    # Set explicitly in every worker, the single thread of the parent would otherwise be inherited
+    torch_threads = torch_threads or max(1, available_cpus() // workers)
+    info(f"Workers use {torch_threads} torch threads each ({available_cpus()} CPUs, {workers} workers)")
+    # The parent must not start an OpenMP team before forking, otherwise workers can hang
+    torch.set_num_threads(1)
+    config = uvicorn.Config(app, **uvicorn_kwargs)
+    sock = config.bind_socket()
+
+    info(f"Preloading models before forking {workers} workers")
+    model_registry.preload()
+    _warm_up(model_registry)
+    if share_memory:
+        model_registry.share_memory()
+    # Keep the garbage collector from touching (and un-sharing) objects created so far
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                _run_worker(config, sock, torch_threads)
+            finally:
+                os._exit(0)
+        children[pid] = index
+        info(f"Started worker {index} with pid {pid}")
+
+    stopping = False
+
+    def stop(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        info(f"Received signal {signum}, stopping {len(children)} workers")
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(workers):
+        spawn(index)
+
+    last_report = time.monotonic()
+    reported_startup = False
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            index = children.pop(pid, None)
+            if index is not None and not stopping:
+                error(f"Worker {index} (pid {pid}) exited with status {status}, restarting")
+                spawn(index)
+            continue
+        time.sleep(1)
+        now = time.monotonic()
+        # First report once workers settled, then periodically
+        if (not reported_startup and now - last_report > 30) or \
+                (memory_report_seconds and now - last_report > memory_report_seconds):
+            _report_memory(children)
+            reported_startup = True
+            last_report = now
+    sock.close()
+    info("All workers stopped")
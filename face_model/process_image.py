@@ -1,92 +1,58 @@
 import os
-import tempfile
 import numpy as np
 import uuid
-import torch
 from PIL import Image
-from ultralytics import YOLO
-from argface_model.argface_classifier import ArcFaceClassifier
-from facenet_model.facenet_model import FaceNetModel
+from model_registry import arcface_dataset
+from argface_model.argface_model import align_face_crop
 from logger import info, debug, error
 
-file_location = os.path.abspath(__file__)  # Get current file abspath
-root_directory = os.path.dirname(file_location)  # Get root dir
-
-build_dir = os.path.join(root_directory, '..', 'build')
-arcface_dataset = os.path.join(build_dir, 'arcface_train_dataset')
-arcface_model_dir = os.path.join(build_dir, '.insightface')
-model_save_path = os.path.join(arcface_model_dir, 'arcface_model.pth')
-# Face Net
-facenet_model_dir = os.path.join(build_dir, 'face_net_train')
-facenet_model_file_path = os.path.join(facenet_model_dir, 'facenet_model.pth')
-
 class ImageProcessor:
-    def __init__(self, yolo_model_path, person_name="UNKNOWN"):
-        self.argface_model = ArcFaceClassifier(arcface_dataset, arcface_model_dir, model_save_path)
-        self.person_name = person_name
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.yolo_model = YOLO(yolo_model_path).to(self.device)
-        self.distances = []
-        self.facenet_model = FaceNetModel(image_path=arcface_dataset, model_file_path=facenet_model_file_path, save_path=facenet_model_dir)
-
-    def verify_images(self, image_path):
+    def __init__(self, model_registry):
+        # Models are owned by the registry and shared by every request
+        self.model_registry = model_registry
+
+    def verify_images(self, face_array, person_name):
         try:
             info("Starting verification process")
-            
-            customer_dir = os.path.join(arcface_dataset, self.person_name)
-            if not os.path.exists(customer_dir):
-                error(f"Customer directory not found: {customer_dir}")
-                return {'status': 'error', 'message': 'Customer not found'}
-
-            customer_images = [f for f in os.listdir(customer_dir) if os.path.isfile(os.path.join(customer_dir, f))]
-            if not customer_images:
-                error(f"No images found for the customer: {self.person_name}")
-                return {'status': 'error', 'message': 'No images found for the customer'}
-
-            first_image_path = os.path.join(customer_dir, customer_images[0])
-            info(f"Using first image for verification: {first_image_path}")
-
-            # Get embeddings for the first customer image and the provided image
-            embeddings = self.facenet_model.get_embeddings([first_image_path, image_path])
-
-            if embeddings.shape[0] != 2:
-                error("Failed to calculate embeddings for both images.")
-                return {'status': 'error', 'message': 'Failed to calculate embeddings for both images'}
-
-            embedding1, embedding2 = embeddings[0], embeddings[1]
-            info("Embeddings calculated for both images")
-
-            # Calculate Euclidean distance (lower indicates more similarity)
-            similarity = np.linalg.norm(embedding1 - embedding2)
-            info(f"Euclidean distance between embeddings: {similarity}")
+            probe_embedding = self.model_registry.facenet().get_embeddings_from_arrays([face_array])[0]
+            return self._verify_embedding(probe_embedding, person_name)
+        except Exception as e:
+            raise ValueError(f"Error in verify_images: {str(e)}")
 
-            # Decide based on a threshold
-            threshold = 2
-            is_same_person = similarity < threshold
-            info("Images are of the same person" if is_same_person else "Images are of different persons")
+    def _verify_embedding(self, probe_embedding, person_name):
+        """Compare a probe FaceNet embedding with the indexed gallery of a customer."""
+        # Reference embeddings are precomputed per gallery image, only the probe is embedded per request
+        reference_embeddings = self.model_registry.embedding_index.get(person_name)
+        if reference_embeddings is None or len(reference_embeddings) == 0:
+            error(f"No indexed images found for the customer: {person_name}")
+            return {'status': 'error', 'message': 'No images found for the customer'}
+        info(f"Probe embedding compared against {len(reference_embeddings)} reference images")
 
-            self.distances.append(similarity)
+        # Calculate Euclidean distance to the closest reference (lower indicates more similarity)
+        similarity = np.linalg.norm(reference_embeddings - probe_embedding, axis=1).min()
+        info(f"Euclidean distance between embeddings: {similarity}")
 
-            return {
-                'is_same_person': bool(is_same_person),
-                'similarity': float(similarity)
-            }
-        except Exception as e:
-            raise ValueError(f"Error in verify_images: {str(e)}")
+        # Decide based on a threshold
+        threshold = 2
+        is_same_person = similarity < threshold
+        info("Images are of the same person" if is_same_person else "Images are of different persons")
 
-    def process_image(self, image):
-        info("Starting image processing")
+        return {
+            'is_same_person': bool(is_same_person),
+            'similarity': float(similarity)
+        }
 
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        image_np = np.array(image)
+    def _detect_faces(self, image_np):
+        """Run YOLO on a frame and return the face detections."""
+        return self._detect_faces_batch([image_np])[0]
 
-        results = self.yolo_model(image_np)
-        detections = []
-        is_same_person = False
-        similarity = 0.0
-        embedding_count = 0
+    def _detect_faces_batch(self, images_np):
+        """Run YOLO once over several frames and return the face detections of each."""
+        with self.model_registry.inference_locks['yolo']:
+            results = self.model_registry.yolo()(list(images_np))
+        frame_detections = []
         for result in results:
+            detections = []
             for box in result.boxes:
                 x1, y1, x2, y2 = map(int, box.xyxy[0])
                 if box.cls == 0:
@@ -94,73 +60,113 @@ class ImageProcessor:
                         'bbox': (x1, y1, x2, y2),
                         'confidence': box.conf.item()
                     })
+            frame_detections.append(detections)
+        return frame_detections
 
+    def _crop_faces(self, image_np, detections):
+        """Cut a padded crop for every detection, keeping them in memory."""
+        padding = 100
+        face_rois = []
         for detection in detections:
-            if os.path.isfile(model_save_path):
-                self.argface_model.load_model()
-            else:
-                self.argface_model.initialize_model()
-                self.argface_model.extract_features()
-                self.argface_model.train()
-                self.argface_model.load_model()
-
             x1, y1, x2, y2 = detection['bbox']
-
-            padding = 100
             x1 = max(0, x1 - padding)
             y1 = max(0, y1 - padding)
             x2 = min(image_np.shape[1], x2 + padding)
             y2 = min(image_np.shape[0], y2 + padding)
+            face_rois.append(np.ascontiguousarray(image_np[y1:y2, x1:x2]))
+        return face_rois
+
+    def _recognize_faces(self, image_np, detections):
+        """Identify and verify all detections of a frame with batched model calls."""
+        return self._recognize_frames([(image_np, detections)])[0]
+
+    def _recognize_frames(self, frames):
+        """Identify and verify the detections of several frames with one batched call per model.
+
+        frames is a list of (image_np, detections); returns the embedding count of each frame.
+        """
+        embedding_counts = [0] * len(frames)
+        # Flatten the faces of every frame, remembering which detection each one belongs to
+        face_rois, owners = [], []
+        for frame_index, (image_np, detections) in enumerate(frames):
+            face_rois.extend(self._crop_faces(image_np, detections))
+            owners.extend((frame_index, detection) for detection in detections)
+        if not face_rois:
+            return embedding_counts
+
+        argface_model = self.model_registry.arcface()
+        if argface_model.model.embedding_mode == 'recognition':
+            # The recognition network expects a tight, square face instead of the padded crop
+            arcface_faces = [align_face_crop(image_np, detection['bbox'])
+                             for image_np, detections in frames for detection in detections]
+        else:
+            arcface_faces = face_rois
+        try:
+            person_names = argface_model.identify_person_arrays(arcface_faces)
+        except Exception as e:
+            # One bad crop should not turn every face of the batch into Unknown
+            error(f"Error identifying persons: {str(e)}, identifying faces one by one")
+            person_names = [self._identify_face(argface_model, face) for face in arcface_faces]
+
+        known_indices = [index for index, name in enumerate(person_names) if name != 'Unknown']
+        if not known_indices:
+            return embedding_counts
+
+        info('Validating persons...')
+        probe_embeddings = self.model_registry.facenet().get_embeddings_from_arrays(
+            [face_rois[index] for index in known_indices])
+        for index, probe_embedding in zip(known_indices, probe_embeddings):
+            frame_index, detection = owners[index]
+            validate_person = self._verify_embedding(probe_embedding, person_names[index])
+            if 'is_same_person' not in validate_person:
+                # Nothing to verify against, e.g. no indexed gallery: the face stays Unknown
+                continue
+            detection['is_same_person'] = validate_person['is_same_person']
+            detection['similarity'] = validate_person['similarity']
+            detection['person_name'] = person_names[index]
+            embedding_counts[frame_index] += 1
+            info(f"process_image: detection: {detection}")
+        return embedding_counts
+
+    def _identify_face(self, argface_model, face):
+        """Identify a single face, Unknown when the classifier fails on it."""
+        try:
+            return argface_model.identify_person_arrays([face])[0]
+        except Exception as e:
+            error(f"Error identifying person: {str(e)}")
+            return 'Unknown'
 
-            face_roi = image_np[y1:y2, x1:x2]
-            face_pil = Image.fromarray(face_roi)
-
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_face_file:
-                face_pil.save(temp_face_file.name)
-                temp_face_path = temp_face_file.name
-
-            try:
-                info(f"Processing face at path: {temp_face_path}")
-                self.person_name = self.argface_model.identify_person(temp_face_path)            
-            except Exception as e:
-                error_msg = str(e)
-                error("Debug: Model device: {}".format(self.argface_model.model.device))
-                error("Debug: Tensor device in identify_person method was likely incorrect.")
-                self.person_name = "Unknown"
-                error(f"Error identifying person: {error_msg}")
-
-            if self.person_name != 'Unknown':
-                info('Validating person...')
-                validate_person = self.verify_images(temp_face_path)
-                is_same_person = validate_person['is_same_person']
-                similarity = validate_person['similarity']
-                embedding_count += 1
-                info(f"is_same_person: {is_same_person}")
-                info(f"similarity: {similarity}")
-                detection['is_same_person'] = is_same_person
-                detection['similarity'] = similarity
-                detection['person_name'] = self.person_name
-                info(f"process_image: detection: {detection}")
-
-            os.remove(temp_face_path)
-            info(f"Person identified: {self.person_name}")
-
-        info(f"Image processing complete with {len(detections)} detections")
-
-        return {
-            'status': 'success',
-            'message': 'Image processed',
-            'detections': detections,
-            'embeddings': embedding_count
-        }
-    
-    def retrieve_image(self, image):
+    def process_image(self, image):
+        return self.process_images([image])[0]
+
+    def process_images(self, images):
+        """Run detection and recognition for several frames as one batch."""
+        info(f"Starting image processing for {len(images)} images")
+
+        images_np = [np.array(image if image.mode == 'RGB' else image.convert('RGB')) for image in images]
+        frame_detections = self._detect_faces_batch(images_np)
+        embedding_counts = self._recognize_frames(list(zip(images_np, frame_detections)))
+
+        results = []
+        for detections, embedding_count in zip(frame_detections, embedding_counts):
+            info(f"Image processing complete with {len(detections)} detections")
+            results.append({
+                'status': 'success',
+                'message': 'Image processed',
+                'detections': detections,
+                'embeddings': embedding_count
+            })
+        return results
+
+    def retrieve_image(self, image, person_name):
         """Save the processed image to the local directory."""
         info("Starting image retrieval")
-        label_dir = os.path.join(arcface_dataset, self.person_name)
+        label_dir = os.path.join(arcface_dataset, person_name)
         os.makedirs(label_dir, exist_ok=True)
-        face_img = f"{self.person_name}_{uuid.uuid4()}.png"
+        face_img = f"{person_name}_{uuid.uuid4()}.png"
         face_save_path = os.path.join(label_dir, face_img)
-        image.convert('RGB').save(face_save_path)
+        image = image.convert('RGB')
+        image.save(face_save_path)
         info(f"Saved processed face image to {face_save_path}")
+        self.model_registry.embedding_index.add_image(person_name, face_img, np.array(image))
         return {'status': 'success', 'message': 'Image downloaded'}
@@ -0,0 +1,188 @@
+"""Build INT8 versions of the exported FaceNet and ArcFace head ONNX models.
+
+FaceNet is statically quantized (QDQ, per-channel weights) with a calibration set drawn
+from arcface_train_dataset; the ArcFace head only holds Linear layers and is dynamically
+quantized. Both start from the unoptimized exports (*.raw.onnx): the quantizer skips the
+fused operators of the ORT-optimized graphs. The number of quantized nodes is logged and
+a model in which nothing was quantized is an error. The script then reports the accuracy
+drift on the verification pairs produced by FaceNetModel.verify_images and the throughput
+of fp32 versus INT8 inference.
+
+Select the result at serving time with INFERENCE_BACKEND=onnx-int8.
+
+Usage (from face_model/), after export_models.py:
+    python quantize_models.py [--calibration-images 200] [--threshold 0.5]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import onnx
+import torch
+from onnx import helper, numpy_helper
+from PIL import Image
+from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic,
+                                      quantize_static)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from facenet_model.facenet_model import FaceNetModel
+from inference_backend import INT8_SUFFIX, OnnxBackend, artifact_paths, min_cosine_similarity
+from model_registry import arcface_dataset, model_save_path, facenet_model_dir, facenet_model_file_path
+from logger import info, error
+
+# Operators carrying the weights, the ones quantization is expected to cover
+WEIGHT_OPS = ('Conv', 'Gemm', 'MatMul')
+INTEGER_OPS = ('ConvInteger', 'MatMulInteger', 'QLinearConv', 'QLinearMatMul')
+
+
+class GalleryCalibrationReader(CalibrationDataReader):
+    """Feed preprocessed gallery images to the static quantization calibrator."""
+
+    def __init__(self, facenet_model, limit, batch_size=16):
+        image_paths, _ = facenet_model._load_images()
+        # Spread the calibration set over every customer instead of the first folders only
+        rng = np.random.default_rng(0)
+        self.image_paths = [image_paths[i] for i in rng.permutation(len(image_paths))[:limit]]
+        self.transform = facenet_model.eval_transform()
+        self.batch_size = batch_size
+        self.position = 0
+        info(f"Calibrating with {len(self.image_paths)} gallery images")
+
+    def get_next(self):
+        if self.position >= len(self.image_paths):
+            return None
+        paths = self.image_paths[self.position:self.position + self.batch_size]
+        self.position += self.batch_size
+        batch = torch.stack([self.transform(Image.open(path).convert("RGB")) for path in paths])
+        return {'input': batch.numpy()}
+
+
+def count_quantized(name, raw_path, int8_path):
+    """Log how many weight operators of the raw graph ended up quantized; fail when none did."""
+    total = sum(node.op_type in WEIGHT_OPS for node in onnx.load(raw_path).graph.node)
+    nodes = onnx.load(int8_path).graph.node
+    dequantized = {output for node in nodes if node.op_type == 'DequantizeLinear' for output in node.output}
+    quantized = sum(node.op_type in INTEGER_OPS for node in nodes) + \
+        sum(node.op_type in WEIGHT_OPS and any(weight in dequantized for weight in node.input[1:2]) for node in nodes)
+    info(f"{name}: {quantized} of {total} Conv/Gemm/MatMul nodes quantized")
+    if quantized == 0:
+        raise RuntimeError(f"{name}: no node was quantized in {int8_path}")
+    return quantized
+
+
+def gemm_to_matmul(model):
+    """Rewrite Gemm (Linear layers) as MatMul + Add, which dynamic quantization supports."""
+    initializers = {initializer.name: initializer for initializer in model.graph.initializer}
+    nodes = []
+    for node in model.graph.node:
+        attributes = {attribute.name: helper.get_attribute_value(attribute) for attribute in node.attribute}
+        if node.op_type != 'Gemm' or node.input[1] not in initializers or attributes.get('transA', 0) or \
+                attributes.get('alpha', 1.0) != 1.0 or attributes.get('beta', 1.0) != 1.0:
+            nodes.append(node)
+            continue
+        weight_name = node.input[1]
+        if attributes.get('transB', 0):
+            weight = numpy_helper.to_array(initializers[weight_name]).T
+            weight_name = f"{weight_name}_transposed"
+            model.graph.initializer.append(numpy_helper.from_array(np.ascontiguousarray(weight), weight_name))
+        if len(node.input) > 2 and node.input[2]:
+            product = f"{node.output[0]}_matmul"
+            nodes.append(helper.make_node('MatMul', [node.input[0], weight_name], [product], name=f"{node.name}_matmul"))
+            nodes.append(helper.make_node('Add', [product, node.input[2]], list(node.output), name=f"{node.name}_add"))
+        else:
+            nodes.append(helper.make_node('MatMul', [node.input[0], weight_name], list(node.output),
+                                          name=f"{node.name}_matmul"))
+    del model.graph.node[:]
+    model.graph.node.extend(nodes)
+    return model
+
+
+def quantize_facenet(facenet_model, calibration_images):
+    fp32_path = artifact_paths(facenet_model_file_path)['onnx']
+    raw_path = artifact_paths(facenet_model_file_path)['onnx_raw']
+    int8_path = artifact_paths(facenet_model_file_path, INT8_SUFFIX)['onnx']
+    prepared_path = f"{int8_path}.prep"
+    quant_pre_process(raw_path, prepared_path)
+    quantize_static(
+        prepared_path, int8_path,
+        GalleryCalibrationReader(facenet_model, calibration_images),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+    os.remove(prepared_path)
+    count_quantized('facenet', raw_path, int8_path)
+    info(f"INT8 FaceNet written to {int8_path}")
+    return OnnxBackend(fp32_path), OnnxBackend(int8_path)
+
+
+def quantize_arcface_head():
+    fp32_path = artifact_paths(model_save_path)['onnx']
+    raw_path = artifact_paths(model_save_path)['onnx_raw']
+    int8_path = artifact_paths(model_save_path, INT8_SUFFIX)['onnx']
+    matmul_path = f"{int8_path}.matmul"
+    onnx.save(gemm_to_matmul(onnx.load(raw_path)), matmul_path)
+    quantize_dynamic(matmul_path, int8_path, weight_type=QuantType.QInt8, op_types_to_quantize=['MatMul'])
+    os.remove(matmul_path)
+    count_quantized('arcface head', raw_path, int8_path)
+    info(f"INT8 ArcFace head written to {int8_path}")
+    return OnnxBackend(fp32_path), OnnxBackend(int8_path)
+
+
+def drift_report(facenet_model, fp32_backend, int8_backend, threshold):
+    """Compare the verification pairs of the fp32 and INT8 FaceNet models."""
+    fp32_distances, fp32_labels = facenet_model.verify_images(threshold=threshold, backend=fp32_backend)
+    int8_distances, int8_labels = facenet_model.verify_images(threshold=threshold, backend=int8_backend)
+    if not fp32_distances:
+        error("No verification pairs found (every customer needs at least two images)")
+        return
+    drift = np.abs(np.array(fp32_distances) - np.array(int8_distances))
+    agreement = np.mean(np.array(fp32_labels) == np.array(int8_labels))
+    info(f"Verification pairs: {len(fp32_distances)}")
+    info(f"Cosine distance drift: mean {drift.mean():.5f}, p95 {np.percentile(drift, 95):.5f}, max {drift.max():.5f}")
+    info(f"Same-person decisions agreeing with fp32 at threshold {threshold}: {agreement:.2%}")
+    info(f"Same-person rate: fp32 {np.mean(fp32_labels):.2%}, int8 {np.mean(int8_labels):.2%}")
+
+
+def throughput(name, backends, batch, repeats=10):
+    for label, backend in backends:
+        backend(batch)  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            backend(batch)
+        per_second = len(batch) * repeats / (time.perf_counter() - start)
+        info(f"{name} {label}: {per_second:9.1f} items/s (batch {len(batch)})")
+    info(f"{name} min cosine fp32 vs int8: {min_cosine_similarity(backends[0][1](batch), backends[1][1](batch)):.5f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calibration-images', type=int, default=200)
+    parser.add_argument('--threshold', type=float, default=0.5, help='verify_images cosine distance threshold')
+    parser.add_argument('--batch-size', type=int, default=32, help='throughput batch size')
+    args = parser.parse_args()
+
+    if not os.path.isfile(artifact_paths(facenet_model_file_path)['onnx_raw']):
+        error("FaceNet ONNX model not found, run export_models.py first")
+        sys.exit(1)
+
+    facenet_model = FaceNetModel(image_path=arcface_dataset, model_file_path=facenet_model_file_path,
+                                 save_path=facenet_model_dir)
+    facenet_fp32, facenet_int8 = quantize_facenet(facenet_model, args.calibration_images)
+    drift_report(facenet_model, facenet_fp32, facenet_int8, args.threshold)
+
+    rng = np.random.default_rng(0)
+    faces = rng.uniform(-1, 1, (args.batch_size, 3, 160, 160)).astype(np.float32)
+    throughput('facenet', [('fp32', facenet_fp32), ('int8', facenet_int8)], faces)
+
+    if os.path.isfile(artifact_paths(model_save_path)['onnx_raw']):
+        head_fp32, head_int8 = quantize_arcface_head()
+        features = rng.standard_normal((args.batch_size, 512)).astype(np.float32)
+        throughput('arcface head', [('fp32', head_fp32), ('int8', head_int8)], features)
+    else:
+        error("ArcFace head ONNX model not found, skipping its quantization")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,28 @@
 import boto3
 import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from logger import info, debug, error
 
+MB = 1024 * 1024
+
+
+def file_etag(path, part_size=None):
+    """Return the S3 ETag of a local file: its MD5, or the multipart ETag of an upload in part_size parts."""
+    with open(path, 'rb') as local_file:
+        if part_size is None:
+            whole = hashlib.md5()
+            for chunk in iter(lambda: local_file.read(8 * MB), b''):
+                whole.update(chunk)
+            return whole.hexdigest()
+        parts = [hashlib.md5(chunk).digest() for chunk in iter(lambda: local_file.read(part_size), b'')]
+    return f'{hashlib.md5(b"".join(parts)).hexdigest()}-{len(parts)}'
+
+
 class S3Config:
     def __init__(self, aws_access_key_id=None, aws_secret_access_key=None, region_name="us-east-1", bucket_name='contactless-checking', acl='public-read'):
         self.aws_access_key_id = aws_access_key_id or os.getenv('AWS_ACCESS_KEY_ID')
@@ -22,7 +43,19 @@ class S3Config:
             region_name=self.region_name
         )
 
-        self.s3 = self.session.client('s3')
+        # Objects are transferred by a pool of max_workers threads, each using up to
+        # max_concurrency connections for multipart transfers of large files
+        self.max_workers = int(os.getenv('S3_MAX_WORKERS', '16'))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '16')) * MB,
+            multipart_chunksize=int(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', '16')) * MB,
+            max_concurrency=int(os.getenv('S3_MAX_CONCURRENCY', '4')),
+            use_threads=True
+        )
+        self.s3 = self.session.client('s3', config=Config(
+            max_pool_connections=self.max_workers * self.transfer_config.max_concurrency,
+            retries={'max_attempts': 5, 'mode': 'adaptive'}
+        ))
         self._create_bucket()
 
     def bucket_exists(self):
@@ -73,15 +106,17 @@ class S3Config:
         except Exception as e:
             error(f'Error creating folder: {e}')
 
-    def upload_file(self, object_name, file_name):
+    def upload_file(self, object_name, file_name, folder_marker=True):
         folder_name = os.path.dirname(object_name)
-        if folder_name:
+        if folder_name and folder_marker:
             self.create_folder(folder_name)
         try:
-            self.s3.upload_file(file_name, self.bucket_name, object_name)
-            info(f'File {file_name} uploaded to {self.bucket_name}/{object_name}.')
+            self.s3.upload_file(file_name, self.bucket_name, object_name, Config=self.transfer_config)
+            debug(f'File {file_name} uploaded to {self.bucket_name}/{object_name}.')
+            return True
         except Exception as e:
-            error(f'Error uploading file: {e}')
+            error(f'Error uploading file {file_name}: {e}')
+            return False
 
     def delete_file(self, folder_name, file_name):
         object_key = f"{folder_name}/{file_name}"
@@ -93,40 +128,211 @@ class S3Config:
     
     def retrieve_file(self, object_name, download_path):
         try:
-            self.s3.download_file(self.bucket_name, object_name, download_path)
-            info(f'File {object_name} downloaded to {download_path}.')
+            self.s3.download_file(self.bucket_name, object_name, download_path, Config=self.transfer_config)
+            debug(f'File {object_name} downloaded to {download_path}.')
+            return True
         except Exception as e:
-            info(f'Error downloading file: {e}')
-            
+            error(f'Error downloading file {object_name}: {e}')
+            return False
+
+    def _list_pages(self, prefix, page_size=1000):
+        objects = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix,
+                                       PaginationConfig={'PageSize': page_size}):
+            objects.extend({'Key': obj['Key'], 'Size': obj['Size'], 'ETag': obj['ETag'].strip('"')}
+                           for obj in page.get('Contents', []))
+        info(f'{len(objects)} objects listed under {prefix}.')
+        return objects
+
+    def list_object_details(self, prefix, page_size=1000):
+        """Return Key, Size and ETag of every object under prefix, following pagination.
+
+        Returns None when any page could not be listed, never a partial listing.
+        """
+        try:
+            return self._list_pages(prefix, page_size)
+        except Exception as e:
+            error(f'Error listing objects under {prefix}: {e}')
+            return None
+
     def list_object(self, prefix):
+        objects = self.list_object_details(prefix)
+        return None if objects is None else [obj['Key'] for obj in objects]
+
+    def download_objects(self, objects, local_dir, max_workers=None):
+        """Download objects (dicts with Key and Size) concurrently and return the transfer stats."""
+        # Folder markers are zero-byte keys ending with '/', there is nothing to download
+        objects = [obj for obj in objects if not obj['Key'].endswith('/')]
+        for folder in {os.path.dirname(os.path.join(local_dir, obj['Key'])) for obj in objects}:
+            os.makedirs(folder, exist_ok=True)
+
+        start = time.perf_counter()
+        downloaded, failed, total_bytes = 0, [], 0
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            futures = {executor.submit(self.retrieve_file, obj['Key'], os.path.join(local_dir, obj['Key'])): obj
+                       for obj in objects}
+            for future in as_completed(futures):
+                obj = futures[future]
+                if future.result():
+                    downloaded += 1
+                    total_bytes += obj['Size']
+                else:
+                    failed.append(obj['Key'])
+        stats = self._transfer_stats(downloaded, total_bytes, time.perf_counter() - start, failed)
+        info(f"Downloaded {stats['objects']} objects, {stats['megabytes']} MB in {stats['seconds']}s "
+             f"({stats['mb_per_second']} MB/s, {stats['objects_per_second']} objects/s), {len(failed)} failed")
+        return stats
+
+    def download_all_objects(self, prefix, local_dir, max_workers=None):
+        """Download every object under prefix; return the transfer stats, or None when the listing failed."""
+        objects = self.list_object_details(prefix)
+        if objects is None:
+            return None
+        return self.download_objects(objects, local_dir, max_workers)
+
+    def sync(self, prefix, local_dir, delete=False, max_workers=None):
+        """Bring local_dir/prefix up to date with the bucket, transferring only new or changed objects.
+
+        The key, ETag and size of every synced object are kept in a manifest under local_dir.
+        With delete=True, files the manifest tracks whose object was removed from the bucket
+        are deleted; files created locally are never touched. Returns the transfer stats, or
+        None when the bucket could not be listed and the local copy was left as is.
+        """
         try:
-            response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix)
-            objects = []
-            if 'Contents' in response:
-                objects = [obj['Key'] for obj in response['Contents']]
-                info(f'Objects listed under {prefix}: {objects}')
-            else:
-                info(f'No objects found under {prefix}.')
-            return objects
+            objects = [obj for obj in self._list_pages(prefix) if not obj['Key'].endswith('/')]
         except Exception as e:
-            error(f'Error listing objects: {e}')
-            return []
+            error(f'Error listing objects under {prefix}, keeping the local copy: {e}')
+            return None
 
-    def download_all_objects(self, prefix, local_dir):
-        objects = self.list_object(prefix)
+        manifest_path = os.path.join(local_dir, '.s3_manifest', f"{prefix.strip('/').replace('/', '_') or 'root'}.json")
+        manifest = self._load_manifest(manifest_path)
+        changed, unchanged = [], {}
         for obj in objects:
-            local_path = os.path.join(local_dir, obj)
-            local_folder = os.path.dirname(local_path)
-            if not os.path.exists(local_folder):
-                os.makedirs(local_folder)
-                info(f'Created local directory {local_folder} for downloading files.')
-            self.retrieve_file(obj, local_path)
-            
-    def upload_folder(self, s3_prefix='', folder_path=''):
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                local_path = os.path.join(root, file)
+            local_path = os.path.join(local_dir, obj['Key'])
+            entry = manifest.get(obj['Key'])
+            if entry and entry['etag'] == obj['ETag'] and entry['size'] == obj['Size'] and \
+                    os.path.isfile(local_path) and os.path.getsize(local_path) == obj['Size']:
+                unchanged[obj['Key']] = entry
+            elif entry is None and self._matches_object(local_path, obj):
+                # Files downloaded before the manifest existed are adopted instead of fetched again
+                unchanged[obj['Key']] = {'etag': obj['ETag'], 'size': obj['Size']}
+            else:
+                changed.append(obj)
+
+        stats = self.download_objects(changed, local_dir, max_workers)
+        failed = set(stats['failed'])
+        synced = dict(unchanged)
+        synced.update({obj['Key']: {'etag': obj['ETag'], 'size': obj['Size']}
+                       for obj in changed if obj['Key'] not in failed})
+
+        deleted = 0
+        if delete:
+            remote_keys = {obj['Key'] for obj in objects}
+            for key in set(manifest) - remote_keys:
+                local_path = os.path.join(local_dir, key)
+                if os.path.isfile(local_path):
+                    os.remove(local_path)
+                    deleted += 1
+        else:
+            # Without delete the stale entries stay tracked so a later sync with delete can remove them
+            synced.update({key: entry for key, entry in manifest.items() if key not in synced})
+        self._save_manifest(manifest_path, synced)
+
+        stats.update(unchanged=len(unchanged), deleted=deleted)
+        info(f"Synced {prefix} to {local_dir}: {stats['objects']} transferred, {len(unchanged)} unchanged, "
+             f"{deleted} deleted, {len(failed)} failed")
+        return stats
+
+    @staticmethod
+    def _load_manifest(manifest_path):
+        try:
+            with open(manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            error(f'S3 manifest {manifest_path} is unreadable, checking every object: {e}')
+            return {}
+
+    @staticmethod
+    def _save_manifest(manifest_path, manifest):
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(f'{manifest_path}.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+    def _matches_object(self, local_path, obj):
+        if not os.path.isfile(local_path) or os.path.getsize(local_path) != obj['Size']:
+            return False
+        etag = obj['ETag']
+        if '-' not in etag:
+            return file_etag(local_path) == etag
+        parts = int(etag.split('-')[1])
+        # The part size of a multipart upload is not stored, try the sizes our uploads use
+        for part_size in {self.transfer_config.multipart_chunksize, 8 * MB}:
+            if -(-obj['Size'] // part_size) == parts and file_etag(local_path, part_size) == etag:
+                return True
+        return False
+
+    @staticmethod
+    def _transfer_stats(objects, total_bytes, seconds, failed):
+        return {
+            'objects': objects,
+            'megabytes': round(total_bytes / MB, 2),
+            'seconds': round(seconds, 3),
+            'mb_per_second': round(total_bytes / MB / seconds, 2) if seconds else 0.0,
+            'objects_per_second': round(objects / seconds, 1) if seconds else 0.0,
+            'failed': failed,
+        }
+
+    def upload_folder(self, s3_prefix='', folder_path='', max_workers=None, skip_unchanged=True, exclude=()):
+        """Upload a folder concurrently and return the transfer stats.
+
+        Prefixes need no folder marker objects, so each file costs a single upload. With
+        skip_unchanged, files whose size and MD5/multipart ETag match the bucket are skipped.
+        Files whose path relative to folder_path is in exclude are left out.
+        """
+        files = []
+        for root, dirs, names in os.walk(folder_path):
+            # The sync manifests describe this machine's copy, not the bucket
+            dirs[:] = [name for name in dirs if name != '.s3_manifest']
+            for name in names:
+                local_path = os.path.join(root, name)
                 relative_path = os.path.relpath(local_path, folder_path)
+                if relative_path in exclude:
+                    continue
                 s3_path = os.path.join(s3_prefix, relative_path).replace("\\", "/")  # Ensure S3 path uses forward slashes
-                self.upload_file(s3_path, local_path)
-                info(f'Uploaded {local_path} to {self.bucket_name}/{s3_path}.')
\ No newline at end of file
+                files.append((local_path, s3_path))
+        remote = {}
+        if skip_unchanged:
+            # Without a listing nothing is known to be unchanged, every file is uploaded
+            remote = {obj['Key']: obj for obj in self.list_object_details(s3_prefix) or []}
+
+        def upload(local_path, s3_path):
+            # Hashing runs on the pool too, hashlib releases the GIL on large buffers
+            if s3_path in remote and self._matches_object(local_path, remote[s3_path]):
+                return None
+            return self.upload_file(s3_path, local_path, folder_marker=False)
+
+        start = time.perf_counter()
+        uploaded, skipped, failed, total_bytes = 0, 0, [], 0
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            futures = {executor.submit(upload, local_path, s3_path): (local_path, s3_path)
+                       for local_path, s3_path in files}
+            for future in as_completed(futures):
+                local_path, s3_path = futures[future]
+                result = future.result()
+                if result is None:
+                    skipped += 1
+                elif result:
+                    uploaded += 1
+                    total_bytes += os.path.getsize(local_path)
+                else:
+                    failed.append(s3_path)
+        stats = self._transfer_stats(uploaded, total_bytes, time.perf_counter() - start, failed)
+        stats['unchanged'] = skipped
+        info(f"Uploaded {folder_path} to {self.bucket_name}/{s3_prefix}: {stats['objects']} objects, "
+             f"{stats['megabytes']} MB in {stats['seconds']}s ({stats['mb_per_second']} MB/s), "
+             f"{skipped} unchanged, {len(failed)} failed")
+        return stats
@@ -0,0 +1,104 @@
+"""S3Config listing and download against moto's in-process S3 stand-in.
+
+Usage (from face_model/, needs the packages of requirements-dev.txt):
+    python -m unittest s3_config.s3Config_test
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+try:
+    from moto import mock_aws
+except ImportError:
+    raise unittest.SkipTest("moto is not installed, see requirements-dev.txt")
+from s3_config.s3Config import S3Config
+
+
+@mock_aws
+class TestS3ConfigDownload(unittest.TestCase):
+
+    def setUp(self):
+        # us-east-1 rejects an explicit LocationConstraint, use a region where the bucket gets created
+        self.s3_config = S3Config('testing', 'testing', region_name='eu-west-1', bucket_name='test-bucket')
+        self.objects = {f'dataset/person_{i % 3}/image_{i}.jpg': os.urandom(100 + i) for i in range(7)}
+        self.objects['dataset/person_0/'] = b''
+        for key, body in self.objects.items():
+            self.s3_config.s3.put_object(Bucket='test-bucket', Key=key, Body=body)
+        self.s3_config.s3.put_object(Bucket='test-bucket', Key='other/file.txt', Body=b'x')
+
+    def test_list_object_follows_pagination(self):
+        keys = self.s3_config.list_object_details('dataset/', page_size=2)
+        self.assertEqual(sorted(obj['Key'] for obj in keys), sorted(self.objects))
+        self.assertEqual(sorted(self.s3_config.list_object('dataset/')), sorted(self.objects))
+
+    def test_failed_page_fails_the_listing(self):
+        paginate = self.s3_config.s3.get_paginator('list_objects_v2').paginate
+
+        def first_page_only(**kwargs):
+            pages = paginate(**kwargs)
+            yield next(iter(pages))
+            raise ConnectionError('connection reset')
+
+        paginator = mock.Mock(paginate=first_page_only)
+        with mock.patch.object(self.s3_config.s3, 'get_paginator', return_value=paginator), \
+                tempfile.TemporaryDirectory() as local_dir:
+            self.assertIsNone(self.s3_config.list_object_details('dataset/', page_size=2))
+            self.assertIsNone(self.s3_config.download_all_objects('dataset/', local_dir))
+            self.assertEqual(os.listdir(local_dir), [])
+
+    def test_download_all_objects(self):
+        with tempfile.TemporaryDirectory() as local_dir:
+            stats = self.s3_config.download_all_objects('dataset/', local_dir, max_workers=4)
+            files = {key: body for key, body in self.objects.items() if not key.endswith('/')}
+            self.assertEqual(stats['objects'], len(files))
+            self.assertEqual(stats['failed'], [])
+            for key, body in files.items():
+                with open(os.path.join(local_dir, key), 'rb') as local_file:
+                    self.assertEqual(local_file.read(), body)
+            self.assertFalse(os.path.exists(os.path.join(local_dir, 'other')))
+
+    def test_sync_transfers_only_changes(self):
+        with tempfile.TemporaryDirectory() as local_dir:
+            self.assertEqual(self.s3_config.sync('dataset/', local_dir)['objects'], 7)
+            self.assertEqual(self.s3_config.sync('dataset/', local_dir)['objects'], 0)
+
+            self.s3_config.s3.put_object(Bucket='test-bucket', Key='dataset/person_1/image_1.jpg', Body=b'changed')
+            self.s3_config.s3.delete_object(Bucket='test-bucket', Key='dataset/person_2/image_2.jpg')
+            stats = self.s3_config.sync('dataset/', local_dir, delete=True)
+            self.assertEqual((stats['objects'], stats['unchanged'], stats['deleted']), (1, 5, 1))
+            with open(os.path.join(local_dir, 'dataset/person_1/image_1.jpg'), 'rb') as local_file:
+                self.assertEqual(local_file.read(), b'changed')
+            self.assertFalse(os.path.exists(os.path.join(local_dir, 'dataset/person_2/image_2.jpg')))
+
+    def test_sync_adopts_existing_files(self):
+        with tempfile.TemporaryDirectory() as local_dir:
+            self.s3_config.download_all_objects('dataset/', local_dir)
+            stats = self.s3_config.sync('dataset/', local_dir)
+            self.assertEqual((stats['objects'], stats['unchanged']), (0, 7))
+
+    def test_upload_folder_skips_unchanged_files(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ('a/weights.pt', 'a/b/labels.json', 'readme.txt'):
+                os.makedirs(os.path.dirname(os.path.join(folder, name)), exist_ok=True)
+                with open(os.path.join(folder, name), 'wb') as local_file:
+                    local_file.write(os.urandom(64))
+            self.assertEqual(self.s3_config.upload_folder('models', folder)['objects'], 3)
+            self.assertEqual(sorted(self.s3_config.list_object('models')),
+                             ['models/a/b/labels.json', 'models/a/weights.pt', 'models/readme.txt'])
+
+            with open(os.path.join(folder, 'readme.txt'), 'wb') as local_file:
+                local_file.write(b'updated')
+            stats = self.s3_config.upload_folder('models', folder)
+            self.assertEqual((stats['objects'], stats['unchanged']), (1, 2))
+
+    def test_upload_folder_exclude(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ('gallery-00000.tar', 'index.json'):
+                with open(os.path.join(folder, name), 'wb') as local_file:
+                    local_file.write(os.urandom(64))
+            self.assertEqual(self.s3_config.upload_folder('archive/', folder, exclude=('index.json',))['objects'], 1)
+            self.assertEqual(self.s3_config.list_object('archive/'), ['archive/gallery-00000.tar'])
+
+
+if __name__ == '__main__':
+    unittest.main()
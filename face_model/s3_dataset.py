@@ -0,0 +1,216 @@
+import os
+import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from dataset_shards import valid_extensions
+from logger import info, error
+
+MB = 1024 * 1024
+# Files younger than this may still be written by another process and are never evicted
+EVICTION_GRACE_SECONDS = 30
+
+
+class S3Dataset:
+    """Gallery images listed from S3 and downloaded on demand into a size-bounded LRU disk cache.
+
+    Keys follow the arcface_train_dataset layout, <prefix><customer>/<image>, so training can
+    start from the listing without mirroring the bucket first. Cached files are named after
+    the object ETag, a replaced image is therefore never served stale. The cache directory is
+    shared by every process reading the dataset (DataLoader and extraction workers): each one
+    counts the bytes it adds and, once over max_bytes, rescans the directory and evicts the
+    least recently read files down to 90% of the budget.
+    """
+
+    def __init__(self, prefix, cache_dir, max_bytes, read_ahead=8):
+        self.prefix = prefix if prefix.endswith('/') else f"{prefix}/"
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.read_ahead = read_ahead
+        self.entries = None
+        self.hits = 0
+        self.misses = 0
+        self._reset()
+
+    @classmethod
+    def from_env(cls, prefix, cache_dir):
+        return cls(prefix, cache_dir,
+                   max_bytes=int(os.getenv('DATASET_S3_CACHE_MB', '2048')) * MB,
+                   read_ahead=int(os.getenv('DATASET_S3_READ_AHEAD', '8')))
+
+    def _reset(self):
+        self._lock = Lock()
+        self._s3_config = None
+        self._s3_pid = None
+        self._executor = None
+        self._pending = {}
+        self._used_bytes = None
+        self._evicting = False
+
+    def __getstate__(self):
+        # The S3 client, the download pool and the lock are recreated in the receiving process
+        state = dict(self.__dict__)
+        for name in ('_lock', '_s3_config', '_s3_pid', '_executor', '_pending', '_used_bytes', '_evicting'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _s3(self):
+        # boto3 clients do not survive fork(), each process builds its own. So does the lock:
+        # a fork taken while a download thread held it would leave it locked forever
+        if self._s3_config is None or self._s3_pid != os.getpid():
+            from s3_config.s3Config import S3Config
+            self._reset()
+            self._s3_config = S3Config()
+            self._s3_pid = os.getpid()
+        return self._s3_config
+
+    def refresh(self):
+        """List the dataset objects; called on first use, call again to pick up new uploads."""
+        objects = self._s3().list_object_details(self.prefix)
+        if objects is None:
+            raise OSError(f"Could not list s3://{self._s3().bucket_name}/{self.prefix}")
+        entries = {}
+        for obj in objects:
+            parts = obj['Key'][len(self.prefix):].split('/')
+            if len(parts) == 2 and parts[1].lower().endswith(valid_extensions):
+                entries[obj['Key']] = {'person': parts[0], 'etag': obj['ETag'], 'size': obj['Size']}
+        if not entries:
+            raise ValueError(f"No images found under s3://{self._s3().bucket_name}/{self.prefix}")
+        self.entries = entries
+        info(f"S3 dataset {self.prefix}: {len(self.entries)} images, cache {self.cache_dir} "
+             f"limited to {self.max_bytes // MB} MB")
+        return self
+
+    def _listed(self):
+        if self.entries is None:
+            self.refresh()
+        return self.entries
+
+    def persons(self):
+        return sorted({entry['person'] for entry in self._listed().values()})
+
+    def images_by_person(self):
+        """Return the sorted image keys of every customer."""
+        images = {}
+        for key in sorted(self._listed()):
+            images.setdefault(self.entries[key]['person'], []).append(key)
+        return images
+
+    def digest(self, key):
+        """Content address of an image for the embedding stores, without downloading it."""
+        return f"s3-etag-{self._listed()[key]['etag']}"
+
+    def _cache_path(self, key):
+        folder, name = os.path.split(key)
+        return os.path.join(self.cache_dir, folder, f"{self._listed()[key]['etag']}-{name}")
+
+    def prefetch(self, keys):
+        """Start downloading images in the background so that the following fetches hit the cache."""
+        self._s3()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.read_ahead))
+            for key in keys:
+                if key not in self._pending and not os.path.exists(self._cache_path(key)):
+                    self._pending[key] = self._executor.submit(self._download, key)
+
+    def _download(self, key):
+        path = self._cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not self._s3().retrieve_file(key, path):
+                raise OSError(f"Could not download s3://{self._s3().bucket_name}/{key}")
+            self._added(self.entries[key]['size'])
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def fetch(self, key):
+        """Return the local path of an image, downloading it first on a cache miss."""
+        path = self._cache_path(key)
+        try:
+            # The modification time records the last read for the LRU eviction
+            os.utime(path)
+            self.hits += 1
+            return path
+        except FileNotFoundError:
+            self.misses += 1
+        self.prefetch([key])
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None:
+            future.result()
+        return path
+
+    def open_image(self, key):
+        """Open an image as RGB, fetching it again if another process evicted it meanwhile."""
+        for attempt in range(2):
+            try:
+                with Image.open(self.fetch(key)) as image:
+                    return image.convert("RGB")
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+    def _added(self, size):
+        with self._lock:
+            # Until the first rescan of this process, the size of what is already cached is unknown
+            if self._used_bytes is not None:
+                self._used_bytes += size
+                if self._used_bytes <= self.max_bytes:
+                    return
+            if self._evicting:
+                return
+            self._evicting = True
+        # The directory walk runs outside the lock so that fetches and prefetches are not blocked
+        try:
+            used_bytes = self._evict()
+            with self._lock:
+                self._used_bytes = used_bytes
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def _evict(self):
+        """Rescan the cache and, once over max_bytes, delete the least recently read files down to
+        90% of it; return the cache size."""
+        files, total = [], 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return total
+        target_bytes = int(self.max_bytes * 0.9)
+        now = time.time()
+        evicted = 0
+        for mtime, size, path in sorted(files):
+            if total <= target_bytes or now - mtime < EVICTION_GRACE_SECONDS:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                error(f"Could not evict {path} from the S3 dataset cache: {e}")
+        info(f"S3 dataset cache: evicted {evicted} files, {total // MB} MB kept")
+        return total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,110 @@
+import os
+import json
+import random
+import hashlib
+import numpy as np
+import torch
+from logger import info, error
+
+
+def config_hash(config):
+    """Stable short hash of a training config; runs with the same config share checkpoints."""
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def dataset_fingerprint(items):
+    """Stable short hash of (image reference, version) pairs, e.g. path and content hash or ETag."""
+    digest = hashlib.sha256()
+    for ref, version in sorted(items):
+        digest.update(f"{ref}\0{version}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def directory_fingerprint(dataset_dir):
+    """dataset_fingerprint of a dataset directory by relative path, size and modification time."""
+    items = []
+    for root, _, file_names in os.walk(dataset_dir):
+        for file_name in file_names:
+            stat = os.stat(os.path.join(root, file_name))
+            items.append((os.path.relpath(os.path.join(root, file_name), dataset_dir),
+                          f"{stat.st_size}-{stat.st_mtime_ns}"))
+    return dataset_fingerprint(items)
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class TrainingCheckpoint:
+    """Resumable state of one training run, one file per part (e.g. 'features', 'fit').
+
+    Files are named after the run and its config hash, so re-running with the same config
+    resumes where the previous run stopped and a different config starts fresh. Callers put
+    a dataset fingerprint into the config, so a run over changed images starts fresh too.
+    """
+
+    def __init__(self, checkpoint_dir, name, config, every_epochs=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.name = name
+        self.config = config
+        self.key = f"{name}-{config_hash(config)}"
+        self.every_epochs = every_epochs or int(os.getenv('TRAINING_CHECKPOINT_EVERY', '1'))
+
+    def _path(self, part):
+        return os.path.join(self.checkpoint_dir, f"{self.key}.{part}.pt")
+
+    def due(self, epoch):
+        """Whether a checkpoint is due after the given 1-based epoch."""
+        return epoch % self.every_epochs == 0
+
+    def save(self, part, state):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        path = self._path(part)
+        torch.save(dict(state, config=self.config), f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        info(f"Checkpoint saved: {path}")
+
+    def load(self, part):
+        """Return the saved state of a part, or None when there is nothing to resume from."""
+        path = self._path(part)
+        if not os.path.isfile(path):
+            return None
+        try:
+            # Checkpoints hold numpy arrays and RNG states besides tensors
+            state = torch.load(path, map_location='cpu', weights_only=False)
+        except Exception as e:
+            error(f"Checkpoint {path} is unreadable, starting over: {e}")
+            return None
+        if state.get('config') != self.config:
+            return None
+        info(f"Resuming from checkpoint {path}")
+        return state
+
+    def clear_other_runs(self):
+        """Remove checkpoints of this name left by runs with another config, which can no longer resume."""
+        if not os.path.isdir(self.checkpoint_dir):
+            return
+        for file_name in os.listdir(self.checkpoint_dir):
+            if file_name.startswith(f"{self.name}-") and not file_name.startswith(f"{self.key}."):
+                os.remove(os.path.join(self.checkpoint_dir, file_name))
+                info(f"Stale checkpoint {file_name} removed")
+
+    def clear(self):
+        """Remove the checkpoints of a run that completed."""
+        if not os.path.isdir(self.checkpoint_dir):
+            return
+        for file_name in os.listdir(self.checkpoint_dir):
+            if file_name.startswith(f"{self.key}."):
+                os.remove(os.path.join(self.checkpoint_dir, file_name))
+        info(f"Checkpoints of {self.key} removed")
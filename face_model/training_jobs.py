@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import queue
+import signal
+import multiprocessing
+from threading import Lock, Thread
+from inference_executor import ExecutorBusyError
+from logger import info, error
+
+JOB_STATES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+FINISHED_STATES = ('succeeded', 'failed', 'cancelled')
+
+
+def parse_cpu_list(spec):
+    """Parse a CPU list such as "2,3,6-7" into [2, 3, 6, 7]."""
+    cpus = []
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def default_training_cpus():
+    """CPUs for training: TRAINING_CPUS, or the upper half of the CPUs this process may use."""
+    spec = os.getenv('TRAINING_CPUS')
+    if spec:
+        return parse_cpu_list(spec)
+    cpus = sorted(os.sched_getaffinity(0))
+    # The lower half stays with the serving workers
+    return cpus[len(cpus) // 2:] if len(cpus) > 1 else cpus
+
+
+def train_models(config, on_epoch=None):
+    """Train the ArcFace head and FaceNet on arcface_train_dataset, the work behind POST /train.
+
+    Both runs checkpoint as they go; calling this again with the same config after an
+    interruption resumes them, and the checkpoints are removed once both have completed.
+    """
+    from argface_model.argface_classifier import ArcFaceClassifier
+    from facenet_model.facenet_model import FaceNetModel
+    from model_registry import (arcface_dataset, arcface_model_dir, build_dir, dataset_backend, dataset_s3_cache_dir,
+                                dataset_shard_dir, facenet_model_dir, facenet_model_file_path, gallery_archive_dir,
+                                model_save_path, training_checkpoint_dir)
+    from training_checkpoint import TrainingCheckpoint, dataset_fingerprint, directory_fingerprint
+
+    def report(stage):
+        return (lambda metrics: on_epoch(stage, metrics)) if on_epoch else None
+
+    s3_dataset, archive = None, None
+    if dataset_backend == 's3':
+        # Images are listed from the bucket and downloaded as the trainers read them
+        from s3_dataset import S3Dataset
+        s3_dataset = S3Dataset.from_env(f"{os.path.basename(arcface_dataset)}/", dataset_s3_cache_dir).refresh()
+        dataset_shard_dir = None
+    elif dataset_backend == 'archive':
+        # A few large tar shards are synced instead of one object per image
+        from gallery_archive import GalleryArchive
+        from s3_config.s3Config import S3Config
+        S3Config().sync(f"{os.path.basename(gallery_archive_dir)}/", build_dir,
+                        delete=os.getenv("S3_SYNC_DELETE", "false").lower() == "true")
+        archive = GalleryArchive(gallery_archive_dir)
+        if not len(archive):
+            raise ValueError(f"Gallery archive {gallery_archive_dir} is empty, run pack_gallery.py --upload first")
+        dataset_shard_dir = None
+    # Pick up images added to the bucket since the last run, only the new or changed ones are transferred
+    elif os.getenv("S3_SYNC_BEFORE_TRAIN", "true").lower() == "true" or not os.path.exists(arcface_dataset):
+        from s3_config.s3Config import S3Config
+        info(f"Syncing {arcface_dataset} from S3")
+        S3Config().sync(f"{os.path.basename(arcface_dataset)}/", build_dir,
+                        delete=os.getenv("S3_SYNC_DELETE", "false").lower() == "true")
+
+    # Checkpoints only resume a run over the same images: 'done', the features and the split all
+    # describe the dataset they were taken on
+    if s3_dataset is not None:
+        fingerprint = dataset_fingerprint((key, entry['etag']) for key, entry in s3_dataset.entries.items())
+    elif archive is not None:
+        fingerprint = dataset_fingerprint((entry['path'], entry['digest']) for entry in archive.entries)
+    else:
+        fingerprint = directory_fingerprint(arcface_dataset)
+    checkpoint_config = dict(config, dataset=fingerprint)
+    arcface_checkpoint = TrainingCheckpoint(training_checkpoint_dir, 'arcface', checkpoint_config)
+    facenet_checkpoint = TrainingCheckpoint(training_checkpoint_dir, 'facenet', checkpoint_config)
+    arcface_checkpoint.clear_other_runs()
+    facenet_checkpoint.clear_other_runs()
+
+    # A run interrupted during FaceNet training does not train ArcFace again
+    if arcface_checkpoint.load('done') is None:
+        classifier = ArcFaceClassifier(arcface_dataset, arcface_model_dir, model_save_path, dataset_shard_dir,
+                                       s3_dataset, archive)
+        info("Initializing and training the model.")
+        classifier.initialize_model()
+        classifier.extract_features(checkpoint=arcface_checkpoint)
+        classifier.train(num_epochs=config['num_epochs'], lr=config['learning_rate'], momentum=config['momentum'],
+                         batch_size=config['batch_size'], on_epoch=report('arcface'), checkpoint=arcface_checkpoint)
+        classifier.plot_training_metrics(os.path.join(arcface_model_dir, 'arcface_train_loss'))
+        arcface_checkpoint.save('done', {})
+
+    faceNetModel = FaceNetModel(
+        image_path=arcface_dataset, batch_size=64, lr=config['learning_rate'],
+        num_epochs=config['num_epochs'], save_path=facenet_model_dir,
+        model_file_path=facenet_model_file_path, shard_dir=dataset_shard_dir, s3_dataset=s3_dataset,
+        archive=archive
+    )
+    faceNetModel.train(on_epoch=report('facenet'), checkpoint=facenet_checkpoint)
+
+    arcface_checkpoint.clear()
+    facenet_checkpoint.clear()
+
+
+def _run_job(train_fn, config, cpus, niceness, events):
+    """Entry point of the training process: pin it, lower its priority, then train."""
+    os.sched_setaffinity(0, cpus)
+    os.nice(niceness)
+    from training_profile import TrainingProfile
+    # After pinning, the thread count follows the job's CPUs and the container quota
+    TrainingProfile.from_env().apply_threads()
+    info(f"Training process {os.getpid()} running on CPUs {cpus} with niceness {niceness}")
+
+    def on_epoch(stage, metrics):
+        events.put(('epoch', dict(metrics, stage=stage)))
+
+    try:
+        train_fn(config, on_epoch)
+    except Exception as e:
+        error(f"Training failed: {e}")
+        events.put(('error', f"{type(e).__name__}: {e}"))
+        raise SystemExit(1)
+
+
+class TrainingJobManager:
+    """Queue of training jobs, each run in its own low-priority process pinned to training CPUs.
+
+    Job records are written to job_dir so every serving worker can report them, and a file
+    lock there keeps one training per host even with several prefork workers.
+    """
+
+    def __init__(self, job_dir, train_fn=train_models, on_success=None, cpus=None, niceness=10,
+                 max_queue=4, retry_after=1):
+        self.job_dir = job_dir
+        self.train_fn = train_fn
+        self.on_success = on_success
+        self.cpus = cpus or default_training_cpus()
+        self.niceness = niceness
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._jobs = {}
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._thread = None
+        self._process = None
+        # spawn: the serving process holds model threads and sessions that must not be forked
+        self._context = multiprocessing.get_context('spawn')
+
+    def _job_path(self, job_id):
+        return os.path.join(self.job_dir, f"{job_id}.json")
+
+    def _save(self, job):
+        os.makedirs(self.job_dir, exist_ok=True)
+        with open(f"{self._job_path(job['id'])}.tmp", 'w') as job_file:
+            json.dump(job, job_file)
+        os.replace(f"{self._job_path(job['id'])}.tmp", self._job_path(job['id']))
+
+    def _load(self, job_id):
+        try:
+            with open(self._job_path(job_id)) as job_file:
+                return json.load(job_file)
+        except (OSError, ValueError):
+            return None
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+            self._save(job)
+
+    def submit(self, config):
+        """Queue a training run and return its job record, ExecutorBusyError when the queue is full."""
+        with self._lock:
+            queued = sum(1 for job in self._jobs.values() if job['status'] == 'queued')
+            if queued >= self.max_queue:
+                raise ExecutorBusyError('training', self.retry_after)
+            job = {
+                'id': uuid.uuid4().hex,
+                'status': 'queued',
+                'config': config,
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'pid': None,
+                'metrics': [],
+                'error': None,
+                'cancel_requested': False,
+            }
+            self._jobs[job['id']] = job
+            self._save(job)
+            if self._thread is None:
+                self._thread = Thread(target=self._run_forever, name='training-jobs', daemon=True)
+                self._thread.start()
+        self._queue.put(job['id'])
+        info(f"Training job {job['id']} queued with config {config}")
+        return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        # Jobs submitted to another prefork worker are only known from their record
+        return self._load(job_id)
+
+    def list(self):
+        jobs = {}
+        if os.path.isdir(self.job_dir):
+            for file_name in os.listdir(self.job_dir):
+                if file_name.endswith('.json'):
+                    job = self._load(file_name[:-len('.json')])
+                    if job:
+                        jobs[job['id']] = job
+        with self._lock:
+            jobs.update((job_id, dict(job)) for job_id, job in self._jobs.items())
+        return sorted(jobs.values(), key=lambda job: job['created_at'], reverse=True)
+
+    def cancel(self, job_id):
+        """Cancel a queued job or stop a running one; returns the job record or None if unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                job = self._load(job_id)
+                if job is None:
+                    return None
+            if job['status'] in FINISHED_STATES:
+                return dict(job)
+            job['cancel_requested'] = True
+            if job['status'] == 'queued':
+                job.update(status='cancelled', finished_at=time.time())
+            self._save(job)
+            pid = job['pid'] if job['status'] == 'running' else None
+        if pid:
+            info(f"Stopping training job {job_id} (pid {pid})")
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        return dict(job)
+
+    def _run_forever(self):
+        while True:
+            job = self._jobs[self._queue.get()]
+            if job['status'] != 'queued':
+                continue
+            os.makedirs(self.job_dir, exist_ok=True)
+            with open(os.path.join(self.job_dir, '.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if job['status'] != 'queued':
+                    continue
+                try:
+                    self._run(job)
+                except Exception as e:
+                    error(f"Training job {job['id']} failed: {e}")
+                    self._update(job, status='failed', error=str(e), finished_at=time.time())
+
+    def _run(self, job):
+        events = self._context.Queue()
+        process = self._context.Process(target=_run_job, name=f"training-{job['id']}",
+                                        args=(self.train_fn, job['config'], self.cpus, self.niceness, events))
+        process.start()
+        self._process = process
+        self._update(job, status='running', started_at=time.time(), pid=process.pid)
+        info(f"Training job {job['id']} started in process {process.pid}")
+
+        error_message = None
+        # Drain events while the process runs; a child blocked on a full pipe would never exit
+        while process.is_alive() or not events.empty():
+            try:
+                kind, payload = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if kind == 'epoch':
+                with self._lock:
+                    job['metrics'].append(payload)
+                    self._save(job)
+            elif kind == 'error':
+                error_message = payload
+        process.join()
+        self._process = None
+
+        # A cancel may have been recorded by another prefork worker
+        record = self._load(job['id']) or job
+        if job['cancel_requested'] or record.get('cancel_requested'):
+            self._update(job, status='cancelled', cancel_requested=True, finished_at=time.time())
+        elif process.exitcode == 0:
+            self._update(job, status='succeeded', finished_at=time.time())
+            if self.on_success:
+                self.on_success()
+        else:
+            self._update(job, status='failed', finished_at=time.time(),
+                         error=error_message or f"training process exited with code {process.exitcode}")
+        info(f"Training job {job['id']} {job['status']}")
+
+    def shutdown(self):
+        """Stop a running training process, e.g. when the server exits."""
+        process = self._process
+        if process is not None and process.is_alive():
+            info(f"Stopping training process {process.pid}")
+            process.terminate()
+            process.join(10)
@@ -0,0 +1,120 @@
+import os
+import math
+import contextlib
+import torch
+from logger import info, error
+
+
+def cgroup_cpu_limit():
+    """Return the container CPU quota in CPUs (cgroup v2 or v1), None when unlimited."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as quota_file, \
+                open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """CPUs this process can actually use: its affinity mask capped by the cgroup quota.
+
+    os.cpu_count() reports the node's cores, which oversubscribes a pod limited to a few CPUs.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    limit = cgroup_cpu_limit()
+    if limit:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+
+class CompiledModule:
+    """Call a torch.compile'd module and fall back to the eager module when compiling fails.
+
+    torch.compile() itself only wraps the module; the graph is compiled on the first call
+    (and again on a recompilation), which is therefore where a missing compiler shows up.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.compiled = torch.compile(module)
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.module(*args, **kwargs)
+        try:
+            return self.compiled(*args, **kwargs)
+        except Exception as e:
+            error(f"torch.compile failed ({type(e).__name__}: {e}), training in eager mode")
+            self.compiled = None
+            return self.module(*args, **kwargs)
+
+
+class TrainingProfile:
+    """Performance options shared by the FaceNet and ArcFace training loops.
+
+    Threads are process wide, so apply_threads() is called once by the training process;
+    threads defaults to available_cpus(). bf16 autocast, channels_last and torch.compile are
+    opt-in because their speedup depends on the CPU (bf16 needs AVX512-BF16/AMX to pay off).
+    """
+
+    def __init__(self, threads=None, interop_threads=None, bf16=False, channels_last=False, torch_compile=False):
+        self.threads = threads or available_cpus()
+        self.interop_threads = interop_threads or 1
+        self.bf16 = bf16
+        self.channels_last = channels_last
+        self.torch_compile = torch_compile
+
+    @classmethod
+    def from_env(cls):
+        def enabled(name):
+            return os.getenv(name, 'false').lower() == 'true'
+        return cls(
+            threads=int(os.getenv('TRAINING_THREADS', '0')) or None,
+            interop_threads=int(os.getenv('TRAINING_INTEROP_THREADS', '0')) or None,
+            bf16=enabled('TRAINING_BF16'),
+            channels_last=enabled('TRAINING_CHANNELS_LAST'),
+            torch_compile=enabled('TRAINING_COMPILE'),
+        )
+
+    def __repr__(self):
+        return (f"TrainingProfile(threads={self.threads}, interop_threads={self.interop_threads}, bf16={self.bf16}, "
+                f"channels_last={self.channels_last}, torch_compile={self.torch_compile})")
+
+    def apply_threads(self):
+        torch.set_num_threads(self.threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # Only settable before the first inter-op parallel work of the process
+            pass
+        info(f"Training with {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads")
+
+    def prepare_model(self, module):
+        """Return the module to call in the training loop; parameters stay shared with `module`."""
+        if self.channels_last:
+            module = module.to(memory_format=torch.channels_last)
+        if self.torch_compile:
+            try:
+                return CompiledModule(module)
+            except Exception as e:
+                error(f"torch.compile unavailable ({e}), training in eager mode")
+        return module
+
+    def prepare_input(self, batch):
+        if self.channels_last and batch.dim() == 4:
+            return batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def autocast(self, device):
+        if not self.bf16:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)